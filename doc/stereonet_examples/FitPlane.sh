@@ -19,6 +19,8 @@ stereonet $datfile --lines | $gmt_bin/psxy $R $J -Sc5p -Gblue -O -K >> $outfile
 #--Fit a Plane to the data-------------
 #  With fitcircle, -L2 is usually better than -L1 for this purpose. 
 plane=$(stereonet $datfile --lines |  $gmt_bin/fitcircle -L2 | awk 'NR==2{print $1, $2}' | stereonet -I plane)
+#  or, without fitcircle, using the orientation tensor of the lines
+#plane=$(stereonet $datfile --lines --fit | awk '$1=="plane"{print $2}')
 
 #--Plot the plane----------------------
 echo $plane | stereonet |  $gmt_bin/psxy $R $J -m -W2p/red -O -K >> $outfile
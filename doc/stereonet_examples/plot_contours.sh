@@ -46,6 +46,10 @@ $gmt_bin/grdfilter $grid -Fg$filterwidth -D0 -G$filtergrid
 #   Convert units to percent (1-100) per sq. degree
 scalefac=$(echo "scale=5; 100 * $filterwidth^2 / (2*3.14 * $numdata * $cellsize^2)" | bc) 
 $gmt_bin/grdmath  $filtergrid $scalefac MUL = $filtergrid
+
+#   Alternatively, stereonet can count the poles on the sphere itself
+#   (Kamb contours in multiples of sigma, see stereonet --help):
+#stereonet --density kamb $datfile | $gmt_bin/xyz2grd -G$filtergrid -R-90/90/-90/90 -I2
 #-------------------------------------------------------
 
 
@@ -7,7 +7,7 @@ __version__ = "0.1"
 __license__ = "MIT <http://opensource.org/licenses/mit-license.php>"
 
 # Local imports.
-from cogo import AngleDMS, avg_angles, dd2dms
+from cogo import AngleDMS, dd2dms
 
 # Standard library imports.
 import csv
@@ -20,11 +20,15 @@ from optparse import OptionParser
 from os import name, path
 
 # Numpy imports.
-from numpy import empty, mean, ptp
+from numpy import arange, arctan2, argsort, array, around, bincount, \
+                  concatenate, cos, degrees, dtype, errstate, flatnonzero, \
+                  floor, full, inf, isnan, lexsort, maximum, minimum, nan, \
+                  radians, sin, sort, unique, where, zeros
 
 # Enthought library imports.
-from enthought.traits.api import Date, Dict, Bool, Enum, File, Float, \
-                                 HasTraits, Instance, Int, List, String, Time
+from enthought.traits.api import Any, Date, Dict, Bool, Enum, File, Float, \
+                                 HasTraits, Instance, Int, List, Property, \
+                                 String, Time
 
 class TerminalController:
     """
@@ -232,7 +236,170 @@ class Station(SOKKIARecord):
 class Target(SOKKIARecord):
     """Target description."""
     target_height = Float
-    
+
+# One row per record of a SOKKIABook. Angles are in decimal degrees. For
+# stations north_horizontal and east_vertical are coordinates. station,
+# theodolite_height, target_height and job_id hold the station, target and job
+# in effect at each record.
+record_dtype = dtype([('record_type', 'S12'),
+                      ('point_id', 'i8'),
+                      ('dc', 'S2'),
+                      ('code', 'S45'),
+                      ('north_horizontal', 'f8'),
+                      ('east_vertical', 'f8'),
+                      ('elevation_distance', 'f8'),
+                      ('source_file', 'S45'),
+                      ('job_id', 'S45'),
+                      ('station', 'S45'),
+                      ('theodolite_height', 'f8'),
+                      ('target_height', 'f8')])
+
+class RecordList(object):
+    """List of the records in a table with record_dtype.
+
+    Each record is only created (as a SOKKIARecord, Job, Station or Target)
+    the first time it is used. Appended records are kept after those in the
+    table."""
+    def __init__(self, table):
+        self.table = table
+        self.views = {}
+        self.extra = []
+
+    def __len__(self):
+        return len(self.table) + len(self.extra)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('record index out of range')
+        if index >= len(self.table):
+            return self.extra[index - len(self.table)]
+        if index not in self.views:
+            self.views[index] = record_view(self.table[index])
+        return self.views[index]
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def append(self, record):
+        self.extra.append(record)
+
+    def extend(self, records):
+        self.extra.extend(records)
+
+def record_view(row):
+    """Return the record object for a row of a table with record_dtype."""
+    record_type = str(row['record_type'])
+    dc = str(row['dc']) or None
+    if record_type == 'OBS':
+        return SOKKIARecord(record_type=record_type,
+                            point_id=int(row['point_id']),
+                            dc=dc,
+                            code=str(row['code']),
+                            north_horizontal=dd2angle(row['north_horizontal']),
+                            east_vertical=dd2angle(row['east_vertical']),
+                            elevation_distance=distance_list(
+                                row['elevation_distance'])[0])
+    elif record_type == 'JOB':
+        return Job(record_type=record_type,
+                   dc=dc,
+                   source_file=str(row['source_file']),
+                   job_id=str(row['job_id']))
+    elif record_type == 'STN':
+        return Station(record_type=record_type,
+                       point_id=int(row['point_id']),
+                       dc=dc,
+                       code=str(row['code']),
+                       north_horizontal=float(row['north_horizontal']),
+                       east_vertical=float(row['east_vertical']),
+                       elevation_distance=float(row['elevation_distance']),
+                       theodolite_height=float(row['theodolite_height']))
+    elif record_type == 'TARGET':
+        return Target(record_type=record_type,
+                      dc=dc,
+                      code=str(row['code']),
+                      target_height=float(row['target_height']))
+    raise ValueError, 'Unknown record type: %s' % record_type
+
+def records_table(records):
+    """Return a table with record_dtype for a list of record objects."""
+    rows = []
+    context = {'job_id': '', 'station': '',
+               'theodolite_height': nan, 'target_height': nan}
+    for record in records:
+        row = dict(context, record_type=record.record_type,
+                   point_id=record.point_id, dc=record.dc or '',
+                   code=record.code, north_horizontal=nan,
+                   east_vertical=nan, elevation_distance=nan,
+                   source_file='')
+        if record.record_type == 'OBS':
+            row['north_horizontal'] = record.north_horizontal.decimal_degrees
+            row['east_vertical'] = record.east_vertical.decimal_degrees
+            row['elevation_distance'] = record.elevation_distance
+        elif record.record_type == 'JOB':
+            row['source_file'] = record.source_file
+            row['job_id'] = context['job_id'] = record.job_id
+        elif record.record_type == 'STN':
+            row['north_horizontal'] = record.north_horizontal
+            row['east_vertical'] = record.east_vertical
+            row['elevation_distance'] = record.elevation_distance
+            row['station'] = context['station'] = record.code
+            row['theodolite_height'] = record.theodolite_height
+            context['theodolite_height'] = record.theodolite_height
+        elif record.record_type == 'TARGET':
+            row['target_height'] = context['target_height'] = \
+                record.target_height
+        rows.append(tuple([row[name] for name in record_dtype.names]))
+    return array(rows, dtype=record_dtype)
+
+def parse_dms(text):
+    """Return the decimal degrees of a 'label: dd-mm-ss' field."""
+    d, m, s = text.split(':')[-1].split('-')
+    return int(d) + int(m)/60.0 + float(s)/3600.0
+
+def dms_columns(angles):
+    """Return arrays of the degrees, minutes and seconds of an array of
+    angles in decimal degrees, with seconds rounded to 4 decimal places."""
+    seconds = around(array(angles, dtype=float, ndmin=1) * 3600, 4) % 1296000
+    degrees = floor(seconds / 3600)
+    minutes = floor((seconds - degrees * 3600) / 60)
+    seconds = seconds - degrees * 3600 - minutes * 60
+    return degrees.astype(int), minutes.astype(int), seconds
+
+def format_dms(angles):
+    """Return a list of angles in decimal degrees formatted as dddmmss.ssss
+    for COLUMBUS."""
+    return ['%.3i%.2i%07.4f' % dms for dms in zip(*[c.tolist() for c in
+                                                      dms_columns(angles)])]
+
+def dd2angle(angle):
+    """Return an AngleDMS for an angle in decimal degrees (exact for whole
+    seconds, unlike dd2dms)."""
+    d, m, s = [c.tolist()[0] for c in dms_columns([angle])]
+    return AngleDMS(degrees=d, minutes=m, seconds=s)
+
+def distance_list(distances):
+    """Return a list of distances with the missing (nan) ones as 0."""
+    return [0 if d != d else d for d in array(distances, ndmin=1).tolist()]
+
+def fill_context(table):
+    """Set the job, station and heights of each row of a table with
+    record_dtype to those of the last JOB, STN and TARGET rows up to it."""
+    index = arange(len(table))
+    for field, record_type, source, default in (
+            ('job_id', 'JOB', 'job_id', ''),
+            ('station', 'STN', 'code', ''),
+            ('theodolite_height', 'STN', 'theodolite_height', nan),
+            ('target_height', 'TARGET', 'target_height', nan)):
+        last = maximum.accumulate(where(table['record_type'] == record_type,
+                                        index, -1))
+        table[field] = where(last >= 0, table[source][last], default)
+    return table
+
 class SOKKIABook(HasTraits):
     """SOKKIA text fieldbook."""
     project = String
@@ -244,8 +411,28 @@ class SOKKIABook(HasTraits):
     point_count = Int
     record_divider = String('-'*135)
     record_pattern = Dict
-    record_list = List
+    record_list = Property(List)
+    observations = Any(desc='table of the records with record_dtype')
     tps_model = Instance(TPSModel)
+    _record_list = Any
+
+    def _get_record_list(self):
+        if self._record_list is None:
+            if self.observations is None:
+                self.observations = zeros(0, dtype=record_dtype)
+            self._record_list = RecordList(self.observations)
+        return self._record_list
+
+    def _set_record_list(self, records):
+        self._record_list = records
+
+    def observation_table(self):
+        """Return the records as a table with record_dtype, rebuilt from
+        record_list if it has been replaced or appended to."""
+        records = self.record_list
+        if isinstance(records, RecordList) and not records.extra:
+            return records.table
+        return records_table(records)
     
     def load(self, input_filename):
         try:
@@ -289,79 +476,76 @@ class SOKKIABook(HasTraits):
                 # Normalize new lines and split records.
                 file_text = file_text.replace('\r\n', '\n').replace('\r', '\n')
                 records = file_text.split('\n%s\n' % self.record_divider)
+                col = self.record_pattern
+                rows = []
+                context = {'job_id': '', 'station': '',
+                           'theodolite_height': nan, 'target_height': nan}
+                # Records of an earlier load carry on into this one.
+                previous = self.observation_table()
+                if len(previous):
+                    for name in context:
+                        context[name] = previous[-1][name]
                 for record in records:
-                    lines = record.splitlines()
-                    record = empty([len(lines), 7], dtype='S45')
-                    for line_num, line in enumerate(lines):
-                        line = [line[:8].strip(),
-                                line[8:20].strip(),
-                                line[20:25].strip(),
-                                line[25:70].strip(),
-                                line[70:115].strip(),
-                                line[115:150].strip(),
-                                line[150:].strip()]
-                        record[line_num, :] = line
-                    if len(record.shape) == 1:
-                        record = record.reshape([1, record.size])
-                    if record.shape[0] == 0:
+                    # Same columns (and 45 character limit) as the heading.
+                    record = [[field.strip()[:45] for field in
+                               (line[:8], line[8:20], line[20:25], line[25:70],
+                                line[70:115], line[115:150], line[150:])]
+                              for line in record.splitlines()]
+                    if len(record) == 0:
                         continue
-                    if record[0, 1] == 'OBS':
-                        obs = SOKKIARecord()
-                        obs.point_id = int(record[0, self.record_pattern['Pt.']])
-                        obs.record_type = record[0, self.record_pattern['Record Type']]
-                        obs.dc = record[0, self.record_pattern['DC']]
-                        obs.code = str(record[0, self.record_pattern['Code']]).strip()
-                        h = record[0, self.record_pattern['North/Hor']]
-                        h = h.split(':')[-1].split('-')
-                        obs.north_horizontal = AngleDMS(degrees=int(h[0]),
-                                                        minutes=int(h[1]),
-                                                        seconds=int(h[2]),)
-                        v = record[0, self.record_pattern['East/Vert']]
-                        v = v.split(':')[-1].split('-')
-                        obs.east_vertical = AngleDMS(degrees=int(v[0]),
-                                                     minutes=int(v[1]),
-                                                     seconds=int(v[2]),)
-                        d = record[0, self.record_pattern['Elev./Dist']]
+                    first = record[0]
+                    row = dict(context, record_type=first[1], point_id=0,
+                               dc='', code='', north_horizontal=nan,
+                               east_vertical=nan, elevation_distance=nan,
+                               source_file='')
+                    if first[1] == 'OBS':
+                        row['point_id'] = int(first[col['Pt.']])
+                        row['dc'] = first[col['DC']]
+                        row['code'] = first[col['Code']]
+                        row['north_horizontal'] = parse_dms(first[col['North/Hor']])
+                        row['east_vertical'] = parse_dms(first[col['East/Vert']])
                         try:
-                            d = float(d.split(':')[-1])
+                            d = float(first[col['Elev./Dist']].split(':')[-1])
                         except ValueError:
-                            d = 0
-                        obs.elevation_distance = d
-                        self.record_list.append(obs)
-                    elif record[0, 1] == 'JOB':
-                        job = Job()
-                        job.record_type = record[0, self.record_pattern['Record Type']]
-                        job.dc = record[0, self.record_pattern['DC']]
-                        job.source_file = record[0, self.record_pattern['Elev./Dist']].strip()
-                        j = record[0, self.record_pattern['North/Hor']]
-                        job.job_id = j.split(':')[-1].strip()
-                        self.record_list.append(job)
-                    elif record[0, 1] == 'INSTR':
-                        m = record[1, 3].split(':')[1].strip()
+                            d = nan # Exported as 0.
+                        row['elevation_distance'] = d
+                    elif first[1] == 'JOB':
+                        row['dc'] = first[col['DC']]
+                        row['source_file'] = first[col['Elev./Dist']]
+                        j = first[col['North/Hor']]
+                        row['job_id'] = context['job_id'] = j.split(':')[-1].strip()
+                    elif first[1] == 'INSTR':
+                        m = record[1][3].split(':')[1].strip()
                         self.tps_model = TPSModel(model = m)
-                    elif record[0, 1] == 'STN':
-                        stn = Station()
-                        stn.point_id = int(record[0, self.record_pattern['Pt.']])
-                        stn.record_type = record[0, self.record_pattern['Record Type']]
-                        stn.dc = record[0, self.record_pattern['DC']]
-                        stn.code = str(record[0, self.record_pattern['Code']]).strip()
-                        n = record[0, self.record_pattern['North/Hor']]
-                        stn.north_horizontal = float(n.split(':')[-1])
-                        e = record[0, self.record_pattern['East/Vert']]
-                        stn.east_vertical = float(n.split(':')[-1])
-                        d = record[0, self.record_pattern['Elev./Dist']]
-                        stn.elevation_distance = float(d.split(':')[-1])
-                        t = record[1, self.record_pattern['North/Hor']]
-                        stn.theodolite_height = float(t.split(':')[-1])
-                        self.record_list.append(stn)
-                    elif record[0, 1] == 'TARGET':
-                        trg = Target()
-                        trg.record_type = record[0, self.record_pattern['Record Type']]
-                        trg.dc = record[0, self.record_pattern['DC']]
-                        trg.code = str(record[0, self.record_pattern['Code']]).strip()
-                        h = record[0, self.record_pattern['North/Hor']]
-                        trg.target_height = float(h.split(':')[-1])
-                        self.record_list.append(trg)
+                        continue
+                    elif first[1] == 'STN':
+                        row['point_id'] = int(first[col['Pt.']])
+                        row['dc'] = first[col['DC']]
+                        row['code'] = context['station'] = first[col['Code']]
+                        n = first[col['North/Hor']]
+                        row['north_horizontal'] = float(n.split(':')[-1])
+                        e = first[col['East/Vert']]
+                        row['east_vertical'] = float(e.split(':')[-1])
+                        d = first[col['Elev./Dist']]
+                        row['elevation_distance'] = float(d.split(':')[-1])
+                        t = record[1][col['North/Hor']]
+                        row['theodolite_height'] = context['theodolite_height'] = \
+                            float(t.split(':')[-1])
+                        row['station'] = context['station']
+                    elif first[1] == 'TARGET':
+                        row['dc'] = first[col['DC']]
+                        row['code'] = first[col['Code']]
+                        h = first[col['North/Hor']]
+                        row['target_height'] = context['target_height'] = \
+                            float(h.split(':')[-1])
+                    else:
+                        continue
+                    rows.append(tuple([row[name] for name in record_dtype.names]))
+                table = array(rows, dtype=record_dtype)
+                if len(previous):
+                    table = concatenate([previous, table])
+                self.observations = table
+                self._record_list = None
             finally:
                 in_file.close()
             
@@ -418,37 +602,28 @@ class SOKKIABook(HasTraits):
                 'Instr Hgt',
                 'Targ Hgt']
         rows = [cols]
-        for record in self.record_list:
-            if record.record_type == "STN":
-                at = record.code
-                instrument_height = record.theodolite_height
-            elif record.record_type == "TARGET":
-                target_height = record.target_height
-            elif record.record_type == "OBS":
-                row = ['$HOR_COMPACT']
-                row.append(at)
-                row.append(record.code)
-                row.append(bs_station)
-                if hor_offset == 0:
-                    hor = record.north_horizontal
-                else:
-                    hor = record.north_horizontal.decimal_degrees + hor_offset
-                    if hor >= 360:
-                        hor -= 360
-                    hor = dd2dms(hor)
-                row.append('%.3i%.2i%07.4f' % (hor.degrees,
-                                               hor.minutes,
-                                               hor.seconds))
-                row.append('%g' % self.tps_model.horizontal_sd)
-                row.append('%.3i%.2i%07.4f' % (record.east_vertical.degrees,
-                                               record.east_vertical.minutes,
-                                               record.east_vertical.seconds))
-                row.append('%g' % self.tps_model.zenith_sd)
-                row.append(record.elevation_distance)
-                row.append('%g' % self.tps_model.chord_sd)
-                row.append(instrument_height)
-                row.append(target_height)
-                rows.append(row)
+        obs = self.observation_table()
+        obs = obs[obs['record_type'] == 'OBS']
+        hor = obs['north_horizontal'] + hor_offset
+        hor[hor >= 360] -= 360
+        for at, code, h, z, chord, instrument_height, target_height in zip(
+                obs['station'].tolist(), obs['code'].tolist(), format_dms(hor),
+                format_dms(obs['east_vertical']),
+                distance_list(obs['elevation_distance']),
+                obs['theodolite_height'].tolist(),
+                obs['target_height'].tolist()):
+            rows.append(['$HOR_COMPACT',
+                         at,
+                         code,
+                         bs_station,
+                         h,
+                         '%g' % self.tps_model.horizontal_sd,
+                         z,
+                         '%g' % self.tps_model.zenith_sd,
+                         chord,
+                         '%g' % self.tps_model.chord_sd,
+                         instrument_height,
+                         target_height])
         writer = csv.writer(out_file, delimiter=';', lineterminator='\n')
         writer.writerows(rows)
         
@@ -471,32 +646,27 @@ class SOKKIABook(HasTraits):
                 'Targ Hgt',
                 'DirSetNum']
         rows = [cols]
-        for record in self.record_list:
-            if record.record_type == "JOB":
-                job = record.job_id
-            elif record.record_type == "STN":
-                at = record.code
-                instrument_height = record.theodolite_height
-            elif record.record_type == "TARGET":
-                target_height = record.target_height
-            elif record.record_type == "OBS":
-                row = ['$DIR_COMPACT']
-                row.append(at)
-                row.append(record.code)
-                row.append('%.3i%.2i%07.4f' % (record.north_horizontal.degrees,
-                                               record.north_horizontal.minutes,
-                                               record.north_horizontal.seconds))
-                row.append('%g' % self.tps_model.horizontal_sd)
-                row.append('%.3i%.2i%07.4f' % (record.east_vertical.degrees,
-                                               record.east_vertical.minutes,
-                                               record.east_vertical.seconds))
-                row.append('%g' % self.tps_model.zenith_sd)
-                row.append(record.elevation_distance)
-                row.append('%g' % self.tps_model.chord_sd)
-                row.append(instrument_height)
-                row.append(target_height)
-                row.append(job)
-                rows.append(row)
+        obs = self.observation_table()
+        obs = obs[obs['record_type'] == 'OBS']
+        for at, code, h, z, chord, instrument_height, target_height, job in zip(
+                obs['station'].tolist(), obs['code'].tolist(),
+                format_dms(obs['north_horizontal']),
+                format_dms(obs['east_vertical']),
+                distance_list(obs['elevation_distance']),
+                obs['theodolite_height'].tolist(),
+                obs['target_height'].tolist(), obs['job_id'].tolist()):
+            rows.append(['$DIR_COMPACT',
+                         at,
+                         code,
+                         h,
+                         '%g' % self.tps_model.horizontal_sd,
+                         z,
+                         '%g' % self.tps_model.zenith_sd,
+                         chord,
+                         '%g' % self.tps_model.chord_sd,
+                         instrument_height,
+                         target_height,
+                         job])
         writer = csv.writer(out_file, delimiter=';', lineterminator='\n')
         writer.writerows(rows)
 
@@ -518,41 +688,27 @@ class SOKKIABook(HasTraits):
                 'Instr Hgt',
                 'Targ Hgt']
         rows = [cols]
-        for record in self.record_list:
-            if record.record_type == "STN":
-                at = record.code
-                instrument_height = record.theodolite_height
-            elif record.record_type == "TARGET":
-                target_height = record.target_height
-            elif record.record_type == "OBS":
-                row = ['$AZ_COMPACT']
-                row.append(at)
-                row.append(record.code)
-                if az_offset == 0:
-                    az = record.north_horizontal
-                else:
-                    az = record.north_horizontal.decimal_degrees + az_offset
-                    if az >= 360:
-                        az -= 360
-                    az = dd2dms(az)
-                if za_offset == 0:
-                    za = record.east_vertical
-                else:
-                    za = record.east_vertical.decimal_degrees + za_offset
-                    za = dd2dms(za)
-                row.append('%.3i%.2i%07.4f' % (az.degrees,
-                                               az.minutes,
-                                               az.seconds))
-                row.append('%g' % self.tps_model.horizontal_sd)
-                row.append('%.3i%.2i%07.4f' % (za.degrees,
-                                               za.minutes,
-                                               za.seconds))
-                row.append('%g' % self.tps_model.zenith_sd)
-                row.append(record.elevation_distance)
-                row.append('%g' % self.tps_model.chord_sd)
-                row.append(instrument_height)
-                row.append(target_height)
-                rows.append(row)
+        obs = self.observation_table()
+        obs = obs[obs['record_type'] == 'OBS']
+        az = obs['north_horizontal'] + az_offset
+        az[az >= 360] -= 360
+        za = obs['east_vertical'] + za_offset
+        for at, code, a, z, chord, instrument_height, target_height in zip(
+                obs['station'].tolist(), obs['code'].tolist(), format_dms(az),
+                format_dms(za), distance_list(obs['elevation_distance']),
+                obs['theodolite_height'].tolist(),
+                obs['target_height'].tolist()):
+            rows.append(['$AZ_COMPACT',
+                         at,
+                         code,
+                         a,
+                         '%g' % self.tps_model.horizontal_sd,
+                         z,
+                         '%g' % self.tps_model.zenith_sd,
+                         chord,
+                         '%g' % self.tps_model.chord_sd,
+                         instrument_height,
+                         target_height])
         writer = csv.writer(out_file, delimiter=';', lineterminator='\n')
         writer.writerows(rows)
                 
@@ -574,88 +730,116 @@ def average_code_obs(in_book,
                   distance_tol=0.01):
     """Average observations with the same code."""
     term = TerminalController()
-                
+    table = in_book.observation_table()
+
+    # Group the records by code, in order of each code's first record.
+    codes, first, group = unique(table['code'], return_index=True,
+                                 return_inverse=True)
+    group = argsort(argsort(first))[group]
+    first = sort(first)
+    averaged = table['record_type'][first] == 'OBS'
+    averaged_groups = flatnonzero(averaged)
+    n_avg = len(averaged_groups)
+
+    # Direct (F1) and reverse (F2) observations of the averaged codes, with
+    # the reverse ones turned to direct, in order of code then record.
+    face = table['dc']
+    reverse = face == 'F2'
+    obs = flatnonzero(averaged[group] & ((face == 'F1') | reverse))
+    obs_group = (averaged.cumsum() - 1)[group[obs]]
+    obs = obs[argsort(obs_group, kind='mergesort')]
+    obs_group = sort(obs_group)
+    h = table['north_horizontal'][obs]
+    h = where(reverse[obs], (h + 180) % 360, h)
+    v = table['east_vertical'][obs]
+    v = where(reverse[obs], 360 - v, v)
+    d = table['elevation_distance'][obs]
+    d = where(isnan(d), 0, d)
+
+    counts = bincount(obs_group, minlength=n_avg)
+    def group_range(values):
+        high = full(n_avg, -inf)
+        low = full(n_avg, inf)
+        maximum.at(high, obs_group, values)
+        minimum.at(low, obs_group, values)
+        return high - low
+    def group_angle(angles):
+        angles = radians(angles)
+        return degrees(arctan2(bincount(obs_group, sin(angles), n_avg),
+                               bincount(obs_group, cos(angles), n_avg))) % 360
+    with errstate(divide='ignore', invalid='ignore'):
+        avg_horizontal = group_angle(h)
+        avg_vertical = group_angle(v)
+        avg_distance = bincount(obs_group, d, n_avg) / counts
+        range_horizontal = group_range(h)
+        range_vertical = group_range(v)
+        range_distance = group_range(d)
+
+    d_tol, m_tol, s_tol = horizontal_tol.split(':')
+    horizontal_tol = AngleDMS(degrees=int(d_tol),
+                              minutes=int(m_tol),
+                              seconds=float(s_tol))
+    d_tol, m_tol, s_tol = vertical_tol.split(':')
+    vertical_tol = AngleDMS(degrees=int(d_tol),
+                            minutes=int(m_tol),
+                            seconds=float(s_tol))
+    with errstate(invalid='ignore'):
+        horizontal_exceeded = minimum(360 - range_horizontal, range_horizontal) \
+                              > horizontal_tol.decimal_degrees
+        vertical_exceeded = range_vertical > vertical_tol.decimal_degrees
+        distance_exceeded = range_distance > distance_tol
+    avg_codes = table['code'][first[averaged_groups]].tolist()
+    for i in flatnonzero(horizontal_exceeded | vertical_exceeded
+                         | distance_exceeded):
+        if horizontal_exceeded[i]:
+            print u'WARNING: Horizontal angle tolerance (%s) exceeded.' \
+                    % horizontal_tol
+            print u'%s HAR difference: %s%s%s\n' % (avg_codes[i],
+                                                    term.RED,
+                                                    dd2dms(range_horizontal[i]),
+                                                    term.NORMAL)
+        if vertical_exceeded[i]:
+            print u'WARNING: Zenith angle tolerance (%s) exceeded.' \
+                    % vertical_tol
+            print u'%s ZA difference: %s%s%s\n' % (avg_codes[i],
+                                                   term.YELLOW,
+                                                   dd2dms(range_vertical[i]),
+                                                   term.NORMAL)
+        if distance_exceeded[i]:
+            print 'WARNING: Slope distance tolerance (%.4f) exceeded.' \
+                   % distance_tol
+            print '%s S difference: %s%.4f%s\n' % (avg_codes[i],
+                                                   term.MAGENTA,
+                                                   range_distance[i],
+                                                   term.NORMAL)
+
+    # Differences between the first two observations of each code.
+    starts = counts.cumsum() - counts
+    pair = counts >= 2
+    differences = full([n_avg, 3], nan)
+    for column, values in enumerate([v, h, d]):
+        differences[pair, column] = values[starts[pair]] \
+                                    - values[starts[pair] + 1]
+    ranges = [row + [code] for row, code in zip(differences.tolist(),
+                                                avg_codes)]
+
+    # One record for each averaged code and every record of the others.
+    keep = ~averaged[group]
+    keep[first[averaged_groups]] = True
+    rows = flatnonzero(keep)
+    rows = rows[lexsort((rows, group[rows]))]
+    out_table = table[rows]
+    is_avg = averaged[group[rows]]
+    out_table['dc'][is_avg] = 'F1'
+    out_table['north_horizontal'][is_avg] = avg_horizontal
+    out_table['east_vertical'][is_avg] = avg_vertical
+    out_table['elevation_distance'][is_avg] = avg_distance
+    fill_context(out_table)
+
     out_book = copy(in_book)
-    out_book.point_count = 0
-    out_book.record_list = []
-    
-    code_dict = {}
-    sorted_codes = []
-    for record in in_book.record_list:
-        if record.code not in sorted_codes:
-            code_dict[record.code] = [record]
-            sorted_codes.append(record.code)
-        else:
-            code_dict[record.code].append(record)
-    ranges = []
-    for code in sorted_codes:
-        code_records = code_dict[code]
-        if code_records[0].record_type == 'OBS':
-            avg_record = SOKKIARecord(record_type = code_records[0].record_type,
-                                      point_id = code_records[0].point_id,
-                                      dc = 'F1',
-                                      code = code)
-            h_angles = []
-            v_angles = []
-            distances = []
-            for record in code_records:
-                if record.dc == 'F1':
-                    h_angles.append(record.north_horizontal)
-                    v_angles.append(record.east_vertical)
-                    distances.append(record.elevation_distance)
-                elif record.dc == 'F2': 
-                    reverse = record.north_horizontal.decimal_degrees + 180
-                    if reverse >= 360:
-                        reverse -= 360
-                    h_angles.append(dd2dms(reverse))
-                    v_angles.append(dd2dms(360 \
-                                           - record.east_vertical.decimal_degrees))
-                    distances.append(record.elevation_distance)
-                
-            avg_record.north_horizontal, range_horizontal = avg_angles(h_angles)
-            avg_record.east_vertical, range_vertical = avg_angles(v_angles)
-            avg_record.elevation_distance = mean(distances)
-            range_distance = ptp(distances)
-            
-            d, m, s = horizontal_tol.split(':')
-            angle_tol = AngleDMS(degrees=int(d),
-                                 minutes=int(m),
-                                 seconds=float(s))
-            if min([360 - range_horizontal.decimal_degrees,
-                   range_horizontal.decimal_degrees]) > angle_tol.decimal_degrees:
-                print u'WARNING: Horizontal angle tolerance (%s) exceeded.' \
-                        % angle_tol
-                print u'%s HAR difference: %s%s%s\n' % (avg_record.code,
-                                                        term.RED,
-                                                        range_horizontal,
-                                                        term.NORMAL)
-            d, m, s = vertical_tol.split(':')
-            angle_tol = AngleDMS(degrees=int(d),
-                                 minutes=int(m),
-                                 seconds=float(s))
-            if range_vertical.decimal_degrees > angle_tol.decimal_degrees:
-                print u'WARNING: Zenith angle tolerance (%s) exceeded.' % angle_tol
-                print u'%s ZA difference: %s%s%s\n' % (avg_record.code,
-                                                       term.YELLOW,
-                                                       range_vertical,
-                                                       term.NORMAL)
-            if range_distance > distance_tol:
-                print 'WARNING: Slope distance tolerance (%.4f) exceeded.' \
-                       % distance_tol
-                print '%s S difference: %s%.4f%s\n' % (avg_record.code,
-                                                       term.MAGENTA,
-                                                       range_distance,
-                                                       term.NORMAL)
-            ranges.append([v_angles[0].decimal_degrees - v_angles[1].decimal_degrees,
-                           h_angles[0].decimal_degrees - h_angles[1].decimal_degrees,
-                           distances[0] - distances[1],
-                           code])
-            out_book.record_list.append(avg_record)
-            out_book.point_count += 1
-        else:
-            for record in code_records:
-                out_book.record_list.append(record)
-                out_book.point_count += 1
+    out_book.point_count = len(out_table)
+    out_book.observations = out_table
+    out_book._record_list = None
     return out_book, ranges
 
 if __name__ == '__main__':
@@ -0,0 +1,260 @@
+#! /usr/bin/python
+"""point_cloud_planes: Strikes and dips of the planar facets in a point cloud.
+
+Reads x, y, z points (east, north, up, e.g. an outcrop lidar scan in the
+comma or space separated format read by xyzs2vtp.py, or a NumPy .npy
+array) a chunk at a time and sums the moments of the points falling in
+each cube of a regular grid. A plane is fit to the points in each cube
+with enough of them by finding the smallest eigenvector of their
+covariance matrix, and the strike and dip of the cubes that are planar
+enough are output (following the RHR, as with stereonet's --invert) so
+they can be piped straight to stereonet. Only the moments of each cube
+are kept, so clouds of any size can be handled.
+
+Provided under an MIT-style license.
+"""
+__license__   = "MIT License <http://http://www.opensource.org/licenses/mit-license.php>"
+
+
+#-------------------------------------------------------------------------
+#--Try to import modules--------------------------------------------------
+#-------------------------------------------------------------------------
+import sys
+from optparse import OptionParser
+import numpy as np
+
+from stereonet import VectorsToPlanes, InputError
+
+
+#----------------------------------------------------------------------------------
+#--Option Handling-----------------------------------------------------------------
+#----------------------------------------------------------------------------------
+
+def main(argv):
+    """Parse arguments and output the planes in the point cloud"""
+    usage = "usage: %prog [infile] [outfile] [-c size] [-m points] [-v variation] [-p planarity] [-a]"
+    description = """Fits planes to the points in each cube of a
+    grid over an x, y, z (east, north, up) point cloud and outputs the
+    strike/dip of each planar patch. Reads stdin and writes stdout if
+    no files are given. Infile may be text (x, y, z and any other columns,
+    separated by commas or whitespace) or a .npy array with x, y, z as
+    its first three columns."""
+    description = description.replace('    ','') #Strip out spaces for better display
+
+    parser = OptionParser(usage=usage, description=description)
+    parser.add_option("-c", "--cell", dest="cell",\
+            help="Width of the cubes (in the units of x, y and z). Default: 1", \
+            action="store", type="float")
+    parser.add_option("-m", "--min-points", dest="minimum",\
+            help="Fewest points in a cube to fit a plane to. Default: 10", \
+            action="store", type="int")
+    parser.add_option("-v", "--max-variation", dest="variation",\
+            help="Largest surface variation (the smallest eigenvalue over their sum, 0 for a perfect plane and 1/3 for a ball of points) of a patch. Default: 0.02", \
+            action="store", type="float")
+    parser.add_option("-p", "--min-planarity", dest="planarity",\
+            help="Smallest planarity ((S2-S3)/S1, near 0 for points along a line) of a patch. Default: 0.2", \
+            action="store", type="float")
+    parser.add_option("-a", "--attributes", dest="attributes",\
+            help="Follow each strike/dip with the x, y, z of the patch's centroid, its number of points and surface variation (tab delimited).", \
+            action="store_true")
+    parser.add_option("--chunk", dest="chunk",\
+            help="Number of points read at a time. Default: 1000000", \
+            action="store", type="int")
+    parser.set_defaults(cell=1.0, minimum=10, variation=0.02, planarity=0.2, attributes=False, chunk=1000000)
+    (options, args) = parser.parse_args(args=argv[1:])
+
+    if options.cell <= 0: parser.error("--cell must be positive")
+    if options.minimum < 3: parser.error("--min-points must be at least 3")
+    if options.chunk < 1: parser.error("--chunk must be at least 1")
+    if len(args) > 2: parser.error("Only one input file and one output file are allowed")
+
+    try:
+        if args: infile = args[0]
+        else:    infile = sys.stdin
+        if len(args) == 2: outfile = file(args[1], 'w')
+        else:              outfile = sys.stdout
+    except IOError, (errno, strerror):
+        sys.exit("Cannot access file!\nI/O error(%s): %s" % (errno, strerror))
+
+    try:
+        moments = VoxelMoments(options.cell)
+        for points in PointChunks(infile, options.chunk): moments.add(points)
+        for data in OutputPlanes(moments, options): outfile.write(data)
+    except InputError, message: sys.exit(message)
+    except IOError: sys.exit('Data could not be written to output!')
+
+
+#---------------------------------------------------------------------------------------
+#--Reading Points-----------------------------------------------------------------------
+#---------------------------------------------------------------------------------------
+
+def PointChunks(infile, size=1000000):
+    """Yields (m,3) arrays of (at most) size x, y, z points read from
+    infile (a filename or an open file). .npy files are memory mapped."""
+    if isinstance(infile, str) and infile.lower().endswith('.npy'):
+        try: points = np.load(infile, mmap_mode='r')
+        except (IOError, ValueError), error: raise InputError("Can't read %s: %s" % (infile, error))
+        if points.ndim != 2 or points.shape[1] < 3:
+            raise InputError('%s must be an (n,3) or wider array of points!' % infile)
+        for start in range(0, len(points), size):
+            yield np.array(points[start:start+size, :3], dtype=float)
+        return
+
+    if isinstance(infile, str):
+        try: infile = open(infile, 'r')
+        except IOError, (errno, strerror): raise InputError("Can't read file!\nI/O error(%s): %s" % (errno, strerror))
+    lines, lineno = [], 0
+    for line in infile:
+        lines.append(line)
+        if len(lines) >= size:
+            yield ParsePoints(lines, lineno)
+            lineno += len(lines)
+            lines = []
+    if lines: yield ParsePoints(lines, lineno)
+
+def ParsePoints(lines, lineno=0):
+    """Returns an (m,3) array of the x, y, z points in a list of lines
+    (skipping comments and blank lines). lineno is the number of lines
+    before these, for error messages."""
+    lines = [line for line in lines if line.strip() and not line.lstrip().startswith('#')]
+    if not lines: return np.empty((0,3))
+    text = ' '.join(lines).replace(',', ' ')
+
+    #--Every line usually has the same columns, so parse them all at once
+    columns = len(lines[0].replace(',', ' ').split())
+    values = np.fromstring(text, sep=' ')
+    if columns >= 3 and len(values) == columns*len(lines) and not np.isnan(values).any():
+        return values.reshape(-1, columns)[:,:3]
+
+    #--Otherwise, one line at a time
+    points = []
+    for n, line in enumerate(lines):
+        try: points.append([float(value) for value in line.replace(',', ' ').split()[:3]])
+        except ValueError: points.append([])
+        if len(points[-1]) != 3:
+            raise InputError('Invalid Input (near line %i): %s\nLines must start with x, y, z!'
+                             % (lineno+n+1, line.strip()))
+    return np.array(points, dtype=float)
+
+
+#---------------------------------------------------------------------------------------
+#--Fitting Planes-----------------------------------------------------------------------
+#---------------------------------------------------------------------------------------
+
+class VoxelMoments(object):
+    """Running number, sum and sum of outer products of the points in
+    each cube of a grid of the given size. Points are taken relative to
+    the corner of their cube so that large coordinates (e.g. UTM) don't
+    lose precision. The sums for each chunk of points are kept until
+    there are about as many as for the whole grid and then combined."""
+    def __init__(self, size=1.0):
+        self.size = float(size)
+        self.origin = None
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.moments = np.zeros((0, 10))
+        self.pending = []
+    def __len__(self):
+        self.compact()
+        return len(self.keys)
+    def add(self, points):
+        points = np.asarray(points, dtype=float).reshape(-1,3)
+        if not len(points): return self
+        cubes = np.floor(points / self.size)
+        if self.origin is None: self.origin = cubes[0].copy()
+        local = points - cubes * self.size
+        cubes = cubes - self.origin
+        if np.abs(cubes).max() >= VoxelOffset:
+            raise InputError('The points span too many cubes, use a larger --cell!')
+        keys = CubeKeys(cubes.astype(np.int64))
+        x, y, z = local.T
+        columns = [np.ones(len(points)), x, y, z, x*x, x*y, x*z, y*y, y*z, z*z]
+        self.pending.append(ReduceMoments(keys, columns))
+        if sum(len(k) for k, m in self.pending) > max(len(self.keys), VoxelCompactSize):
+            self.compact()
+        return self
+    def compact(self):
+        """Combines the pending sums with those of the whole grid"""
+        if not self.pending: return
+        keys = np.concatenate([self.keys] + [k for k, m in self.pending])
+        moments = np.concatenate([self.moments] + [m for k, m in self.pending])
+        self.keys, self.moments = ReduceMoments(keys, moments.T)
+        self.pending = []
+    def planes(self, minimum=10):
+        """Returns arrays of the centroids (m,3), unit normals (m,3),
+        eigenvalues of the covariance matrices (m,3, largest first) and
+        number of points of each cube with at least minimum points."""
+        self.compact()
+        keep = self.moments[:,0] >= minimum
+        keys, moments = self.keys[keep], self.moments[keep]
+        n = moments[:,0:1]
+        mean = moments[:,1:4] / n
+        products = moments[:,[4,5,6,5,7,8,6,8,9]].reshape(-1,3,3) / n[:,:,np.newaxis]
+        covariance = products - mean[:,:,np.newaxis] * mean[:,np.newaxis,:]
+        values, vectors = np.linalg.eigh(covariance) #Smallest first
+        corners = (CubeIndices(keys) + self.origin) * self.size
+        return corners + mean, vectors[:,:,0], np.clip(values[:,::-1], 0, None), n[:,0].astype(int)
+
+def ReduceMoments(keys, columns):
+    """Returns the unique keys and a (k,len(columns)) array of the sum
+    of each column for each key"""
+    unique, inverse = np.unique(keys, return_inverse=True)
+    sums = np.column_stack([np.bincount(inverse, weights=column, minlength=len(unique))
+                            for column in columns])
+    return unique, sums
+
+def CubeKeys(cubes):
+    """Returns an int64 key for each row of an (n,3) array of integer
+    cube indices (each within VoxelOffset of 0)"""
+    cubes = cubes + VoxelOffset
+    return (cubes[:,0] * VoxelWidth + cubes[:,1]) * VoxelWidth + cubes[:,2]
+
+def CubeIndices(keys):
+    """Returns the (n,3) array of cube indices given by CubeKeys"""
+    rest, k = np.divmod(keys, VoxelWidth)
+    i, j = np.divmod(rest, VoxelWidth)
+    return np.column_stack([i, j, k]) - VoxelOffset
+
+#Cube indices are kept within VoxelOffset of the first point's cube
+#   so each fits in 21 bits of a key
+VoxelWidth = 1 << 21
+VoxelOffset = 1 << 20
+#Number of pending cube sums that always triggers VoxelMoments.compact
+VoxelCompactSize = 1 << 20
+
+def NormalsToPlanes(normals):
+    """Returns arrays of the strike and dip (following the RHR) of the
+    planes with the given (m,3) array of east, north, up normals"""
+    #--stereonet's vectors are <down, east, north>
+    east, north, up = normals[:,0], normals[:,1], normals[:,2]
+    return VectorsToPlanes(np.column_stack([-up, east, north]))
+
+def OutputPlanes(moments, options):
+    """Yields the strike/dip of each planar patch (see VoxelMoments)
+    as text, a block of patches at a time."""
+    centers, normals, values, counts = moments.planes(options.minimum)
+    total = values.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variation = values[:,2] / total
+        planarity = (values[:,1] - values[:,2]) / values[:,0]
+    keep = (total > 0) & (variation <= options.variation) & (planarity >= options.planarity)
+    centers, normals, counts, variation = centers[keep], normals[keep], counts[keep], variation[keep]
+    strikes, dips = NormalsToPlanes(normals)
+
+    for start in range(0, len(strikes), OutputBlockSize):
+        block = slice(start, start + OutputBlockSize)
+        if options.attributes:
+            rows = zip(strikes[block].tolist(), dips[block].tolist(), centers[block,0].tolist(),
+                       centers[block,1].tolist(), centers[block,2].tolist(),
+                       counts[block].tolist(), variation[block].tolist())
+            yield ''.join(['%.1f/%.1f\t%.3f\t%.3f\t%.3f\t%i\t%.4f\n' % row for row in rows])
+        else:
+            yield ''.join(['%.1f/%.1f\n' % row for row in zip(strikes[block].tolist(), dips[block].tolist())])
+
+#Number of patches formatted at once
+OutputBlockSize = 10000
+
+
+if __name__ == '__main__':
+    #gracefully exit on ctrl-c
+    try: main(sys.argv)
+    except KeyboardInterrupt: pass
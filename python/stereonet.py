@@ -15,8 +15,11 @@ __author__    = "Joe Kington <jkington@wisc.edu>"
 #-------------------------------------------------------------------------
 #--Try to import modules--------------------------------------------------
 #-------------------------------------------------------------------------
-import sys, copy
-from math import radians,degrees,cos,sin,asin,atan2,atan,sqrt
+import sys, os, re, shlex, signal, struct, zlib, SocketServer
+from copy import copy, deepcopy
+from collections import OrderedDict, deque, namedtuple
+from multiprocessing import Pool
+from math import degrees,sqrt
 try:
     from optparse import OptionParser, OptionGroup
 except ImportError:
@@ -26,6 +29,14 @@ except ImportError:
     You are currently using python ver. %s""" % (sys.argv[0], sys.version)
     message = message.replace('   ','') #For better display
     sys.exit(message)
+try:
+    import numpy as np
+except ImportError:
+    message = """%s requires numpy (http://numpy.scipy.org) for its
+    vectorized rotations.  Please install it and try again.
+    You are currently using python ver. %s""" % (sys.argv[0], sys.version)
+    message = message.replace('   ','') #For better display
+    sys.exit(message)
 
 
 
@@ -36,11 +47,83 @@ except ImportError:
 def main(argv):
     """Parse arguments and execute routine based on them"""
 
+    #---------------------------------------------------------------------
+    #--Parse Options------------------------------------------------------
+    #---------------------------------------------------------------------
+    parser = BuildParser()
+    (options, args) = parser.parse_args(args=argv[1:])
+    CheckOptions(parser, options)
+
+    #--Server mode: handle requests until stdin or the socket is closed
+    if options.serve or options.socket:
+        if args: parser.error("Input and output files can't be used with --serve or --socket")
+        if options.socket: ServeSocket(options.socket, options)
+        else:              ServeStream(sys.stdin, sys.stdout, options)
+        return
+
+    if options.Binary or options.npy or options.Raster or options.Normalize: mode = 'wb'
+    else:                                               mode = 'w'
+    try:
+        #How many files are we working with?
+        if len(args) == 0:   #None, read from stdin, write to stdout
+            infile = sys.stdin
+            outfile = sys.stdout
+        elif len(args) == 1: #One, read from file, write to stdout
+            infile = file(args[0], 'r')
+            outfile = sys.stdout
+        elif len(args) ==2:  #Two, read from first, write to second
+            infile = file(args[0], 'r')
+            outfile = file(args[1], mode)
+
+        #More, raise an options parser error and print message
+        else: parser.error("Only one input file and one output file are allowed")
+
+    except IOError, (errno, strerror):
+        #If opening a file fails...
+        sys.exit("Cannot access file!\nI/O error(%s): %s" % (errno, strerror)) 
+
+    #--Normalized files are rewound to write the number of records
+    if options.Normalize:
+        try: outfile.tell()
+        except IOError: sys.exit("--normalize can't write to a pipe, give an outfile!")
+
+    #-----------------------------------------------------------------------
+    #--Read input file and output properly formatted data-------------------
+    #-----------------------------------------------------------------------
+    #   Lines are handled in blocks so that the rotations for a whole block
+    #   can be done at once with numpy instead of one vertex at a time.
+    records = []
+    try:
+        if options.Normalize: outfile.write(NpyHeader(NormalizedType, 0))
+        for data in Output(infile, options):
+            #--Write to output---------------------------
+            #   (.npy files need the number of records first)
+            if options.npy: records.append(data)
+            elif options.Normalize:
+                outfile.write(data.tostring())
+                records.append(len(data))
+            else:           outfile.write(data)
+
+        if options.Normalize:
+            outfile.seek(0)
+            outfile.write(NpyHeader(NormalizedType, sum(records)))
+
+        if options.npy:
+            if options.Density: columns = 3
+            else:               columns = 2
+            records = np.frombuffer(''.join(records), dtype=BinaryType(options))
+            np.save(outfile, records.reshape(-1, columns))
+
+    except InputError, message: sys.exit(message)
+    except IOError: sys.exit('Data could not be written to output!')
+
+def BuildParser():
+    """Returns the OptionParser for the command line (and server requests)"""
 
     #---------------------------------------------------------------
     #--Set up Options-----------------------------------------------
     #---------------------------------------------------------------
-    usage = "usage: %prog [infile] [outfile] [-p|-P|-L|-R] [-I] [-H] [-C] [-i] [-:]"
+    usage = "usage: %prog [infile] [outfile] [-p|-P|-L|-R] [-I] [-H] [-C] [-d] [-F] [-k] [--fisher] [--test] [--rose] [--beta] [--dedupe] [-b] [--normalize] [--project] [-i|-t] [-:] [-j] [--serve|--socket]"
     description = """Formats structural data for plotting on a 
     stereonet using GMT's psxy. Outputs tab delimited x,y pairs 
     representing a feature based on a strike and dip, plunge and
@@ -83,7 +166,7 @@ def main(argv):
             help="Output rakes along a plane as points given a S/D and rake measurement (e.g 330/42W 22N, 150/42 30, 075/38SE 32SW).", \
             action="store_const", const='Rakes')
     parser.add_option("-H", "--horizontal", dest="Flatten",\
-            help="Rotate all measurements in input so that the specified plane is horizontal. FLATTEN should be in the form of a S/D measurement, e.g. 234/64NW.", \
+            help="Rotate all measurements in input so that the specified plane is horizontal. FLATTEN should be in the form of a S/D measurement, e.g. 234/64NW. For a plunging fold, follow it with '@' and the P/B of the fold axis (e.g. 234/64NW@20/250) to first rotate the axis to horizontal (around the horizontal line perpendicular to it) and then rotate around the axis until the plane (which should contain the axis) is horizontal.", \
             action="store", type="string")
     parser.add_option("-I", "--invert", dest="Invert",\
             help="Convert each long,lat pair in input to a plunge/bearing or the strike/dip of a plane defined as the pole to the long,lat pair. Useful for converting the output an analysis (e.g. 'fitcircle') back to a more readable format.",\
@@ -96,9 +179,140 @@ def main(argv):
             action="store_true")
     parser.add_option("-i", "--increment", dest="inc", \
             help="Increment to insert vertices at along a line representing a plane. Default: 10 degrees", \
+            action="store", type="float")
+    parser.add_option("-t", "--tolerance", dest="tolerance", \
+            help="Instead of a fixed increment, insert just enough vertices along each plane that the straight segments between them are never farther than TOLERANCE from the true line on the net, in units of the radius of the (equal-area, or --project) net. E.g. 0.003 (about 0.65p on a -JA0/0/6i net) gives fewer vertices than the default -i 10 and is never farther off than it.", \
+            action="store", type="float")
+    parser.add_option("--project", dest="Project", \
+            help="Output x,y coordinates on a net with a radius of 1 projected with an equal-area ('schmidt') or equal-angle ('wulff') projection instead of long,lat pairs. The output can be plotted with a linear projection (e.g. psxy -JX6i -R-1/1/-1/1).", \
+            action="store", choices=('schmidt','wulff'))
+    parser.add_option("-j", "--jobs", dest="jobs", \
+            help="Number of processes to use. The input is split into chunks that are handled in parallel and written out in their original order. Default: 1", \
+            action="store", type="int")
+
+    density = OptionGroup(parser, 'Density Contouring', description="Count poles (or lines or rakes with --lines or --rakes) on the lower hemisphere and output long, lat, density for each node of a grid. The output can be gridded with xyz2grd -R-90/90/-90/90 and contoured with grdcontour.")
+    density.add_option("-d", "--density", dest="Density",\
+            help="Counting method: 'kamb' (Kamb, 1959), 'modified-kamb' (exponential smoothing, Vollmer, 1995) or 'schmidt' (1% area counting). Density is given in multiples of the standard deviation expected for uniformly distributed data for the Kamb methods and in percent of the data per 1% area for schmidt.", \
+            action="store", choices=('kamb','modified-kamb','schmidt'))
+    density.add_option("--sigma", dest="sigma",\
+            help="Expected count (in standard deviations) for uniformly distributed data used to choose the counting circle for the Kamb methods. Default: 3", \
+            action="store", type="float")
+    density.add_option("--spacing", dest="spacing",\
+            help="Spacing (in degrees) of the grid nodes. Default: 2", \
+            action="store", type="float")
+    density.add_option("--update", dest="update",\
+            help="Add the counts for input to the density grid saved in UPDATE (a .npz file, created if it doesn't exist) and output the density of everything counted so far. Only 'kamb' and 'schmidt' grids can be updated. A new kamb grid keeps the counting circle chosen for its first measurements (or for --expected), so the density of later updates is in standard deviations for that circle instead.", \
+            action="store", type="string")
+    density.add_option("--expected", dest="expected",\
+            help="Choose the counting circle of a new kamb --update grid for EXPECTED measurements instead of the number in the first input. Grids started with the same --expected and --sigma can be merged, and a grid can be started with no input.", \
+            action="store", type="int")
+    density.add_option("--merge", dest="merge",\
+            help="Add the counts in the density grid MERGE (saved by --update with the same method and spacing and, for kamb, the same counting circle, e.g. started with the same --expected and --sigma) to the grid being updated. May be given more than once.", \
+            action="append", type="string")
+    parser.add_option_group(density)
+
+    analysis = OptionGroup(parser, 'Orientation Analysis')
+    analysis.add_option("-F", "--fit", dest="Fit",\
+            help="Fit the orientation tensor (Scheidegger, 1965) to the poles (or lines or rakes with --lines or --rakes) in input. Outputs the best fit plane (girdle), the fold axis (its pole), the mean orientation, the normalized eigenvalues and Woodcock's (1977) K and C shape parameters.", \
+            action="store_true")
+    parser.add_option_group(analysis)
+
+    clusters = OptionGroup(parser, 'Clustering', description="Separate the poles (or lines or rakes with --lines or --rakes) into sets with spherical k-means, treating them as axes. Outputs each measurement in the same form as --clean (as a P/B for lines and rakes) followed by the number of its set, preceded by a '#' line giving the mean orientation, size and concentration (largest normalized eigenvalue) of each set. Sets are numbered from largest to smallest.")
+    clusters.add_option("-k", "--clusters", dest="Clusters",\
+            help="Number of sets to separate the measurements into.", \
             action="store", type="int")
+    clusters.add_option("--batch", dest="batch",\
+            help="Update the sets with random mini-batches of BATCH measurements instead of all of them in each iteration (much faster for large inputs). Default: 0 (use all)", \
+            action="store", type="int")
+    clusters.add_option("--iterations", dest="iterations",\
+            help="Maximum number of iterations (or mini-batches). Default: 100", \
+            action="store", type="int")
+    clusters.add_option("--seed", dest="seed",\
+            help="Seed for the random starting sets and mini-batches (and --bootstrap resamples). Default: 0", \
+            action="store", type="int")
+    parser.add_option_group(clusters)
+
+    fisher = OptionGroup(parser, 'Fisher Statistics', description="Treat the poles (or lines or rakes with --lines or --rakes) as directions on the lower hemisphere and output their mean, resultant length, Fisher (1953) kappa and alpha95 on lines starting with '#' followed by the alpha95 cone (and the bootstrap cone with --bootstrap) as GMT multisegment polygons (e.g. psxy -m -L).")
+    fisher.add_option("--fisher", dest="Fisher",\
+            help="Output Fisher statistics and confidence cones.", \
+            action="store_true")
+    fisher.add_option("--bootstrap", dest="bootstrap",\
+            help="Also resample the data N times (spread over --jobs processes) and output the cone containing 95% of the resampled means. Default: 0 (don't)", \
+            action="store", type="int")
+    parser.add_option_group(fisher)
+
+    tests = OptionGroup(parser, 'Significance Tests', description="Test whether the poles (or lines or rakes with --lines or --rakes) could have come from a null distribution by comparing their Rayleigh (3nR^2 of the lower hemisphere directions) and Bingham (15n/2 times the sum of the squared differences of the orientation tensor's eigenvalues from 1/3) statistics with those of sets of the same size drawn from it. Sets are drawn in blocks (spread over --jobs processes, with seeds starting at --seed). Each test is output as its name, the statistic and the p-value (the fraction of sets with a statistic at least as large).")
+    tests.add_option("--test", dest="Test",\
+            help="Null distribution: 'uniform' (no preferred orientation) or 'fisher' (the Fisher distribution with the data's principal axis as its mean and the kappa that gives the same largest eigenvalue).", \
+            action="store", choices=('uniform','fisher'))
+    tests.add_option("--precision", dest="precision",\
+            help="Largest standard error of the p-values, which sets the number of sets drawn (1/(4 PRECISION^2)) and the decimals output. Default: 0.01", \
+            action="store", type="float")
+    parser.add_option_group(tests)
+
+    beta = OptionGroup(parser, 'Beta Diagrams', description="Intersect every pair of planes in input and output the lines of intersection (as with --lines) instead of the planes. Combined with -d, -F, --rose or --raster, the intersections are analyzed instead. Pairs of planes are handled in blocks (spread over --jobs processes), so memory use doesn't grow with the number of pairs.")
+    beta.add_option("--beta", dest="Beta",\
+            help="Use the intersections of all pairs of planes.", \
+            action="store_true")
+    parser.add_option_group(beta)
+
+    dedupe = OptionGroup(parser, 'Duplicates', description="Output the lines of input (unchanged) whose orientations aren't within an angle of any earlier line that was output, dropping the rest as duplicates. Planes are compared by their poles, and lines (and rakes) are axes, so 10/45 and 190/-45 are the same.")
+    dedupe.add_option("--dedupe", dest="Dedupe",\
+            help="Drop measurements within ANGLE degrees of an earlier measurement (0 for exact duplicates only).", \
+            action="store", type="float", metavar="ANGLE")
+    parser.add_option_group(dedupe)
+
+    rose = OptionGroup(parser, 'Rose Diagrams', description="Count the strikes of planes (or the trends of poles, lines or rakes with --poles, --lines or --rakes) in sectors and output each sector as a GMT multisegment polygon (e.g. psxy -m -L -JX6i -R-1/1/-1/1). The longest petal has a radius of 1, north is up and each segment header gives the sector and its count.")
+    rose.add_option("--rose", dest="Rose",\
+            help="'bidirectional' (each strike or trend is also counted 180 degrees away, as is usual for strikes) or 'unidirectional'.", \
+            action="store", choices=('bidirectional','unidirectional'))
+    rose.add_option("--sector", dest="sector",\
+            help="Width of the sectors in degrees. Must divide 360 evenly. Default: 10", \
+            action="store", type="float")
+    rose.add_option("--area", dest="area",\
+            help="Make the area, rather than the radius, of each petal proportional to its count (a square root scale).", \
+            action="store_true")
+    parser.add_option_group(rose)
+
+    raster = OptionGroup(parser, 'Raster Output', description="Count the poles (or lines or rakes with --lines or --rakes) falling in each pixel of an equal-area (or --project wulff) net and write the counts as an image or grid instead of text. Only the counts are kept, so any amount of data can be rendered.")
+    raster.add_option("--raster", dest="Raster",\
+            help="Format of the output: 'png' for an image colored by count (transparent outside the net) or 'grid' for a NetCDF grid of the counts (e.g. for grdimage -JX6i, NaN outside the net). Requires an outfile or redirected stdout.", \
+            action="store", choices=('png','grid'))
+    raster.add_option("--pixels", dest="pixels",\
+            help="Width and height of the raster in pixels. Default: 512", \
+            action="store", type="int")
+    raster.add_option("--cmap", dest="cmap",\
+            help="Colors for --raster png: 'viridis', 'hot' or 'gray'. Default: viridis", \
+            action="store", choices=('viridis','hot','gray'))
+    parser.add_option_group(raster)
+
+    binary = OptionGroup(parser, 'Binary Output', description="Write coordinates as packed binary records instead of text. The line representing each plane is preceded by a record of NaNs, which GMT treats as a segment header when reading binary multisegment data (e.g. psxy -bi2 -m).")
+    binary.add_option("-b", "--binary", dest="Binary",\
+            help="Precision of the binary records: 'f' for single (float32, psxy -bis in GMT4 or -bi2f in GMT5) or 'd' for double (float64, psxy -bi or -bi2d).", \
+            action="store", choices=('f','d'))
+    binary.add_option("--npy", dest="npy",\
+            help="Write a NumPy .npy file with one row per record instead. Uses the precision from --binary (double by default).", \
+            action="store_true")
+    parser.add_option_group(binary)
+
+    normalize = OptionGroup(parser, 'Normalized Files', description="Parse the measurements in infile once and save them (strike or bearing, dip or plunge, rake, the plane they're flattened to with -H and the line they came from) as a NumPy .npy file of records. Giving that file as the infile of a later call reads the records straight from the file (without parsing anything) for any other output or analysis. The type of measurement (planes, lines or rakes) is also saved, so -L and -R don't need to be given again.")
+    normalize.add_option("--normalize", dest="Normalize",\
+            help="Write the parsed measurements to outfile (which must be a file, not a pipe).", \
+            action="store_true")
+    parser.add_option_group(normalize)
+
+    server = OptionGroup(parser, 'Server Mode', description="Keep running and answer one request per line instead of reading an infile. A request is the options for a single call, a '|' and the measurements separated by ';' (e.g. 'poles | 052/36SW; 330/42W' or '-I plane | 10 20'). The options may start with the name of an operation (planes, poles, lines, rakes, invert or clean) instead of its flag and default to the options the server was started with. Each response is the usual output followed by an empty line. Invalid measurements are reported on lines starting with '#'.")
+    server.add_option("--serve", dest="serve",\
+            help="Read requests from stdin and write responses to stdout (e.g. as a coprocess of a shell script).", \
+            action="store_true")
+    server.add_option("--socket", dest="socket",\
+            help="Listen for requests on the unix socket SOCKET. Each connection is handled by its own process.", \
+            action="store", type="string")
+    parser.add_option_group(server)
 
-    parser.set_defaults(PlotType="Planes", inc=10, ReverseXY=False)
+    parser.set_defaults(PlotType="Planes", inc=10, ReverseXY=False, jobs=1, sigma=3, spacing=2, npy=False,
+                        pixels=512, cmap='viridis', batch=0, iterations=100, seed=0, bootstrap=0, precision=0.01,
+                        sector=10)
 
     #Bit of a hack to add examples.  Adds an empty option group with them.
     #Need to write a new formatter that leaves in newlines in some cases
@@ -106,64 +320,356 @@ def main(argv):
     #   Or just go back to getopt... Very verbose, either way...
     examples = OptionGroup(parser, 'Examples', description=examples)
     parser.add_option_group(examples)
+    return parser
+
+def CheckOptions(parser, options):
+    """Reports combinations of options that can't be used together
+    through parser.error"""
+    if (options.Binary or options.npy) and (options.Invert or options.Clean or Analysis(options) not in (None, 'Density')):
+        parser.error("Binary output is only available for coordinates and -d")
+    if len([name for name in AnalysisModes if getattr(options, name, None) is not None]) > 1:
+        parser.error("Only one of -d, -F, -k, --fisher, --test, --rose, --raster and --dedupe can be used at a time")
+    if options.Project and (options.Invert or options.Clean or Analysis(options) not in (None, 'Raster')):
+        parser.error("--project is only available for coordinates and --raster")
+    if options.Normalize and (options.Invert or options.Clean or options.Binary or options.npy or options.Beta
+                              or options.Project or Analysis(options)):
+        parser.error("--normalize can't be used with -I, -C, -b, --npy, --beta, --project or an analysis")
+    if options.Dedupe is not None and not 0 <= options.Dedupe < 90:
+        parser.error("--dedupe must be at least 0 and less than 90")
+    if options.Dedupe is not None and (options.Beta or options.Project):
+        parser.error("--dedupe can't be used with --beta or --project")
+    if options.bootstrap < 0: parser.error("--bootstrap can't be negative")
+    if not 0 < options.precision <= 0.5: parser.error("--precision must be between 0 and 0.5")
+    if options.Beta and (options.PlotType not in ('Planes', 'Poles') or options.Invert or options.Clean):
+        parser.error("--beta needs planes and can't be used with -L, -R, -I or -C")
+    if (options.update or options.merge) and (options.Density not in ('kamb', 'schmidt') or options.Beta):
+        parser.error("--update and --merge need -d kamb or -d schmidt and can't be used with --beta")
+    if options.merge and not options.update:
+        parser.error("--merge needs a grid to --update")
+    if options.expected is not None and (not options.update or options.Density != 'kamb'):
+        parser.error("--expected needs a -d kamb grid to --update")
+    if options.expected is not None and options.expected < 1:
+        parser.error("--expected must be at least 1")
+    if options.Beta and Analysis(options) in ('Clusters', 'Fisher'):
+        parser.error("--beta can't be used with -k or --fisher")
+    if options.Rose and not (0 < options.sector <= 360 and abs(360.0/options.sector - round(360.0/options.sector)) < 1e-9):
+        parser.error("--sector must divide 360 evenly")
+    if options.Raster and (options.Binary or options.npy or options.Invert or options.Clean):
+        parser.error("--raster can't be used with -b, --npy, -I or -C")
+    if options.Raster and options.pixels < 1:
+        parser.error("--pixels must be at least 1")
+    if options.inc <= 0: parser.error("--increment must be positive")
+    if options.tolerance is not None and options.tolerance <= 0:
+        parser.error("--tolerance must be positive")
+    if options.Clusters is not None and options.Clusters < 1:
+        parser.error("--clusters must be at least 1")
+
+#Number of input lines handled at once by main
+BlockSize = 10000
+#Approximate size (in bytes) of the chunks of a file handed to each process with --jobs
+ChunkBytes = 1 << 22
 
+#---------------------------------------------------------------------------------------    
+#--Reading input in blocks--------------------------------------------------------------
+#---------------------------------------------------------------------------------------    
 
-    #---------------------------------------------------------------------
-    #--Parse Options------------------------------------------------------
-    #---------------------------------------------------------------------
-    (options, args) = parser.parse_args(args=argv[1:])
-    try:
-        #How many files are we working with?
-        if len(args) == 0:   #None, read from stdin, write to stdout
-            infile = sys.stdin
-            outfile = sys.stdout
-        elif len(args) == 1: #One, read from file, write to stdout
-            infile = file(args[0], 'r')
-            outfile = sys.stdout
-        elif len(args) ==2:  #Two, read from first, write to second
-            infile = file(args[0], 'r')
-            outfile = file(args[1], 'w')
+def Output(infile, options):
+    """Yields the output for infile one block at a time, reporting (and
+    skipping) lines that can't be parsed. Analyses (e.g. --density) 
+    combine the results from every block and yield their output once 
+    all of infile has been read."""
+    lineno, summary = 0, None
+    analysis = Analysis(options) or options.Beta
+    for data, errors, nlines in ProcessInput(infile, options):
+        #--If the data wasn't properly formatted, print error and continue
+        for n, line, message in errors:
+            print >>sys.stderr, 'Invalid Input (line %i): %s\n' % (lineno+n, line), message, '\nSkipping this line...'
+        if options.Normalize: data['line'] += lineno
+        lineno += nlines
+
+        if not analysis:      yield data
+        elif summary is None: summary = data
+        else:                 summary += data
+
+    if options.Beta:
+        if summary is None: raise InputError('No valid measurements to intersect!')
+        for data in OutputBeta(np.concatenate(summary), options): yield data
+    elif analysis: yield OutputAnalysis(summary, options)
+
+
+def ProcessInput(infile, options):
+    """Yields the formatted output, the list of errors and the number of
+    lines read for each block of infile, in order. If options.jobs is
+    greater than one, the blocks are handled by a pool of processes.
+    Normalized files (see --normalize) are read in blocks of records."""
+    if IsNormalized(infile):
+        tasks = ((infile.name, start, end, options) for start, end in RecordRanges(infile.name))
+        function = ProcessRecordRange
+    elif options.jobs <= 1:
+        for lines in LineBlocks(infile):
+            yield ProcessLineBlock((lines, options))
+        return
+
+    #--Files are split into byte ranges that each process reads itself
+    #   while anything else (e.g. stdin) is sent to them in blocks of lines
+    elif infile is sys.stdin or not hasattr(infile, 'name'):
+        tasks = ((lines, options) for lines in LineBlocks(infile))
+        function = ProcessLineBlock
+    else:
+        tasks = ((infile.name, start, end, options) for start, end in ByteRanges(infile.name))
+        function = ProcessByteRange
 
-        #More, raise an options parser error and print message
-        else: parser.error("Only one input file and one output file are allowed")
+    for result in MapInOrder(function, tasks, options.jobs): yield result
 
-    except IOError, (errno, strerror):
-        #If opening a file fails...
-        sys.exit("Cannot access file!\nI/O error(%s): %s" % (errno, strerror)) 
+def MapInOrder(function, tasks, jobs=1):
+    """Yields function(task) for each task, in order, using a pool of
+    jobs processes if jobs is greater than one."""
+    if jobs <= 1:
+        for task in tasks: yield function(task)
+        return
 
-    #-----------------------------------------------------------------------
-    #--Read input file and output properly formatted data-------------------
-    #-----------------------------------------------------------------------
+    #--Only keep a few blocks in flight so memory use stays bounded
+    #   regardless of the size of the input. Results come back in order.
+    pool = Pool(jobs)
+    try:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(function, (task,)))
+            if len(pending) >= 2*jobs: yield pending.popleft().get()
+        while pending: yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+
+def LineBlocks(infile, size=None):
+    """Yields lists of (at most) size lines read from infile."""
+    size = size or BlockSize
+    block = []
     for line in infile:
-        line = line.strip()
+        block.append(line)
+        if len(block) >= size:
+            yield block
+            block = []
+    if block: yield block
+
+def ByteRanges(filename, size=None):
+    """Yields (start, end) byte offsets splitting a file into chunks
+    of roughly size bytes.  Each chunk ends on a line boundary."""
+    size = size or ChunkBytes
+    total = os.path.getsize(filename)
+    f = open(filename, 'rb')
+    start = 0
+    while start < total:
+        f.seek(start + size)
+        f.readline() #Move to the end of the current line
+        end = min(f.tell(), total)
+        yield start, end
+        start = end
+    f.close()
+
+def ProcessLineBlock(task):
+    """Formats a (lines, options) block. Returns the output, the
+    errors with line numbers relative to the start of the block,
+    and the number of lines in the block."""
+    lines, options = task
+    data, errors = ProcessLines(lines, options)
+    return data, errors, len(lines)
+
+def ProcessByteRange(task):
+    """Reads the lines between the start and end offsets of a file
+    and formats them. Returns the same thing as ProcessLineBlock."""
+    filename, start, end, options = task
+    f = open(filename, 'rb')
+    f.seek(start)
+    lines = f.read(end-start).split('\n')
+    f.close()
+    if lines and not lines[-1]: lines.pop() #Trailing newline
+    return ProcessLineBlock((lines, options))
+
+def ProcessRecordRange(task):
+    """Reads the records between the start and end indices of a 
+    normalized file and formats them. Returns the same thing as
+    ProcessLineBlock (with the number of records instead of lines)."""
+    filename, start, end, options = task
+    records = LoadNormalized(filename)[start:end]
+    return ProcessRecords(records, options), [], end-start
 
-        #--Skip Comments and Blank Lines-------------
-        if line.startswith('#') or len(line)==0: continue
-
-        try:
-            #--Which function are we preforming?---------
-            if options.Invert:    data = InvertGeographic(line,options) #Invert long,lat to a S/D or P/B
-            elif options.Clean:   data = CleanInput(line,options)       #Output data in azimuths following the RHR     
-            else:                 data = OutputXY(line,options)         #Output long,lat pairs corresponding to measurements
-
-            #--Write to output---------------------------
-            try: outfile.write(data)
-            except: sys.exit('Data could not be written to output!')
-
-        #--If the data wasn't properly formatted, print error and continue
-        except InputError, message:
-            print >>sys.stderr, 'Invalid Input: %s\n' % line, message, '\nSkipping this line...'
 
+#---------------------------------------------------------------------------------------    
+#--Server Mode--------------------------------------------------------------------------
+#---------------------------------------------------------------------------------------    
+#   Avoids starting python (and parsing options) for every feature when
+#   stereonet is called many times from a script.
+
+#Names that can be used for an operation at the start of a request
+Operations = {'planes':'--planes', 'poles':'--poles', 'lines':'--lines', 'rakes':'--rakes',
+              'invert':'--invert', 'clean':'--clean'}
+#Number of distinct request options kept parsed
+RequestCacheSize = 1000
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    """Answers the requests sent over a connection to ServeSocket"""
+    def handle(self):
+        ServeStream(self.rfile, self.wfile, self.server.defaults)
+
+class ForkingUnixServer(SocketServer.ForkingMixIn, SocketServer.UnixStreamServer):
+    """Unix socket server handling each connection in a new process
+    (so that the caches aren't shared between threads)"""
+
+def ServeSocket(path, defaults=None):
+    """Answers requests sent to the unix socket at path until interrupted."""
+    if os.path.exists(path): os.remove(path) #Left over from a previous server
+    server = ForkingUnixServer(path, RequestHandler)
+    server.defaults = defaults
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit()) #Still clean up when killed
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path): os.remove(path)
+
+def ServeStream(infile, outfile, defaults=None):
+    """Answers each request (line) read from infile on outfile until
+    infile is closed.  Options missing from a request are taken from
+    defaults (the options the server was started with), if given."""
+    parser = BuildParser()
+    parser.error = RaiseInputError #Bad requests shouldn't stop the server
+    cache = LRUCache(RequestCacheSize)
+
+    #--readline instead of iterating over infile, as that reads ahead and
+    #   would wait for more requests before answering this one
+    for request in iter(infile.readline, ''):
+        if not request.strip(): continue
+        try: response = Respond(request, parser, cache, defaults)
+        except Exception, message: #One bad request shouldn't stop the server
+            response = '# Error: %s\n\n' % message
+        outfile.write(response)
+        outfile.flush()
+
+def Respond(request, parser, cache, defaults=None):
+    """Returns the response to a single request (see ServeStream)."""
+    args, sep, lines = request.partition('|')
+    if not sep: args, lines = '', args
+    try:
+        options = RequestOptions(args.strip(), parser, cache, defaults)
+        data, errors = ProcessLines(lines.split(';'), options)
+        if options.Beta:
+            poles = np.concatenate(data)
+            if not len(poles): raise InputError('No valid measurements to intersect!')
+            data = ''.join(OutputBeta(poles, options))
+        elif Analysis(options): data = OutputAnalysis(data, options)
+    except InputError, message:
+        return '# %s\n\n' % message
+    for n, line, message in errors:
+        data += '# Invalid Input: %s: %s\n' % (line, message)
+    return data + '\n'
+
+def RequestOptions(request, parser, cache, defaults=None):
+    """Parses the options of a request. Parsed options are cached, 
+    as most requests repeat the same few."""
+    options = cache.get(request)
+    if options is not None: return options
+
+    try: args = shlex.split(request)
+    except ValueError, message: raise InputError('Invalid request: %s' % message)
+    if args and args[0].lower() in Operations: args[0] = Operations[args[0].lower()]
+    if defaults is not None: defaults = deepcopy(defaults) #Appended options (e.g. --merge) mustn't change them
+    options, extra = parser.parse_args(args=args, values=defaults)
+    if extra: raise InputError('Unexpected arguments in request: %s' % ' '.join(extra))
+    options.serve, options.socket, options.jobs = None, None, 1 #Not for the server's own options
+    if options.Binary or options.npy or options.Raster or options.Normalize:
+        raise InputError('Binary, raster and normalized output are not available in requests')
+    CheckOptions(parser, options)
+    cache[request] = options
+    return options
+
+def RaiseInputError(message):
+    """Replaces OptionParser.error, which exits"""
+    raise InputError(message)
 
 
 #---------------------------------------------------------------------------------------    
 #--Decide what to do--------------------------------------------------------------------
 #---------------------------------------------------------------------------------------    
 
+def ProcessLines(lines, options):
+    """Formats a block of input lines.  Returns the output for the block
+    as a string and a list of (line number, line, InputError) tuples for
+    the lines that couldn't be parsed. Line numbers start at 1 for the
+    first line of the block."""
+    data, errors, measurements, numbers = [], [], [], []
+    for n, line in enumerate(lines):
+        line = line.strip()
+
+        #--Skip Comments and Blank Lines-------------
+        if line.startswith('#') or len(line)==0: continue
+
+        #--Which function are we preforming?---------
+        if options.Clean:
+            try: data.append(CleanInput(line,options)) #Output data in azimuths following the RHR
+            except InputError, message:
+                errors.append((n+1, line, message))
+        else:
+            #Output long,lat pairs corresponding to measurements
+            #   (or invert long,lat pairs to a S/D or P/B)
+            #   These are collected and converted all at once
+            measurements.append(line)
+            numbers.append(n+1)
+
+    #--Analyses return a summary of the block instead of text--
+    if options.Clean:
+        results = []
+    elif options.Invert:
+        results = InvertGeographicBatch(measurements, options)
+    elif options.Normalize:
+        results, m = ParseBatch(measurements, options.PlotType.capitalize(), options.Flatten)
+        records = NormalizedRecords(m, options.PlotType, np.take(numbers, m.rows),
+                                    [SplitFlatten(measurements[i])[0] for i in m.rows])
+    elif Analysis(options) or options.Beta:
+        results, vectors = PointVectors(measurements, options)
+        if options.Beta: data = [vectors] #Intersected once every block is read
+        elif options.Dedupe is not None: #Compared once every block is read
+            data = [([line for line, result in zip(measurements, results) if result is None], vectors)]
+        else:            data = AnalyzeBlock(vectors, options)
+    else:
+        results = OutputXYBatch(measurements, options)
+
+    for n, line, result in zip(numbers, measurements, results):
+        if isinstance(result, InputError): errors.append((n, line, result))
+        elif result is not None:           data.append(result)
+
+    if Analysis(options) or options.Beta: return data, errors
+    if options.Normalize: return records, errors
+    return ''.join(data), errors
+
+def ProcessRecords(records, options):
+    """Formats (or summarizes, see ProcessLines) a block of records 
+    from a normalized file. Records are always valid, so there's no
+    list of errors to return."""
+    options = RecordOptions(records, options)
+    m = RecordMeasurements(records, options)
+    if options.Clean: return ''.join(line + '\n' for line in RecordLines(records))
+    elif options.Invert: raise InputError("Normalized files hold measurements, not longs and lats to invert!")
+    elif Analysis(options) or options.Beta:
+        vectors = MeasurementPoints(m, options)
+        if options.Beta: return [vectors]
+        elif options.Dedupe is not None: return [(RecordLines(records), vectors)]
+        else: return AnalyzeBlock(vectors, options)
+    return ''.join(FormatMeasurements([None]*len(records), m, options))
+
 def OutputXY(input,options):
     """Calculates the strike and dip based on the input 
     string and returns x,y pairs for plotting in a 
     stereographic projection"""
+    result = OutputXYBatch([input], options)[0]
+    if isinstance(result, InputError): raise result
+    return result
+
+def OutputXYBatch(inputs,options):
+    """Vectorized version of OutputXY. Takes a list of input
+    strings and returns a list containing either the x,y pairs
+    for each measurement or the InputError raised while parsing
+    it. All measurements are rotated at once."""
 
     #--Basic Concepts-----------------------------------
     """A stereonet in <long,lat> coordinates:
@@ -186,109 +692,518 @@ def OutputXY(input,options):
        otherwise necessary!)"""
     #---------------------------------------------------
 
+    results, m = ParseBatch(inputs, options.PlotType.capitalize(), options.Flatten)
+    return FormatMeasurements(results, m, options)
+
+def FormatMeasurements(results, m, options):
+    """Fills in results (see OutputXYBatch) with the x,y pairs for
+    each of the parsed Measurements m and returns it."""
     #--Options------------------------------------------
     PlotType = options.PlotType.capitalize()
     inc = options.inc
-    Flatten = options.Flatten
 
-    #--Is data going to be "flattened"?-----------------
-    #   This checks for the line-by-line case denoted
-    #   by an H in the infile, e.g. 340/20 H 035/76
-    if 'H' in input.upper():
-        portions = [item.strip() for item in input.upper().split('H')]
-        if len(portions) == 2:  input,Flatten = portions
-        else: raise InputError("Too many H's!")
-        
+    if not m.rows: return results
+    flattened = ~np.isnan(m.flats[:,0])
+
     #---------------------------------------------------
-    #--Make Data with strike=North----------------------
+    #--Make Data with strike=North and rotate-----------
     #---------------------------------------------------
-    header = ''
+    #If data needs to be 'unfolded', rotate the pole, instead of the plane
+    #  This prevents problems with length changes if x,y coordinates from
+    #  a plane are rotated instead of a point.
+    if PlotType == 'Planes': groups = [(~flattened, 'Planes'), (flattened, 'Poles')]
+    else:                    groups = [(np.ones(len(m.rows), dtype=bool), PlotType)]
+
+    for select, template in groups:
+        if not select.any(): continue
+        index = np.flatnonzero(select)
+        headers = [m.headers[k] for k in index]
+        if template == 'Planes':
+            #Most planes have been drawn before, so look them up
+            X,Y = GreatCircles(m.strikes[index], m.dips[index], inc, options.Project, options.tolerance)
+        else:
+            xyz = MeasurementVectors(template, m.strikes[index], m.dips[index],
+                                     m.rakes[index], m.flats[index], inc)
+            if PlotType == 'Planes':
+                #A pole to a plane was rotated, go back and create the
+                #plane perpendicular to it (annotated with its new S/D)
+                strikes, dips = VectorsToPlanes(xyz[:,0,:])
+                headers = ['> %.2f/%.2f\n' % sd for sd in zip(strikes.tolist(), dips.tolist())]
+                X,Y = GreatCircles(strikes, dips, inc, options.Project, options.tolerance)
+            elif options.Project:
+                #Go straight from the vectors to the projected net
+                X,Y = ProjectVectors(xyz, options.Project)
+            else:
+                X,Y = cart2sph(xyz[...,0], xyz[...,1], xyz[...,2])
+
+        #--Return as strings-----------------------------
+        if options.Binary or options.npy: rows = PackXYBatch(headers, X, Y, options)
+        else:                             rows = FormatXYBatch(headers, X, Y, options.ReverseXY, options.Project)
+        for k, row in zip(index, rows): results[m.rows[k]] = row
+
+    return results
+
+def ParseBatch(inputs, PlotType, Flatten=None):
+    """Parses a list of measurements with ParseXY. Returns a list
+    holding the InputError raised by each input that couldn't be
+    parsed (None for the rest) and a Measurements tuple of arrays
+    for the inputs that were parsed. Measurements that aren't being
+    "flattened" have a NaN horizontal strike and dip in flats (and
+    those without a fold axis a NaN plunge and bearing, see ParseFlatten)."""
+    results = [None]*len(inputs)
+    rows, headers, strikes, dips, rakes, flats = [], [], [], [], [], []
+    for i, input in enumerate(inputs):
+        try: header,strike,dip,rake,horizontal = ParseXY(input, PlotType, Flatten)
+        except InputError, error:
+            results[i] = error
+            continue
+        rows.append(i)
+        headers.append(header)
+        strikes.append(strike)
+        dips.append(dip)
+        rakes.append(rake)
+        flats.append(horizontal or (np.nan,)*4)
+
+    m = Measurements(rows, headers, np.array(strikes, dtype=float),
+                     np.array(dips, dtype=float), np.array(rakes, dtype=float),
+                     np.array(flats, dtype=float).reshape(-1,4))
+    return results, m
+
+#Parsed measurements (see ParseBatch)
+Measurements = namedtuple('Measurements', 'rows headers strikes dips rakes flats')
+
+def MeasurementVectors(template, strikes, dips, rakes, flats, inc=10):
+    """Returns an array of unit vectors with shape (n, vertices, 3) 
+    for n measurements drawn using template ('Planes', 'Poles', 
+    'Lines', or 'Rakes'), rotated to their strike and "flattened"
+    if they have a horizontal strike and dip (and fold axis) in flats."""
+    x,y = TemplateXY(template, dips, rakes, inc)
+    xyz = np.dstack(sph2cart(x,y))
+
+    #--Rotate Data to proper strike----------------------
+    R = RotationMatrices(strikes)
+
+    #--Do we need to "Flatten" the data?-----------------
+    #   i.e. Rotate to horizontal based on another plane.
+    #   Measurements are grouped by the plane they're flattened
+    #   to (e.g. bedding in a structural domain) and one matrix
+    #   is built for each group.
+    flat = ~np.isnan(flats[:,0])
+    if flat.any():
+        beds, group = UniqueRows(flats[flat])
+        R[flat] = np.matmul(FlattenMatrices(*beds.T)[group], R[flat])
+
+    return RotateVectors(xyz, R)
+
+def UniqueRows(array):
+    """Returns the unique rows of a 2D array and the index of the 
+    unique row matching each row of the array."""
+    array = np.ascontiguousarray(array)
+    rows = array.view(np.dtype((np.void, array.dtype.itemsize * array.shape[1])))
+    unique, first, inverse = np.unique(rows.ravel(), return_index=True, return_inverse=True)
+    return array[first], inverse
+
+def GreatCircles(strikes, dips, inc=10, projection=None, tolerance=None):
+    """Returns arrays of long, lat vertices (one row per plane) for 
+    the planes with the given strikes and dips, with points in the 
+    upper hemisphere replaced by the opposite end of the line. Planes 
+    are kept in GreatCircleCache keyed by their strike and dip rounded 
+    to GreatCircleResolution degrees and only the planes that aren't 
+    there already are rotated. If a projection is given (see
+    ProjectVectors), returns projected x, y vertices instead. If a 
+    tolerance is given, vertices are placed by AdaptiveGreatCircles
+    and lists of rows (of different lengths) are returned."""
+    keys = zip(np.round(np.asarray(strikes) / GreatCircleResolution).astype(int).tolist(),
+               np.round(np.asarray(dips) / GreatCircleResolution).astype(int).tolist())
+
+    #--Look up each plane, noting the ones we don't have yet
+    found, missing = {}, []
+    for key in keys:
+        if key in found: continue
+        vertices = GreatCircleCache.get(key + (inc, projection, tolerance))
+        if vertices is None: missing.append(key)
+        else:                found[key] = vertices
+
+    #--Rotate all of the missing planes at once--------
+    if missing:
+        quantized = np.array(missing, dtype=float) * GreatCircleResolution
+        count = len(missing)
+        if tolerance:
+            circles = AdaptiveGreatCircles(quantized[:,0], quantized[:,1], tolerance, projection)
+        else:
+            xyz = MeasurementVectors('Planes', quantized[:,0], quantized[:,1],
+                                     np.zeros(count), np.nan*np.ones((count,2)), inc)
+            if projection: X,Y = ProjectVectors(xyz, projection)
+            else:          X,Y = FoldHemisphere(*cart2sph(xyz[...,0], xyz[...,1], xyz[...,2]))
+            circles = [np.vstack((lon, lat)) for lon, lat in zip(X, Y)]
+        for key, vertices in zip(missing, circles):
+            vertices.flags.writeable = False #Shared by everything using the cache
+            GreatCircleCache[key + (inc, projection, tolerance)] = found[key] = vertices
+
+    if tolerance:
+        return [found[key][0] for key in keys], [found[key][1] for key in keys]
+    vertices = np.array([found[key] for key in keys])
+    return vertices[:,0,:], vertices[:,1,:]
+
+def AdaptiveGreatCircles(strikes, dips, tolerance, projection=None):
+    """Returns a list of (2,m) arrays of the vertices of the planes
+    with the given strikes and dips. Segments are split until the middle
+    of each segment is within tolerance (in units of the net radius) of
+    the middle of the great circle it stands in for, measured on a net
+    with the given projection (equal-area by default, like -JA). As that
+    error shrinks with the square of a segment's length, each segment
+    that is too far off is split into as many equal pieces as should
+    bring it within tolerance. Vertices are long, lat pairs or projected
+    x, y if a projection is given. All segments of all planes are split
+    at once."""
+    strikes = np.asarray(strikes, dtype=float)
+    dips = np.asarray(dips, dtype=float)
+    count = len(strikes)
+    R = RotationMatrices(strikes)
+    net = projection or 'schmidt'
+    #--If strike=north, planes are lines of constant longitude, so each
+    #  vertex is cos(lat)*U + sin(lat)*W for the rotated vectors at lat=0
+    #  and lat=90 of its plane
+    U = RotateVectors(np.column_stack(sph2cart(90 - dips, np.zeros(count))), R)
+    W = RotateVectors(np.column_stack(sph2cart(90 - dips, 90*np.ones(count))), R)
+    def rotate(planes, lats):
+        lats = np.radians(lats)[:,np.newaxis]
+        xyz = np.cos(lats) * U[planes] + np.sin(lats) * W[planes]
+        #The ends are horizontal. Don't let rounding flip them to the other side of the net.
+        xyz[:,0] = np.maximum(xyz[:,0], 0)
+        return xyz
+    def project(planes, lats):
+        return np.column_stack(ProjectVectors(rotate(planes, lats), net))
+
+    #--Start with a few segments per plane, each keeping--
+    #  the projected points at its ends (P0 and P1)
+    starts = np.arange(-90, 90+AdaptiveStart, AdaptiveStart, dtype=float)
+    ends = project(np.repeat(np.arange(count), len(starts)), np.tile(starts, count))
+    ends = ends.reshape(count, len(starts), 2)
+    P0, P1 = ends[:,:-1].reshape(-1, 2), ends[:,1:].reshape(-1, 2)
+    planes = np.repeat(np.arange(count), len(starts)-1)
+    lat0 = np.tile(starts[:-1], count)
+    lat1 = lat0 + AdaptiveStart
+    keptPlanes, keptLats = [np.arange(count)], [90*np.ones(count)] #Ends of the planes
+    for level in range(AdaptiveLevels):
+        error = np.sqrt(((project(planes, (lat0 + lat1) / 2) - (P0 + P1) / 2)**2).sum(axis=1))
+        if level == AdaptiveLevels-1: error[:] = 0 #Can't split any more
+        good = error <= tolerance
+        keptPlanes.append(planes[good])
+        keptLats.append(lat0[good])
+
+        #--Split the rest into equal pieces--------------
+        bad = ~good
+        if not bad.any(): break
+        pieces = np.clip(np.ceil(np.sqrt(error[bad] / tolerance)), 2, AdaptivePieces).astype(int)
+        segment = np.repeat(np.arange(len(pieces)), pieces)
+        piece = np.arange(len(segment)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        width = ((lat1[bad] - lat0[bad]) / pieces)[segment]
+        planes = planes[bad][segment]
+        lat0 = lat0[bad][segment] + piece * width
+        lat1 = lat0 + width
+
+        #--Only the points between new pieces need projecting
+        first, last = P0[bad], P1[bad]
+        inner = piece > 0 #Pieces starting inside their segment
+        follows = np.append(inner[1:], False) #Pieces ending inside it
+        P0 = np.empty((len(segment), 2))
+        P0[~inner] = first
+        P0[inner] = project(planes[inner], lat0[inner])
+        P1 = np.empty_like(P0)
+        P1[~follows] = last
+        P1[follows] = P0[1:][inner[1:]]
+
+    #--Put each plane's vertices in order---------------
+    planes, lats = np.concatenate(keptPlanes), np.concatenate(keptLats)
+    order = np.lexsort((lats, planes))
+    planes, lats = planes[order], lats[order]
+    xyz = rotate(planes, lats)
+    if projection: X,Y = ProjectVectors(xyz, projection)
+    else:          X,Y = FoldHemisphere(*cart2sph(xyz[:,0], xyz[:,1], xyz[:,2]))
+    splits = np.cumsum(np.bincount(planes, minlength=count))[:-1]
+    return np.split(np.vstack((X, Y)), splits, axis=1)
+
+#Length (in degrees) of the first segments of AdaptiveGreatCircles 
+AdaptiveStart = 45
+#Maximum number of times AdaptiveGreatCircles splits a segment
+AdaptiveLevels = 16
+#Most pieces AdaptiveGreatCircles splits a segment into at once
+AdaptivePieces = 64
+
+#Great circles are cached by strike and dip rounded to this many degrees
+GreatCircleResolution = 1e-3
+#Maximum number of great circles kept in GreatCircleCache (see LRUCache)
+GreatCircleCacheSize = 50000
+
+def FlattenMatrices(horizStrikes, horizDips, plunges=None, bearings=None):
+    """Returns rotation matrices that rotate each plane given by
+    horizStrikes and horizDips to horizontal, leaving its strike
+    in place, or, where a fold axis is given by plunges and bearings 
+    (not NaN), see UnfoldQuaternions."""
+    #Rotate to horizStrike=north and make horizDip horizontal,
+    #then unrotate back to the original strike
+    R = np.matmul(RotationMatrices(horizStrikes),
+                  RotationMatrices(-horizStrikes, -horizDips))
+    if plunges is not None:
+        axis = ~np.isnan(plunges)
+        if axis.any():
+            R[axis] = QuaternionMatrices(UnfoldQuaternions(horizStrikes[axis], horizDips[axis],
+                                                           plunges[axis], bearings[axis]))
+    return R
+
+def UnfoldQuaternions(strikes, dips, plunges, bearings):
+    """Returns quaternions that rotate each fold axis given by plunges
+    and bearings to horizontal (around the horizontal line perpendicular
+    to it) and then around the axis until the plane given by strikes
+    and dips (or the plane through the axis closest to it) is horizontal."""
+    strikes, dips, plunges, bearings = [np.asarray(value, dtype=float) 
+                                        for value in (strikes, dips, plunges, bearings)]
+    first = AxisQuaternions(0, bearings + 90, plunges)
+
+    #--Clockwise angle (looking down the now horizontal axis) of the
+    #   rotated pole from up, then the smallest turn to up or down
+    poles = RotateVectors(LineVectors(90 - dips, strikes - 90), QuaternionMatrices(first))
+    right = LineVectors(0, bearings + 90)
+    angles = np.degrees(np.arctan2((poles*right).sum(axis=-1), -poles[:,0]))
+    turn = np.mod(180 - angles + 90, 180) - 90
+    return ComposeRotations(first, AxisQuaternions(0, bearings, turn))
+
+def ParseFlatten(Flatten):
+    """Parses the S/D (and, after an '@', the P/B of a fold axis) of
+    the plane given to -H or after an H. Returns a (strike, dip, plunge, 
+    bearing) tuple with a NaN plunge and bearing if there's no axis."""
+    if '@' not in Flatten: return ParsePlanes(Flatten) + (np.nan, np.nan)
+    portions = [item.strip() for item in Flatten.split('@')]
+    if len(portions) != 2: raise InputError("Too many @'s!")
+    bearing, plunge = ParseLines(portions[1])
+    return ParsePlanes(portions[0]) + (plunge, bearing)
+
+def ParseXY(input, PlotType, Flatten=None):
+    """Parses a measurement for OutputXY. Returns a GMT multisegment
+    header (for planes), the strike (bearing for lines), dip (plunge
+    for lines), rake, and a (strike, dip) tuple of the plane to
+    "flatten" the measurement to (None if it isn't being flattened)."""
+
+    input, Flatten = SplitFlatten(input, Flatten)
+    header, rake = '', 0
     if PlotType == 'Planes':
         strike,dip = ParsePlanes(input) #Returns S/D following RHR
-
-        #If strike=north, planes are lines of constant longitude.
         header = '> %s\n' % (input) #Multisegment GMT format, annotated with S/D
-        x,y = [],[]
-        for lat in range(-90,90+inc,inc):
-            x.append(90-dip)
-            y.append(float(lat))
-
-        #If data needs to be 'unfolded', rotate the pole, instead of the plane
-        #  This prevents problems with length changes if x,y coordinates from
-        #  a plane are rotated instead of a point.
-        if Flatten: x,y = [-dip], [0]
 
     elif PlotType == 'Poles':
-        strike,dip = ParsePlanes(input) 
-
-        #If strike=north, the pole to a plane will be at lat=0, long=-dip 
-        x,y = [-dip], [0]
+        strike,dip = ParsePlanes(input)
 
     elif PlotType == 'Lines':
         #Returns bearing/plunge with bearing at the end the plunge direction is measured from
-        strike,dip = ParseLines(input) 
-
-        #For Lines, plot lat=codip, long=0 and rotate later
-        x,y = [0], [90-dip]
+        strike,dip = ParseLines(input)
 
     elif PlotType == 'Rakes':
         #Returns a negative rake if the rake angle is measured from the "south" end of the plane
         strike,dip,rake = ParseRakes(input)
-        if rake>0: coRake = 90-rake
-        else:      coRake = 90+rake
-
-        #For Rakes, Lat = 90-rake, Long = 90-dip
-        x,y = [90-dip], [coRake]
 
     else:  #Shouldn't Happen
         sys.exit("Invalid Plot Type: %s (This shouldn't happen!) Programming error!" % PlotType)
 
-    #---------------------------------------------------
-    #--Rotate and Format Data---------------------------
-    #---------------------------------------------------
+    if Flatten: Flatten = ParseFlatten(Flatten)
+    else:       Flatten = None
 
-    #--Rotate Data to proper strike----------------------
-    X,Y = Rotate(x,y,strike)
+    return header,strike,dip,rake,Flatten
 
-    #--Do we need to "Flatten" the data?-----------------
-    #   i.e. Rotate to horizontal based on another plane
-    if Flatten:
-        horizStrike,horizDip = ParsePlanes(Flatten)
-        #Rotate to horizStrike=north and make horizDip horizontal
-        X,Y = Rotate(X,Y,-horizStrike,-horizDip)
-        #Unrotate back to the original strike
-        X,Y = Rotate(X,Y,horizStrike)
-
-        #If a pole to a plane was rotated, go back and create the plane
-        #  This needs to be explained more clearly... Also, it's a bit hackish...
-        if PlotType == 'Planes':
-            tmpOpts = copy.copy(options)
-            tmpOpts.Flatten = False
-            tmpOpts.Invert = 'plane'
-            StrikeDip = InvertGeographic('%.5f\t%.5f'%(X[0],Y[0]), tmpOpts)
-            return OutputXY(StrikeDip, tmpOpts)
-
-    #--Return as a string--------------------------------
-    coords = header  #In case it's a line, use GMT multisegment format
-    outputFormat = '%.2f\t%.2f\n' #Formatting string for coordinates
- 
-    for lon,lat in zip(X,Y): 
-
-        #If point is in the upper hemisphere, get the opposite end
-        if lon>90: lon-=180; lat=-lat
-        if lon<-90: lon+=180; lat=-lat
-
-        #Is -: set? If so, output lat-long, otherwise output long-lat
-        if options.ReverseXY:  coords += outputFormat % (lat,lon) 
-        else:                  coords += outputFormat % (lon,lat)
-
-    return coords
+def SplitFlatten(input, Flatten=None):
+    """Returns a measurement and the plane it is "flattened" to, 
+    which may follow it after an H (e.g. 340/20 H 035/76) instead 
+    of being given for all of them (Flatten)."""
+    if 'H' in input.upper():
+        portions = [item.strip() for item in input.upper().split('H')]
+        if len(portions) == 2:  input,Flatten = portions
+        else: raise InputError("Too many H's!")
+    return input, Flatten
+
+def TemplateXY(PlotType, dips, rakes, inc):
+    """Returns arrays of long, lat vertices (one row per measurement)
+    for measurements with the given dips (or plunges) and rakes
+    before they are rotated to their strike."""
+    dips = np.asarray(dips, dtype=float)
+    rakes = np.asarray(rakes, dtype=float)
+
+    if PlotType == 'Planes':
+        #If strike=north, planes are lines of constant longitude.
+        #   (inc may not evenly divide 180, the last vertex is at or past 90)
+        lats = -90 + inc*np.arange(int(np.ceil(180.0/inc - 1e-9)) + 1)
+        x = np.repeat((90-dips)[:,np.newaxis], len(lats), axis=1)
+        y = np.repeat(lats[np.newaxis,:], len(dips), axis=0)
+
+    elif PlotType == 'Poles':
+        #If strike=north, the pole to a plane will be at lat=0, long=-dip
+        x = -dips[:,np.newaxis]
+        y = np.zeros_like(x)
+
+    elif PlotType == 'Lines':
+        #For Lines, plot lat=codip, long=0 and rotate later
+        y = 90-dips[:,np.newaxis]
+        x = np.zeros_like(y)
+
+    elif PlotType == 'Rakes':
+        #For Rakes, Lat = 90-rake, Long = 90-dip
+        #   (rakes measured from the "south" end are negative)
+        x = 90-dips[:,np.newaxis]
+        y = 90-np.abs(rakes)[:,np.newaxis]
+
+    else:  #Shouldn't Happen
+        sys.exit("Invalid Plot Type: %s (This shouldn't happen!) Programming error!" % PlotType)
+
+    return x,y
+
+def FormatXY(header, longs, lats, ReverseXY=False):
+    """Returns a string of tab delimited long, lat pairs (preceeded by
+    header) with points in the upper hemisphere replaced by the
+    opposite end of the line."""
+    return FormatXYBatch([header], [longs], [lats], ReverseXY)[0]
+
+def FormatXYBatch(headers, longs, lats, ReverseXY=False, projection=None):
+    """Vectorized version of FormatXY. Takes a list of headers and 
+    arrays of longs and lats with one row per header and returns a
+    list of strings. If a projection is given, longs and lats are 
+    projected x, y coordinates (see ProjectVectors) instead. Rows
+    may be lists of different lengths (see RaggedBatch)."""
+    if Ragged(longs): return RaggedBatch(FormatXYBatch, headers, longs, lats, ReverseXY, projection)
+    if projection: outputFormat = '%.4f\t%.4f\n' #Net has a radius of 1
+    else:
+        outputFormat = '%.2f\t%.2f\n'
+        longs, lats = FoldHemisphere(longs, lats)
+
+    #Is -: set? If so, output lat-long, otherwise output long-lat
+    if ReverseXY: pairs = np.dstack((lats, longs))
+    else:         pairs = np.dstack((longs, lats))
+
+    #Every row has the same number of vertices, so each one is
+    #formatted with a single formatting string.
+    outputFormat = outputFormat * pairs.shape[1] #Formatting string for coordinates
+    rows = pairs.reshape(len(headers), -1).tolist()
+
+    #In case it's a line, header is in GMT multisegment format
+    return [header + outputFormat % tuple(row) for header, row in zip(headers, rows)]
+
+def PackXY(header, longs, lats, options):
+    """Binary version of FormatXY. Returns the long, lat pairs packed
+    as native floats (see BinaryType) with a record of NaNs in place 
+    of a multisegment header."""
+    return PackXYBatch([header], [longs], [lats], options)[0]
+
+def PackXYBatch(headers, longs, lats, options):
+    """Vectorized version of PackXY. Takes a list of headers and
+    arrays of longs and lats with one row per header and returns a
+    list of strings of packed binary records."""
+    if Ragged(longs): return RaggedBatch(PackXYBatch, headers, longs, lats, options)
+    if not options.Project: longs, lats = FoldHemisphere(longs, lats)
+    if options.ReverseXY: records = np.dstack((lats, longs))
+    else:                 records = np.dstack((longs, lats))
+    records = records.astype(BinaryType(options))
+    nan = np.array([np.nan, np.nan], dtype=records.dtype).tostring()
+    return [(header and nan) + row.tostring() for header, row in zip(headers, records)]
+
+def Ragged(rows):
+    """True if rows is a list of rows with different lengths"""
+    return isinstance(rows, list) and len(set([len(row) for row in rows])) > 1
+
+def RaggedBatch(function, headers, longs, lats, *args):
+    """Calls a batch formatting function (e.g. FormatXYBatch) on each
+    group of rows with the same number of vertices and returns the list 
+    of results in the original order."""
+    results = [None]*len(headers)
+    groups = {}
+    for i, row in enumerate(longs): groups.setdefault(len(row), []).append(i)
+    for index in groups.values():
+        rows = function([headers[i] for i in index], np.array([longs[i] for i in index]),
+                        np.array([lats[i] for i in index]), *args)
+        for i, row in zip(index, rows): results[i] = row
+    return results
+
+def BinaryType(options):
+    """Returns the numpy type of binary output records."""
+    if options.Binary == 'f': return np.float32
+    return np.float64
 
 
 def InvertGeographic(input,options):
     """Converts a string containing a long, lat pair into a plunge/bearing
     or strike/dip of the plane perpendictular to it."""
-    
+    long,lat = ParseGeographic(input, options)
+    PB = InvertGeographicArrays([long], [lat], options.Invert)
+
+    #--Return P/B of line or S/D of plane
+    outputFormat = '%.2f/%.2f\n'
+    return outputFormat % (PB[0][0], PB[1][0])
+
+def InvertGeographicBatch(inputs, options):
+    """Vectorized version of InvertGeographic. Takes a list of input
+    strings and returns a list containing either the P/B or S/D for
+    each one or the InputError raised while parsing it."""
+    results = [None]*len(inputs)
+    fields = [input.split() for input in inputs]
+
+    #--Usually everything is a valid number, so convert all at once
+    #   and only go through the inputs one at a time if that fails
+    try:
+        if [len(field) for field in fields].count(2) != len(fields): raise ValueError
+        pairs = np.array(fields, dtype=float).reshape(-1,2)
+        if options.ReverseXY: pairs = pairs[:,::-1]
+        longs, lats = pairs[:,0].copy(), pairs[:,1].copy()
+        valid = ValidGeographic(longs, lats)
+    except ValueError:
+        longs, lats = np.zeros(len(inputs)), np.zeros(len(inputs))
+        valid = np.zeros(len(inputs), dtype=bool)
+    for i in np.flatnonzero(~valid):
+        try:
+            longs[i], lats[i] = ParseGeographic(inputs[i], options)
+            valid[i] = True
+        except InputError, error:
+            results[i] = error
+
+    #--Convert the valid pairs and format the results---
+    index = np.flatnonzero(valid)
+    PB = InvertGeographicArrays(longs[index], lats[index], options.Invert)
+    outputFormat = '%.2f/%.2f\n'
+    for i, pair in zip(index.tolist(), zip(PB[0].tolist(), PB[1].tolist())):
+        results[i] = outputFormat % pair
+    return results
+
+def InvertGeographicArrays(longs, lats, invert='lines'):
+    """Converts arrays of longs and lats (in degrees) into arrays of
+    the plunge and bearing of the lines they represent (invert='lines')
+    or the strike and dip of the planes they are the poles to (invert=
+    'planes' or 'poles'). Points in the upper hemisphere are replaced
+    by the opposite end of the line. Longs may be between -180 and 360. 
+    Pairs outside the range accepted by InvertGeographic give NaNs."""
+    longs = np.array(longs, dtype=float)
+    lats = np.array(lats, dtype=float)
+    invalid = ~ValidGeographic(longs, lats)
+    longs[invalid], lats[invalid] = np.nan, np.nan
+
+    with np.errstate(invalid='ignore'): #NaNs
+        #--If using 0<long<360, convert to -180<long<180-------------------
+        longs[longs > 180] -= 360
+
+        #--Make sure it's in the right hemisphere, if not get the opposite end of the line
+        longs, lats = FoldHemisphere(longs, lats)
+
+    #--Convert to vectors and then to P/B or S/D---------------------------
+    xyz = np.column_stack(sph2cart(longs, lats))
+    if invert.lower() in ['line','lines']:                     return VectorsToLines(xyz)
+    elif invert.lower() in ['plane','planes','pole','poles']:  return VectorsToPlanes(xyz)
+    else: #Shouldn't Happen
+        sys.exit("Invalid inversion: %s (This shouldn't happen!) Programming error!" % invert)
+
+def ValidGeographic(longs, lats):
+    """Returns a boolean array that's True where longs and lats are in 
+    the range accepted by InvertGeographic"""
+    with np.errstate(invalid='ignore'):
+        return (np.abs(lats) <= 90) & (np.abs(longs) <= 360) & (longs >= -180)
+
+def ParseGeographic(input, options):
+    """Returns the long, lat pair in a string as floats, raising an 
+    InputError if it isn't a valid pair"""
     #--Split input into long and lat and convert to floats-----------------
     input = input.split()
     if len(input) != 2:
@@ -306,61 +1221,45 @@ def InvertGeographic(input,options):
     if (abs(lat) > 90) or (abs(long) > 360) or (long < -180):
         raise InputError("(%.1f, %.1f) is not a valid lat, long pair." % (lat, long))
 
-    #--If using 0<long<360, convert to -180<long<180-----------------------
-    if long > 180: long -= 360
-
-    #--Make sure it's in the right hemisphere, if not get the opposite end of the line
-    if long > 90:    long -= 180; lat=-lat
-    elif long < -90: long += 180; lat=-lat
-    
-    #--Convert back to plunge and bearing----------------------------------
-    x,y,z = sph2cart(long,lat)           #Cartesian Coords
-    bearing = atan2(z,y)                 #Bearing will be in y-z plane
-    plunge = atan( x/sqrt(y**2 + z**2) ) #Plunge is the angle btw the line and the y-z plane
-    plunge,bearing = degrees(plunge), degrees(bearing)
-    
-    #--Rotate so that 0 is north, not east---------------------------------
-    bearing = 90-bearing
-    if bearing<0: bearing += 360
-
-    #--Calculate S/D of plane to which the measurement is the pole---------
-    strike = bearing+90
-    dip = 90-plunge
-    if strike>360: strike-=360
-
-    #--Return P/B of line or S/D of plane
-    outputFormat = '%.2f/%.2f\n'
-    if options.Invert.lower() in ['line','lines']:    return outputFormat % (plunge,bearing)
-    elif options.Invert.lower() in ['plane','planes','pole','poles']: return outputFormat % (strike,dip)
+    return long,lat
 
 def CleanInput(input, options):
     """Takes a line with a S/D, P/B, or rake measurement 
     in any acceptable form and returns a measurement in
     azimuth format following the RHR."""
+    if options.PlotType in ['Planes', 'Poles']:
+        strike,dip = ParsePlanes(input)
+        rake = 0
+    elif options.PlotType == 'Lines':
+        strike,dip = ParseLines(input)
+        rake = 0
+    elif options.PlotType == 'Rakes':
+        strike,dip,rake = ParseRakes(input)
+    else: #Shouldn't Happen...
+        sys.exit("Invalid Plot Type: %s (This shouldn't happen!) Programming error!" % options.PlotType)
+    return FormatClean(options.PlotType, strike, dip, rake)+'\n'
 
-    #--Direction letters for each quad----------------------
-    LineDir = {'I':'NE', 'II':'SE', 'III':'SW', 'IV':'NW'} #Same quad as end of line
-    DipDir =  {'I':'SE', 'II':'SW', 'III':'NW', 'IV':'NE'} #Dip dir following RHR
+def FormatClean(PlotType, strike, dip, rake=0):
+    """Returns a parsed measurement (see ParseXY) in the form output
+    by CleanInput (without a newline)."""
 
     #--Output Format----------------------------------------
     outFormat = '%.0f/%.0f%s'           #E.g. Strike, dip, and direction
     rakeFormat = outFormat + ' %.0f%s'  #Strike/Dip of plane + Rake angle and direction 
 
     #--Strike/Dip-------------------------------------------
-    if options.PlotType in ['Planes', 'Poles']:
-        strike,dip = ParsePlanes(input)
+    if PlotType in ['Planes', 'Poles']:
         quad = FindQuadrant(strike)
         output = outFormat % (strike,dip, DipDir[quad])
 
     #--Plunge/Bearing---------------------------------------
-    elif options.PlotType == 'Lines':
-        bearing,plunge = ParseLines(input)
+    elif PlotType == 'Lines':
+        bearing,plunge = strike,dip
         quad = FindQuadrant(bearing)
         output = outFormat % (plunge,bearing, LineDir[quad])
 
     #--Rakes------------------------------------------------
-    elif options.PlotType == 'Rakes':
-        strike,dip,rake = ParseRakes(input)
+    elif PlotType == 'Rakes':
         quad = FindQuadrant(strike)
         end = LineDir[quad]
         #Is the rake measured from the non-RHR end of the plane?
@@ -373,9 +1272,1178 @@ def CleanInput(input, options):
         output = rakeFormat % (strike,dip,dir,rake,end)
 
     else: #Shouldn't Happen...
-        sys.exit("Invalid Plot Type: %s (This shouldn't happen!) Programming error!" % options.PlotType)
+        sys.exit("Invalid Plot Type: %s (This shouldn't happen!) Programming error!" % PlotType)
+
+    return output
+
+#---------------------------------------------------------------------------------------    
+#--Normalized Files---------------------------------------------------------------------
+#---------------------------------------------------------------------------------------    
+#   --normalize writes parsed measurements as a 1D .npy array of records
+#   so that later calls can memory map it instead of parsing text again.
+
+#One record per measurement. NaN flatStrike and flatDip if it isn't flattened
+#   and NaN flatPlunge and flatBearing if it isn't flattened around a fold axis.
+#Longest measurement kept as written (for the segment header of a plane)
+#   in a normalized record. Longer ones are written out from the record.
+NormalizedTextSize = 32
+NormalizedType = np.dtype([('type', 'S1'), ('strike', '<f8'), ('dip', '<f8'), ('rake', '<f8'),
+                           ('flatStrike', '<f8'), ('flatDip', '<f8'), ('flatPlunge', '<f8'),
+                           ('flatBearing', '<f8'), ('line', '<i8'), ('text', 'S%i' % NormalizedTextSize)])
+#Fields of NormalizedType holding the columns of Measurements.flats
+NormalizedFlats = ('flatStrike', 'flatDip', 'flatPlunge', 'flatBearing')
+#Code saved in the type field for each kind of measurement
+NormalizedCodes = {'Planes':'P', 'Poles':'P', 'Lines':'L', 'Rakes':'R'}
+#Size (in bytes) of the .npy header written by --normalize
+NpyHeaderSize = 512
+
+def NormalizedRecords(m, PlotType, lines, texts):
+    """Returns an array of NormalizedType records for the parsed
+    Measurements m that came from the given line numbers and
+    measurements (without any H, see SplitFlatten)."""
+    records = np.zeros(len(m.rows), dtype=NormalizedType)
+    records['type'] = NormalizedCodes[PlotType.capitalize()]
+    records['strike'], records['dip'], records['rake'] = m.strikes, m.dips, m.rakes
+    for i, name in enumerate(NormalizedFlats): records[name] = m.flats[:,i]
+    records['line'] = lines
+    records['text'] = [text if len(text) <= NormalizedTextSize else '' for text in texts]
+    return records
+
+def RecordMeasurements(records, options):
+    """Returns a Measurements tuple (see ParseBatch) for an array of 
+    records. Records that weren't flattened when they were normalized
+    are flattened to options.Flatten if it's given."""
+    strikes, dips, rakes = [np.array(records[name], dtype=float) for name in ('strike', 'dip', 'rake')]
+    flats = np.column_stack([records[name] for name in NormalizedFlats]).astype(float)
+    if options.Flatten: flats[np.isnan(flats[:,0])] = ParseFlatten(options.Flatten)
+    if options.PlotType == 'Planes':
+        headers = ['> %s\n' % (text or line) for text, line in zip(records['text'].tolist(), RecordLines(records))]
+    else:
+        headers = ['']*len(records)
+    return Measurements(range(len(records)), headers, strikes, dips, rakes, flats)
+
+def RecordLines(records):
+    """Returns a list of the records in the form output by CleanInput
+    (followed by the plane and fold axis they're flattened to, if any)"""
+    PlotTypes = {'P':'Planes', 'L':'Lines', 'R':'Rakes'}
+    lines = []
+    for code, strike, dip, rake, flatStrike, flatDip, flatPlunge, flatBearing in zip(
+            records['type'].tolist(), records['strike'].tolist(), records['dip'].tolist(), 
+            records['rake'].tolist(), *[records[name].tolist() for name in NormalizedFlats]):
+        line = FormatClean(PlotTypes[code], strike, dip, rake)
+        if flatStrike == flatStrike: line += ' H ' + FormatClean('Planes', flatStrike, flatDip)
+        if flatPlunge == flatPlunge: line += '@' + FormatClean('Lines', flatBearing, flatPlunge)
+        lines.append(line)
+    return lines
+
+def RecordOptions(records, options):
+    """Returns options with the PlotType saved in the records (which
+    are plotted as poles if options.PlotType is 'Poles')"""
+    codes = np.unique(records['type'])
+    if len(codes) > 1: raise InputError("Normalized files can't mix planes, lines and rakes!")
+    if not len(codes): return options
+    PlotType = {'P':'Planes', 'L':'Lines', 'R':'Rakes'}[codes[0]]
+    if PlotType == 'Planes' and options.PlotType == 'Poles': PlotType = 'Poles'
+    if PlotType == options.PlotType: return options
+    options = copy(options)
+    options.PlotType = PlotType
+    return options
+
+def IsNormalized(infile):
+    """True if infile is a .npy file (e.g. written by --normalize)"""
+    if infile is sys.stdin or not os.path.isfile(getattr(infile, 'name', '')): return False
+    f = open(infile.name, 'rb')
+    magic = f.read(6)
+    f.close()
+    return magic == '\x93NUMPY'
+
+def LoadNormalized(filename):
+    """Returns the array of records in a file written by --normalize,
+    memory mapped so that only the records that are used are read."""
+    try:
+        try: records = np.load(filename, mmap_mode='r')
+        except ValueError: records = np.load(filename) #No records to map
+    except (IOError, ValueError), error:
+        raise InputError("Can't read %s: %s" % (filename, error))
+    if records.dtype != NormalizedType or records.ndim != 1:
+        raise InputError("%s wasn't written by --normalize!" % filename)
+    return records
+
+def RecordRanges(filename, size=None):
+    """Yields (start, end) indices splitting the records in a 
+    normalized file into blocks of size records."""
+    size = size or BlockSize
+    total = len(LoadNormalized(filename))
+    for start in range(0, total, size):
+        yield start, min(start + size, total)
+
+def NpyHeader(dtype, rows):
+    """Returns a version 1.0 .npy header for a 1D array of rows records
+    of dtype. The header is always NpyHeaderSize bytes long, so it can
+    be rewritten once the number of records is known."""
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+                                np.lib.format.dtype_to_descr(dtype), rows)
+    if len(header) > NpyHeaderSize - 11: #Shouldn't Happen
+        sys.exit("NpyHeaderSize is too small for %s (This shouldn't happen!) Programming error!" % header)
+    header = header.ljust(NpyHeaderSize - 11) + '\n'
+    return '\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header
+
+#---------------------------------------------------------------------------------------    
+#--Analyses-----------------------------------------------------------------------------
+#---------------------------------------------------------------------------------------    
+#   Each block of input is summarized by AnalyzeBlock. Summaries of
+#   different blocks are combined with += (so they can come from different
+#   processes) and the combined summary is turned into output at the end.
+
+#Options that select an analysis instead of formatting the input
+AnalysisModes = ('Density', 'Fit', 'Clusters', 'Fisher', 'Test', 'Rose', 'Raster', 'Dedupe')
+
+def Analysis(options):
+    """Returns the name of the analysis selected by options (e.g. 
+    'Density') or None if input is just being formatted."""
+    for name in AnalysisModes:
+        if getattr(options, name, None) is not None: return name
+    return None
+
+def AnalyzeBlock(vectors, options):
+    """Summarizes an (n,3) array of unit vectors from a block of input
+    for the analysis selected by options."""
+    analysis = Analysis(options)
+    if analysis in ('Density', 'Clusters', 'Fisher'): return [vectors] #Needs all of the data
+    elif analysis in ('Fit', 'Test'): return OrientationTensor(vectors)
+    elif analysis == 'Rose':
+        return RoseCounts(options.sector, options.Rose == 'bidirectional', RoseAzimuths(vectors, options))
+    elif analysis == 'Raster':
+        return RasterCounts(options.pixels, options.Project or 'schmidt', vectors)
+    else: #Shouldn't Happen
+        sys.exit("Invalid analysis: %s (This shouldn't happen!) Programming error!" % analysis)
+
+def OutputAnalysis(summary, options):
+    """Returns the output of the analysis selected by options given
+    the combined summaries of every block of input."""
+    analysis = Analysis(options)
+    if analysis == 'Density' and options.update:
+        return OutputDensity(np.concatenate(summary or [np.empty((0,3))]), options)
+    if summary is None: raise InputError('No valid measurements to analyze!')
+    if analysis == 'Density': return OutputDensity(np.concatenate(summary), options)
+    elif analysis == 'Fit':   return OutputFit(summary, options)
+    elif analysis == 'Clusters': return OutputClusters(np.concatenate(summary), options)
+    elif analysis == 'Fisher':   return OutputFisher(np.concatenate(summary), options)
+    elif analysis == 'Test':     return OutputTest(summary, options)
+    elif analysis == 'Rose':     return OutputRose(summary, options)
+    elif analysis == 'Raster':return OutputRaster(summary, options)
+    elif analysis == 'Dedupe':
+        lines = sum([block for block, vectors in summary], [])
+        return OutputDedupe(lines, np.concatenate([vectors for block, vectors in summary]), options)
+    else: #Shouldn't Happen
+        sys.exit("Invalid analysis: %s (This shouldn't happen!) Programming error!" % analysis)
+
+#--Orientation Tensor-------------------------------------------------------------------
+
+class OrientationTensor(object):
+    """Running sum of the outer products of unit vectors with
+    themselves (the orientation tensor, Scheidegger, 1965) and the
+    number of vectors summed.  Only the 3x3 sum (and the resultant 
+    of the vectors in the lower hemisphere) is kept, so any amount of
+    data can be added. Tensors of different blocks of data can be 
+    added together."""
+    def __init__(self, vectors=None):
+        self.sum = np.zeros((3,3))
+        self.resultant = np.zeros(3)
+        self.count = 0
+        if vectors is not None: self.add(vectors)
+    def add(self, vectors):
+        vectors = np.asarray(vectors, dtype=float).reshape(-1,3)
+        self.sum += np.dot(vectors.T, vectors)
+        self.resultant += np.where(vectors[:,0:1] < 0, -vectors, vectors).sum(axis=0)
+        self.count += len(vectors)
+        return self
+    def __iadd__(self, other):
+        self.sum += other.sum
+        self.resultant += other.resultant
+        self.count += other.count
+        return self
+    def __add__(self, other):
+        total = OrientationTensor()
+        total += self
+        total += other
+        return total
+    def eigen(self):
+        """Returns the normalized eigenvalues (largest first) and
+        the corresponding eigenvectors (as rows)."""
+        if self.count == 0: raise InputError('No valid measurements to analyze!')
+        values, vectors = np.linalg.eigh(self.sum / self.count)
+        order = np.argsort(values)[::-1]
+        return values[order], vectors[:,order].T
+
+def OutputFit(tensor, options):
+    """Returns the best fit plane, fold axis, mean orientation and 
+    shape of the data summarized by an OrientationTensor as text."""
+    values, vectors = tensor.eigen()
+    plunges, bearings = VectorsToLines(vectors)
+    strikes, dips = VectorsToPlanes(vectors)
+
+    #--Woodcock's (1977) shape parameters-----------------
+    #   K<1 for girdles and K>1 for clusters, C is the strength
+    S1,S2,S3 = np.clip(values, 1e-15, None)
+    K = np.log(S1/S2) / max(np.log(S2/S3), 1e-15)
+    C = np.log(S1/S3)
+
+    output  = 'plane\t%.2f/%.2f\n' % (strikes[2], dips[2])  #Girdle, the pole of which is the
+    output += 'axis\t%.2f/%.2f\n' % (plunges[2], bearings[2]) #least clustered direction
+    output += 'mean\t%.2f/%.2f\n' % (plunges[0], bearings[0])
+    output += 'eigenvalues\t%.4f\t%.4f\t%.4f\n' % tuple(values)
+    output += 'K\t%.4f\nC\t%.4f\n' % (K, C)
+    output += 'count\t%i\n' % tensor.count
+    return output
+
+#--Clustering---------------------------------------------------------------------------
+
+def OutputClusters(vectors, options):
+    """Separates an (n,3) array of unit vectors into options.Clusters
+    sets and returns a summary of each set followed by each vector (in
+    --clean format) and the number of its set as text."""
+    centers, labels = SphericalKMeans(vectors, options.Clusters, options.iterations,
+                                      options.batch, options.seed)
+
+    #--Number the sets from largest to smallest---------
+    counts = np.bincount(labels, minlength=len(centers))
+    order = np.argsort(-counts, kind='mergesort')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    labels, centers, counts = rank[labels], centers[order], counts[order]
+    tensors = ScatterMatrices(vectors, labels, len(centers))
+    concentration = np.linalg.eigvalsh(tensors)[:,-1] / np.maximum(counts, 1)
+
+    if options.PlotType.capitalize() in ('Planes', 'Poles'): kind = 'Planes'
+    else:                                                   kind = 'Lines'
+    means = FormatOrientations(centers, kind)
+    output = ['# set %i: %s n=%i (%.1f%%) S1=%.4f\n' % (i+1, mean, count, 100.0*count/len(vectors), S1)
+              for i, (mean, count, S1) in enumerate(zip(means, counts, concentration))]
+    output += ['%s\t%i\n' % row for row in zip(FormatOrientations(vectors, kind), (labels+1).tolist())]
+    return ''.join(output)
+
+def SphericalKMeans(vectors, k, iterations=100, batch=0, seed=0):
+    """Separates an (n,3) array of unit vectors, treated as axes (v and
+    -v are the same), into k sets. Each set's center is the principal
+    eigenvector of its orientation tensor and vectors belong to the 
+    set with the closest center (largest |cos|). If batch is nonzero,
+    centers are updated with random samples of batch vectors (mini-
+    batch k-means) instead of all of them. Returns the (k,3) centers
+    and the set (0 to k-1) of each vector."""
+    n = len(vectors)
+    if n == 0: raise InputError('No valid measurements to cluster!')
+    if k > n: raise InputError('Can\'t separate %i measurements into %i sets!' % (n, k))
+    state = np.random.RandomState(seed)
+    centers = AxialSeeds(vectors, k, state)
+
+    if batch:
+        #--Running sums of each set's tensor over every batch so far
+        sums = np.zeros((k,3,3))
+        for i in range(iterations):
+            sample = vectors[state.randint(0, n, batch)]
+            sums += ScatterMatrices(sample, NearestAxes(sample, centers), k)
+            centers = PrincipalAxes(sums, centers)
+    else:
+        labels = None
+        for i in range(iterations):
+            new = NearestAxes(vectors, centers)
+            if labels is not None and (new == labels).all(): break
+            labels = new
+            centers = PrincipalAxes(ScatterMatrices(vectors, labels, k), centers)
+
+    return centers, NearestAxes(vectors, centers)
+
+def AxialSeeds(vectors, k, state):
+    """Picks k starting centers from an (n,3) array of unit vectors 
+    (k-means++ with sin^2 of the angle between axes as the distance)"""
+    centers = [vectors[state.randint(len(vectors))]]
+    distance = 1 - np.dot(vectors, centers[0])**2
+    for i in range(1, k):
+        total = distance.sum()
+        if total <= 0: index = state.randint(len(vectors)) #All the same axis
+        else:          index = min(np.searchsorted(np.cumsum(distance), state.uniform(0, total)), len(vectors)-1)
+        centers.append(vectors[index])
+        distance = np.minimum(distance, 1 - np.dot(vectors, centers[-1])**2)
+    return np.array(centers)
+
+def NearestAxes(vectors, centers):
+    """Returns the index of the center closest to each vector (as axes)"""
+    labels = np.empty(len(vectors), dtype=int)
+    for start in range(0, len(vectors), CountBlockSize):
+        block = vectors[start:start+CountBlockSize]
+        labels[start:start+CountBlockSize] = np.abs(np.dot(block, centers.T)).argmax(axis=1)
+    return labels
+
+def ScatterMatrices(vectors, labels, k):
+    """Returns a (k,3,3) array of the sums of the outer products of
+    the vectors in each of k sets."""
+    sums = np.empty((k,3,3))
+    for i in range(3):
+        for j in range(i, 3):
+            sums[:,i,j] = sums[:,j,i] = np.bincount(labels, vectors[:,i]*vectors[:,j], minlength=k)
+    return sums
+
+def PrincipalAxes(tensors, previous):
+    """Returns the principal eigenvector of each of a (k,3,3) array of
+    orientation tensors (previous, for empty sets)."""
+    values, axes = np.linalg.eigh(tensors)
+    axes = axes[...,-1]
+    empty = values[:,-1] <= 0
+    axes[empty] = previous[empty]
+    return axes
+
+def FormatOrientations(vectors, kind='Planes'):
+    """Returns a list of strings (in the same form as CleanInput, 
+    without newlines) of the planes whose poles are, or the lines 
+    given by, an (n,3) array of vectors"""
+    if kind == 'Planes':
+        strikes, dips = VectorsToPlanes(vectors)
+        return ['%.0f/%.0f%s' % (strike, dip, DipDir[FindQuadrant(strike)])
+                for strike, dip in zip(strikes.tolist(), dips.tolist())]
+    plunges, bearings = VectorsToLines(vectors)
+    return ['%.0f/%.0f%s' % (plunge, bearing, LineDir[FindQuadrant(bearing)])
+            for plunge, bearing in zip(plunges.tolist(), bearings.tolist())]
+
+#--Fisher Statistics-------------------------------------------------------------------
+
+def OutputFisher(vectors, options):
+    """Returns the Fisher statistics of an (n,3) array of unit vectors
+    as '#' lines followed by the alpha95 (and bootstrap) cones as GMT
+    multisegment polygons of long, lat pairs."""
+    vectors = np.where(vectors[:,0:1] < 0, -vectors, vectors) #Lower hemisphere
+    mean, n, R, kappa, alpha95 = FisherStatistics(vectors)
+    if options.PlotType.capitalize() in ('Planes', 'Poles'): kind = 'Planes'
+    else:                                                   kind = 'Lines'
+    plunge, bearing = VectorsToLines(mean[np.newaxis,:])
+
+    output  = '# mean\t%.2f/%.2f\n' % (plunge[0], bearing[0])
+    if kind == 'Planes':
+        strike, dip = VectorsToPlanes(mean[np.newaxis,:])
+        output += '# plane\t%.2f/%.2f\n' % (strike[0], dip[0])
+    output += '# n\t%i\n# R\t%.4f\n# kappa\t%.4f\n# alpha95\t%.4f\n' % (n, R, kappa, alpha95)
+    cones = [('alpha95', alpha95)]
+    if options.bootstrap:
+        angle = BootstrapCone(vectors, mean, options.bootstrap, options.jobs, options.seed)
+        output += '# bootstrap95\t%.4f\n' % angle
+        cones.append(('bootstrap95', angle))
+
+    #--Cones aren't folded, points in the upper hemisphere are outside -Rd
+    for name, angle in cones:
+        X,Y = cart2sph(*ConeVectors(mean, angle, options.inc).T)
+        if options.ReverseXY: X,Y = Y,X
+        output += '> %s %.2f\n' % (name, angle)
+        output += ''.join(['%.2f\t%.2f\n' % pair for pair in zip(X.tolist(), Y.tolist())])
+    return output
+
+def FisherStatistics(vectors):
+    """Returns the mean direction (a unit vector), number of vectors,
+    resultant length, Fisher kappa (estimated by (n-1)/(n-R)) and alpha95
+    (in degrees) of an (n,3) array of unit vectors."""
+    n = len(vectors)
+    if n < 2: raise InputError('At least two valid measurements are needed for Fisher statistics!')
+    resultant = vectors.sum(axis=0)
+    R = np.sqrt(np.dot(resultant, resultant))
+    if R == 0: raise InputError('The measurements have no mean direction!')
+    with np.errstate(divide='ignore'):
+        kappa = (n - 1) / (n - R)
+    cosine = 1 - (n - R) / R * (20**(1.0/(n-1)) - 1)
+    alpha95 = np.degrees(np.arccos(np.clip(cosine, -1, 1)))
+    return resultant / R, n, R, kappa, alpha95
+
+def BootstrapCone(vectors, mean, count, jobs=1, seed=0):
+    """Returns the angle (in degrees) from mean within which 95% of the 
+    means of count resamples of vectors fall. Resamples are split 
+    between jobs processes, each with its own seed."""
+    counts = [count // jobs + (i < count % jobs) for i in range(max(jobs, 1))]
+    tasks = [(vectors, size, seed + i) for i, size in enumerate(counts) if size]
+    if len(tasks) > 1:
+        pool = Pool(len(tasks))
+        try:     means = pool.map(BootstrapMeans, tasks)
+        finally: pool.terminate()
+    else:
+        means = map(BootstrapMeans, tasks)
+    cosines = np.dot(np.concatenate(means), mean)
+    return np.percentile(np.degrees(np.arccos(np.clip(cosines, -1, 1))), 95)
+
+def BootstrapMeans(task):
+    """Returns a (count,3) array of the mean directions of count random
+    resamples (with replacement) of a (vectors, count, seed) task."""
+    vectors, count, seed = task
+    state = np.random.RandomState(seed)
+    n = len(vectors)
+    means = np.empty((count, 3))
+    step = max(1, BootstrapBlockSize // n) #Resamples drawn at once
+    for start in range(0, count, step):
+        size = min(step, count - start)
+        sums = vectors[state.randint(0, n, (size, n))].sum(axis=1)
+        means[start:start+size] = sums / np.sqrt((sums**2).sum(axis=1))[:,np.newaxis]
+    return means
+
+#Number of resampled vectors BootstrapMeans handles at once
+BootstrapBlockSize = 1 << 20
+
+def ConeVectors(axis, angle, inc=10):
+    """Returns an (m,3) array of unit vectors every inc degrees around 
+    a cone with the given angle (in degrees) around the unit vector axis.
+    The first and last vectors are the same, closing the polygon."""
+    u, v = PerpendicularAxes(axis)
+    steps = int(np.ceil(360.0 / inc))
+    theta = np.radians(np.linspace(0, 360, steps + 1))[:,np.newaxis]
+    angle = np.radians(angle)
+    return np.cos(angle)*axis + np.sin(angle)*(np.cos(theta)*u + np.sin(theta)*v)
+
+def PerpendicularAxes(axis):
+    """Returns two unit vectors perpendicular to the unit vector axis
+    and each other"""
+    other = np.eye(3)[np.argmin(np.abs(axis))]
+    u = np.cross(axis, other)
+    u /= np.sqrt(np.dot(u, u))
+    return u, np.cross(axis, u)
+
+#--Significance Tests-------------------------------------------------------------------
+
+def OutputTest(tensor, options):
+    """Returns the Rayleigh and Bingham statistics of the data summarized
+    by an OrientationTensor and their p-values under the null distribution
+    options.Test as text."""
+    n = tensor.count
+    if n < 2: raise InputError('At least two valid measurements are needed to test!')
+    values, axes = tensor.eigen()
+    observed = TestStatistics(tensor.resultant, values, n)
+    if options.Test == 'fisher':
+        #--Fit to the axes rather than the lower hemisphere directions,
+        #   which are biased where the mean is near horizontal
+        null = (axes[0], FisherKappa(values[0]))
+    else:
+        null = None
+    count = int(np.ceil(0.25 / options.precision**2))
+    simulated = SimulateStatistics(null, n, count, options.jobs, options.seed)
+    p = ((simulated >= observed).sum(axis=0) + 1.0) / (count + 1)
+    decimals = max(1, int(np.ceil(-np.log10(options.precision))))
+
+    output  = 'null\t%s\n' % options.Test
+    if null: output += 'kappa\t%.4f\n' % null[1]
+    output += 'count\t%i\nsets\t%i\n' % (n, count)
+    output += 'rayleigh\t%.4f\t%.*f\n' % (observed[0], decimals, p[0])
+    output += 'bingham\t%.4f\t%.*f\n' % (observed[1], decimals, p[1])
+    return output
+
+def FisherKappa(S1):
+    """Returns the kappa of the Fisher distribution whose largest
+    normalized eigenvalue is S1 (the mean squared cosine of the angle
+    from the mean, 1 - 2(coth(kappa)/kappa - 1/kappa^2))"""
+    if S1 <= 1.0/3: return 0.0
+    if S1 >= 1: return np.inf
+    low, high = 1e-6, 1e9
+    for i in range(100): #Bisect in log(kappa)
+        kappa = sqrt(low * high)
+        if 1 - 2*(1/(kappa*np.tanh(kappa)) - 1/kappa**2) < S1: low = kappa
+        else:                                                 high = kappa
+    return kappa
+
+def TestStatistics(resultants, eigenvalues, n):
+    """Returns the Rayleigh and Bingham statistics of sets of n unit
+    vectors with the given (lower hemisphere) resultants and normalized
+    eigenvalues (the last axis of either)."""
+    rayleigh = 3.0 * (resultants**2).sum(axis=-1) / n
+    bingham = 7.5 * n * ((eigenvalues - 1.0/3)**2).sum(axis=-1)
+    return np.stack([rayleigh, bingham], axis=-1)
+
+def SimulateStatistics(null, n, count, jobs=1, seed=0):
+    """Returns a (count,2) array of the TestStatistics of count sets of
+    n unit vectors drawn from null (None for uniform or a (mean, kappa)
+    tuple for the Fisher distribution). Sets are split between jobs
+    processes, each with its own seed."""
+    counts = [count // jobs + (i < count % jobs) for i in range(max(jobs, 1))]
+    tasks = [(null, n, size, seed + i) for i, size in enumerate(counts) if size]
+    if len(tasks) > 1:
+        pool = Pool(len(tasks))
+        try:     statistics = pool.map(SimulateSets, tasks)
+        finally: pool.terminate()
+    else:
+        statistics = map(SimulateSets, tasks)
+    return np.concatenate(statistics)
+
+def SimulateSets(task):
+    """Returns a (count,2) array of the TestStatistics of the sets drawn
+    for a (null, n, count, seed) task (see SimulateStatistics)."""
+    null, n, count, seed = task
+    state = np.random.RandomState(seed)
+    statistics = np.empty((count, 2))
+    step = max(1, BootstrapBlockSize // n) #Sets drawn at once
+    for start in range(0, count, step):
+        size = min(step, count - start)
+        if null is None: vectors = UniformVectors(state, (size, n))
+        else:            vectors = FisherVectors(state, (size, n), *null)
+        vectors = np.where(vectors[...,0:1] < 0, -vectors, vectors) #Lower hemisphere
+        eigenvalues = np.linalg.eigvalsh(np.einsum('sni,snj->sij', vectors, vectors) / n)
+        statistics[start:start+size] = TestStatistics(vectors.sum(axis=1), eigenvalues, n)
+    return statistics
+
+def UniformVectors(state, shape):
+    """Returns an array of unit vectors (with shape + (3,)) drawn 
+    uniformly from the sphere with a numpy RandomState"""
+    vectors = state.standard_normal(shape + (3,))
+    return vectors / np.sqrt((vectors**2).sum(axis=-1))[...,np.newaxis]
+
+def FisherVectors(state, shape, mean, kappa):
+    """Returns an array of unit vectors (with shape + (3,)) drawn from
+    the Fisher distribution around the unit vector mean with a numpy
+    RandomState"""
+    #--Cosine of the angle from the mean (inverting its distribution)
+    #   and a uniform angle around it
+    u = state.uniform(size=shape)
+    if kappa == 0:        w = state.uniform(-1, 1, size=shape)
+    elif np.isinf(kappa): w = np.ones(shape)
+    else:               w = np.clip(1 + np.log(u + (1-u)*np.exp(-2*kappa)) / kappa, -1, 1)
+    theta = state.uniform(0, 2*np.pi, size=shape)
+    a, b = PerpendicularAxes(mean)
+    sine = np.sqrt(1 - w**2)
+    return (w[...,np.newaxis]*mean + (sine*np.cos(theta))[...,np.newaxis]*a 
+                                   + (sine*np.sin(theta))[...,np.newaxis]*b)
+
+#--Orientation Index-------------------------------------------------------------------
+
+class OrientationIndex(object):
+    """Finds the axes in an (n,3) array of unit vectors that are within
+    an angle of, or nearest to, other unit vectors without comparing 
+    every pair. Each axis (and its opposite) is put in a cube of a 3D
+    grid so only the vectors in the cubes near a query are compared.
+    Queries within angles up to the one given are fastest."""
+    def __init__(self, vectors, angle=None):
+        self.vectors = np.asarray(vectors, dtype=float)
+        n = len(self.vectors)
+        #--Cubes about as wide as the chord of angle (or holding a
+        #   few vectors each), but not so small that the keys overflow
+        if angle is None: angle = degrees(np.arccos(1 - min(IndexCubeCount / max(n, 1.0), 1)))
+        self.size = max(SearchChord(angle), IndexMinimumSize)
+        self.shape = int(np.ceil(2 / self.size)) + 1
+        both = np.concatenate([self.vectors, -self.vectors])
+        keys = self.keys(self.cubes(both))
+        self.order = np.argsort(keys, kind='mergesort')
+        self.sorted = keys[self.order]
+        self.stored = both[self.order]
+        self.order %= max(n, 1)
+    def __len__(self):
+        return len(self.vectors)
+    def cubes(self, vectors):
+        return np.floor((vectors + 1) / self.size).astype(np.int64)
+    def keys(self, cubes):
+        return (cubes[...,0]*self.shape + cubes[...,1])*self.shape + cubes[...,2]
+    def pairs(self, queries, angle):
+        """Yields arrays of the indices of queries, indices of vectors 
+        and the cosines of the angles between them for every pair of
+        a query and an axis within angle (in degrees, less than 90) of 
+        it, a block of queries at a time, in order of the queries."""
+        queries = np.asarray(queries, dtype=float).reshape(-1, 3)
+        cosAngle = np.cos(np.radians(angle)) - IndexTolerance
+        m = max(int(np.ceil(SearchChord(angle) / self.size)), 1)
+        steps = np.arange(-m, m+1)
+        offsets = np.stack(np.meshgrid(steps, steps, steps), axis=-1).reshape(-1, 3)
+        #--When there are more nearby cubes than vectors, compare them all
+        brute = len(offsets) > len(self.stored)
+        rows = max(1, IndexBlockSize * 27 // max(len(self.stored) if brute else len(offsets), 1))
+        for start in range(0, len(queries), rows):
+            block = queries[start:start+rows]
+            if brute:
+                which, position = np.indices((len(block), len(self.stored))).reshape(2, -1)
+            else:
+                cubes = self.cubes(block)[:,np.newaxis,:] + offsets
+                inside = np.all((cubes >= 0) & (cubes < self.shape), axis=2)
+                keys = self.keys(cubes)
+                first = np.searchsorted(self.sorted, keys, 'left')
+                counts = np.where(inside, np.searchsorted(self.sorted, keys, 'right') - first, 0).ravel()
+                #--Every stored vector in every nearby cube
+                which = np.repeat(np.arange(len(block)).repeat(len(offsets)), counts)
+                position = np.repeat(first.ravel() - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+            cosines = np.einsum('ij,ij->i', block[which], self.stored[position])
+            close = cosines >= cosAngle
+            yield which[close] + start, self.order[position[close]], np.minimum(cosines[close], 1)
+    def within(self, queries, angle):
+        """Returns arrays of the indices of queries and of vectors for 
+        every axis within angle (in degrees, less than 90) of a query"""
+        found = list(self.pairs(queries, angle))
+        if not found: return np.zeros(0, int), np.zeros(0, int)
+        return np.concatenate([i for i, j, c in found]), np.concatenate([j for i, j, c in found])
+    def nearest(self, queries, k=1):
+        """Returns (m,k) arrays of the indices of, and angles (in degrees)
+        to, the k axes nearest each of an (m,3) array of queries, 
+        nearest first."""
+        queries = np.asarray(queries, dtype=float).reshape(-1, 3)
+        if not 0 < k <= len(self): raise InputError('Can only find 1 to %i nearest measurements!' % len(self))
+        indices = np.zeros((len(queries), k), dtype=int)
+        angles = np.zeros((len(queries), k))
+        #--Widen the search around queries without k axes near enough
+        angle = degrees(np.arccos(1 - min(float(k) / len(self), 1)))
+        remaining = np.arange(len(queries))
+        while len(remaining):
+            angle = min(2*angle, 90 - IndexTolerance)
+            found = list(self.pairs(queries[remaining], angle))
+            which = np.concatenate([i for i, j, c in found])
+            vectors = np.concatenate([j for i, j, c in found])
+            cosines = np.concatenate([c for i, j, c in found])
+            counts = np.bincount(which, minlength=len(remaining))
+            done = (counts >= k) | (angle >= 90 - IndexTolerance)
+            #--Nearest k of each finished query (sorted by query, then angle)
+            keep = done[which]
+            which, vectors, cosines = which[keep], vectors[keep], cosines[keep]
+            order = np.lexsort((-cosines, which))
+            which, vectors, cosines = which[order], vectors[order], cosines[order]
+            rank = np.arange(len(which)) - np.repeat(np.cumsum(counts[done]) - counts[done], counts[done])
+            first = rank < k
+            rows = remaining[which[first]]
+            indices[rows, rank[first]] = vectors[first]
+            angles[rows, rank[first]] = np.degrees(np.arccos(cosines[first]))
+            remaining = remaining[~done]
+        return indices, angles
+
+def Chord(angle):
+    """Returns the distance between two unit vectors angle degrees apart"""
+    return 2 * np.sin(np.radians(angle) / 2)
+
+def SearchChord(angle):
+    """Returns the farthest apart two unit vectors counted as within
+    angle degrees of each other (allowing for IndexTolerance) can be"""
+    return Chord(degrees(np.arccos(max(np.cos(np.radians(angle)) - IndexTolerance, -1))))
+
+#Number of axes (on average) within the cube size chosen for an index
+IndexCubeCount = 8.0
+#Smallest cube size (keeps the keys of a 3D grid within an int64)
+IndexMinimumSize = 1e-4
+#Cosines this close to the limit are counted as within it (exact duplicates)
+IndexTolerance = 1e-9
+#Number of queries OrientationIndex compares at once
+IndexBlockSize = 1024
+
+def OutputDedupe(lines, vectors, options):
+    """Returns the lines whose vectors aren't within options.Dedupe 
+    degrees of the vector of an earlier line that was kept"""
+    return ''.join(line + '\n' for line, kept in 
+                   zip(lines, Unique(vectors, options.Dedupe).tolist()) if kept)
+
+def Unique(vectors, angle=0):
+    """Returns a boolean array that is False for each of an (n,3) array 
+    of unit vectors within angle (in degrees) of an earlier vector that
+    is True (i.e. keeps the first of each group of duplicates)."""
+    #--Only the first of identical vectors can be kept, so compare just those
+    vectors = np.asarray(vectors, dtype=float).reshape(-1, 3)
+    distinct, inverse = UniqueRows(vectors)
+    first = np.zeros(len(distinct), dtype=int)
+    first[inverse[::-1]] = np.arange(len(vectors))[::-1]
+    order = np.argsort(first)
+    keep = np.zeros(len(vectors), dtype=bool)
+    keep[first[order]] = UniqueDistinct(distinct[order], angle)
+    return keep
+
+def UniqueDistinct(vectors, angle=0):
+    """Unique for an array of vectors with no identical rows"""
+    keep = np.ones(len(vectors), dtype=bool)
+    index = OrientationIndex(vectors, angle)
+    for which, others, cosines in index.pairs(vectors, angle):
+        earlier = others < which
+        which, others = which[earlier], others[earlier]
+        #--Duplicates of vectors that are already settled (kept or not)
+        #   i.e. those before the first vector with an earlier duplicate
+        start = which.min() if len(which) else 0
+        before = others < start
+        keep[which[before & keep[others]]] = False
+        #--Then the rest, in order
+        which, others = which[~before], others[~before]
+        order = np.lexsort((others, which))
+        which, others = which[order], others[order]
+        bounds = np.flatnonzero(np.diff(np.r_[-1, which, -1]))
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            if keep[which[first]] and keep[others[first:last]].any(): keep[which[first]] = False
+    return keep
+
+#--Density Contouring-------------------------------------------------------------------
+
+def PointVectors(inputs, options):
+    """Returns a list of the InputErrors raised by each input (None
+    if it was parsed, see ParseBatch) and an (n,3) array of unit vectors
+    for the poles to planes, lines, or rakes given by the inputs."""
+    results, m = ParseBatch(inputs, options.PlotType.capitalize(), options.Flatten)
+    return results, MeasurementPoints(m, options)
+
+def MeasurementPoints(m, options):
+    """Returns an (n,3) array of unit vectors for the parsed 
+    Measurements m (see PointVectors)"""
+    PlotType = options.PlotType.capitalize()
+    if PlotType == 'Planes': template = 'Poles'
+    else:                    template = PlotType
+    xyz = MeasurementVectors(template, m.strikes, m.dips, m.rakes, m.flats)
+    return xyz[:,0,:]
+
+def OutputDensity(vectors, options):
+    """Returns a string of tab delimited long, lat, density (or binary
+    records with --binary) for each node of a density grid of the (n,3)
+    array of unit vectors. With --update, the vectors are added to (and
+    the density is for) the saved DensityAccumulator instead."""
+    if options.update:
+        accumulator = DensityAccumulator.load(options.update, options, len(vectors))
+        accumulator.add(vectors)
+        for filename in options.merge or []:
+            accumulator += DensityAccumulator.load(filename)
+        accumulator.save(options.update)
+        longs, lats, density = accumulator.density()
+    else:
+        longs, lats, density = DensityGrid(vectors, options.spacing, options.Density, options.sigma)
+    return FormatDensity(longs, lats, density, options)
+
+def FormatDensity(longs, lats, density, options):
+    """Returns the long, lat and density of each node of a density grid
+    as text (or binary records with --binary)"""
+    #Is -: set? If so, output lat-long, otherwise output long-lat
+    if options.ReverseXY: columns = (lats, longs, density)
+    else:                 columns = (longs, lats, density)
+    if options.Binary or options.npy:
+        records = np.column_stack([column.ravel() for column in columns])
+        return records.astype(BinaryType(options)).tostring()
+    rows = zip(*[column.ravel().tolist() for column in columns])
+    return ''.join(['%.2f\t%.2f\t%.4f\n' % row for row in rows])
+
+def DensityGrid(vectors, spacing=2, method='kamb', sigma=3):
+    """Contours an (n,3) array of (axial) unit vectors on a grid of 
+    long, lat nodes every spacing degrees on the lower hemisphere. 
+    Returns 2D arrays of the long, lat and density at each node. 
+    Density is in multiples of the standard deviation expected for 
+    uniformly distributed data for 'kamb' and 'modified-kamb' and 
+    in percent of the data per 1% area for 'schmidt'."""
+    n = len(vectors)
+    if n == 0: raise InputError('No valid measurements to contour!')
+    longs, lats = DensityNodes(spacing)
+    cosRadius, kernel, units = DensityParameters(n, method, sigma)
+    counts = CountWithin(longs, lats, vectors, cosRadius, kernel)
+    return longs, lats, counts / units
+
+class DensityAccumulator(object):
+    """Counts at each node of a density grid with a fixed counting
+    circle that can be saved, updated with more vectors and added to
+    other accumulators with the same grid and circle."""
+    def __init__(self, spacing=2, method='kamb', cosRadius=0.99):
+        self.spacing, self.method, self.cosRadius = float(spacing), method, float(cosRadius)
+        self.longs, self.lats = DensityNodes(spacing)
+        self.counts = np.zeros(self.longs.shape)
+        self.count = 0
+    def add(self, vectors):
+        if len(vectors): self.counts += CountWithin(self.longs, self.lats, vectors, self.cosRadius)
+        self.count += len(vectors)
+        return self
+    def __iadd__(self, other):
+        if (other.spacing, other.method, other.cosRadius) != (self.spacing, self.method, self.cosRadius):
+            raise InputError("Can't merge density grids with different methods, spacings or counting circles! (Start kamb grids with the same --expected and --sigma)")
+        self.counts += other.counts
+        self.count += other.count
+        return self
+    def density(self):
+        """Returns 2D arrays of the long, lat and density at each node"""
+        n = self.count
+        if n == 0: raise InputError('No valid measurements to contour!')
+        if self.method == 'schmidt': units = 0.01 * n
+        else:
+            area = 1 - self.cosRadius
+            units = sqrt(n * area * (1-area))
+        return self.longs, self.lats, self.counts / units
+    def save(self, filename):
+        """Saves to filename (a .npz file), replacing it only once the
+        new file is complete."""
+        temporary = filename + '.tmp'
+        f = open(temporary, 'wb')
+        np.savez(f, counts=self.counts, count=self.count, spacing=self.spacing,
+                 method=self.method, cosRadius=self.cosRadius, version=AccumulatorVersion)
+        f.close()
+        os.rename(temporary, filename)
+    @classmethod
+    def load(cls, filename, options=None, n=0):
+        """Returns the accumulator saved in filename. If filename doesn't
+        exist and options are given, returns a new, empty accumulator
+        for their method and spacing with the counting circle DensityGrid
+        would use for n vectors (or options.expected)."""
+        if not os.path.exists(filename) and options is not None:
+            if options.expected: n = options.expected
+            if n == 0 and options.Density == 'kamb':
+                raise InputError('No valid measurements to start %s with! (Use --expected to start an empty grid)' % filename)
+            cosRadius = DensityParameters(n, options.Density, options.sigma)[0]
+            return cls(options.spacing, options.Density, cosRadius)
+        try:
+            saved = np.load(filename)
+            version = int(saved['version'])
+            if version != AccumulatorVersion:
+                raise InputError('%s is a version %i density grid, not version %i!' % (filename, 
+                            version, AccumulatorVersion))
+            accumulator = cls(float(saved['spacing']), str(saved['method']), float(saved['cosRadius']))
+            accumulator.counts += saved['counts']
+            accumulator.count = int(saved['count'])
+        except (IOError, KeyError, ValueError), error:
+            raise InputError("Can't read density grid %s: %s" % (filename, error))
+        if options is not None and (accumulator.method, accumulator.spacing) != (options.Density, options.spacing):
+            raise InputError('%s is a %s grid every %g degrees, not %s every %g!' % (filename, 
+                        accumulator.method, accumulator.spacing, options.Density, options.spacing))
+        return accumulator
+
+#Format of the files saved by DensityAccumulator
+AccumulatorVersion = 1
+
+def DensityNodes(spacing=2):
+    """Returns 2D arrays of the long and lat of the nodes of a density grid"""
+    nodes = np.arange(-90, 90+spacing/2.0, spacing)
+    return np.meshgrid(nodes, nodes)
+
+def DensityParameters(n, method='kamb', sigma=3):
+    """Returns the cosine of the counting radius, the kernel (None to 
+    count each vector as 1) and the units counts are divided by to
+    contour n vectors with the given method (see DensityGrid)"""
+    sigma = float(sigma)
+    if method == 'kamb':
+        #Counting circle covers sigma^2/(n+sigma^2) of the hemisphere
+        area = sigma**2 / (n + sigma**2)
+        return 1-area, None, sqrt(n * area * (1-area))
+
+    elif method == 'modified-kamb':
+        #Weights fall off exponentially with the cosine of the angle
+        #from the node.  Weights smaller than KernelCutoff are ignored.
+        f = 2 * (1 + n / sigma**2)
+        kernel = lambda cosines: np.exp(f * (cosines - 1))
+        cutoff = max(0.0, 1 + np.log(KernelCutoff) / f)
+        return cutoff, kernel, sqrt(n * (f/2 - 1) / f**2)
+
+    elif method == 'schmidt':
+        #Counting circle covers 1% of the hemisphere
+        return 0.99, None, 0.01 * n
+
+    else: #Shouldn't Happen
+        sys.exit("Invalid density method: %s (This shouldn't happen!) Programming error!" % method)
+
+def CountWithin(longs, lats, vectors, cosRadius, kernel=None):
+    """For each node of a grid with rows of constant lat, sums kernel(c)
+    (or 1 if no kernel is given) over the (axial) unit vectors where c,
+    the absolute value of the cosine of the angle between the vector and
+    the node, is at least cosRadius.  The vectors are sorted by latitude
+    so that each row of nodes is only compared with the vectors that
+    can fall within cosRadius of it (or of its antipode)."""
+    radius = degrees(np.arccos(cosRadius)) + 1e-6
+    vectorLats = np.degrees(np.arcsin(np.clip(vectors[:,2], -1, 1)))
+    order = np.argsort(vectorLats)
+    vectorLats, vectors = vectorLats[order], vectors[order]
+
+    counts = np.zeros(longs.shape)
+    for i in range(longs.shape[0]):
+        lat = lats[i,0]
+        row = np.column_stack(sph2cart(longs[i], lats[i]))
+
+        #--Candidates near the node and near its antipode----
+        near = np.searchsorted(vectorLats, [lat-radius, lat+radius])
+        far = np.searchsorted(vectorLats, [-lat-radius, -lat+radius])
+        if far[0] < near[1] and near[0] < far[1]:
+            ranges = [(min(near[0], far[0]), max(near[1], far[1]))]
+        else:
+            ranges = [near, far]
+
+        #--Compare in blocks to keep memory use bounded-----
+        for start, stop in ranges:
+            for block in range(start, stop, CountBlockSize):
+                end = min(block+CountBlockSize, stop)
+                cosines = np.abs(np.dot(vectors[block:end], row.T))
+                inside = cosines >= cosRadius
+                if kernel is None: counts[i] += inside.sum(axis=0)
+                else:              counts[i] += np.where(inside, kernel(cosines), 0).sum(axis=0)
+    return counts
+
+#Number of vectors compared with a row of grid nodes at once
+CountBlockSize = 1 << 15
+#Smallest weight counted by the modified Kamb method
+KernelCutoff = 1e-6
+
+#--Beta Diagrams------------------------------------------------------------------------
+
+def OutputBeta(poles, options):
+    """Yields the output for the intersections of every pair of the
+    planes whose poles are given by an (n,3) array of unit vectors. The
+    intersections are formatted as lines (one block of pairs at a time)
+    or analyzed as selected by options (once all pairs are done)."""
+    pairs = [(a, b) for a in range(0, len(poles), BetaBlockSize)
+                    for b in range(a, len(poles), BetaBlockSize)]
+    analysis = Analysis(options)
+    if analysis is None:
+        for data in BetaMap(poles, options, pairs): yield data
+        return
+
+    #--Intersections are lines, whatever the input was------
+    options = copy(options)
+    options.PlotType = 'Lines'
+    if analysis == 'Density':
+        #Density units depend on the number of intersections, so count those first
+        n = sum(BetaMap(poles, options, pairs, 'count'))
+        if n == 0: raise InputError('No planes intersect!')
+        longs, lats = DensityNodes(options.spacing)
+        counts = sum(BetaMap(poles, options, pairs, n))
+        yield FormatDensity(longs, lats, counts / DensityParameters(n, options.Density, options.sigma)[2], options)
+    else:
+        summary = None
+        for data in BetaMap(poles, options, pairs):
+            if summary is None: summary = data
+            else:               summary += data
+        yield OutputAnalysis(summary, options)
+
+def BetaMap(poles, options, pairs, stage=None):
+    """Yields the results of BetaBlock for each pair of blocks of poles,
+    in order, using a pool of options.jobs processes if more than one."""
+    tasks = [(a, b, stage) for a, b in pairs]
+    if options.jobs <= 1:
+        SetBetaState(poles, options)
+        for task in tasks: yield BetaBlock(task)
+        return
+    pool = Pool(options.jobs, SetBetaState, (poles, options))
+    try:
+        for result in pool.imap(BetaBlock, tasks): yield result
+        pool.close()
+    finally:
+        pool.terminate()
+
+def SetBetaState(poles, options):
+    """Keeps the poles and options used by BetaBlock (in each process)"""
+    BetaState['poles'], BetaState['options'] = poles, options
+
+#Poles and options used by BetaBlock (sent to each process only once)
+BetaState = {}
+
+def BetaBlock(task):
+    """Intersects the planes in block a with those in block b of the
+    poles in BetaState. Returns the formatted lines of intersection 
+    or, if options select an analysis, their summary (see AnalyzeBlock).
+    If the task's stage is 'count' only the number of intersections 
+    is returned and if it's a number, the density counts at each node
+    for that many intersections in total."""
+    a, b, stage = task
+    poles, options = BetaState['poles'], BetaState['options']
+    lines = Intersections(poles[a:a+BetaBlockSize], poles[b:b+BetaBlockSize], a == b)
+    if stage == 'count': return len(lines)
+    elif stage is not None:
+        cosRadius, kernel, units = DensityParameters(stage, options.Density, options.sigma)
+        longs, lats = DensityNodes(options.spacing)
+        return CountWithin(longs, lats, lines, cosRadius, kernel)
+    elif Analysis(options):
+        return AnalyzeBlock(lines, options)
+
+    #--Formatted like any other lines------------------------
+    #   (there are no headers, so the whole block is formatted at once)
+    if options.Project: X,Y = ProjectVectors(lines, options.Project)
+    else:               X,Y = cart2sph(lines[:,0], lines[:,1], lines[:,2])
+    if options.ReverseXY: pairs = np.column_stack((Y, X))
+    else:                 pairs = np.column_stack((X, Y))
+    if options.Binary or options.npy: return pairs.astype(BinaryType(options)).tostring()
+    if options.Project: outputFormat = '%.4f\t%.4f\n'
+    else:               outputFormat = '%.2f\t%.2f\n'
+    return outputFormat * len(pairs) % tuple(pairs.ravel().tolist())
+
+def Intersections(first, second, same=False):
+    """Returns an (m,3) array of the (lower hemisphere) unit vectors
+    along the intersection of each plane whose pole is in first with
+    each plane whose pole is in second. If first and second are the same
+    block of poles, each pair is only intersected once. (Nearly) parallel
+    planes are skipped."""
+    lines = np.cross(first[:,np.newaxis,:], second[np.newaxis,:,:])
+    if same: lines = lines[np.triu_indices(len(first), 1)]
+    else:    lines = lines.reshape(-1,3)
+    lengths = np.sqrt((lines**2).sum(axis=1))
+    keep = lengths > BetaParallel
+    lines = lines[keep] / lengths[keep][:,np.newaxis]
+    return np.where(lines[:,0:1] < 0, -lines, lines)
+
+#Number of planes intersected with another block of planes at once
+BetaBlockSize = 1024
+#Sine of the smallest angle between planes that are intersected
+BetaParallel = 1e-6
+
+#--Rose Diagrams------------------------------------------------------------------------
+
+class RoseCounts(object):
+    """Number of azimuths in each sector (of width degrees, starting at
+    north) of a rose diagram. Bidirectional roses also count each 
+    azimuth 180 degrees away. Counts of different blocks of data can be
+    added together."""
+    def __init__(self, width=10, bidirectional=True, azimuths=None):
+        self.width, self.bidirectional = float(width), bidirectional
+        self.counts = np.zeros(int(round(360 / self.width)), dtype=np.int64)
+        self.count = 0
+        if azimuths is not None: self.add(azimuths)
+    def add(self, azimuths):
+        #Round off the error from converting the measurements to vectors
+        #   and back so that e.g. a strike of 60 stays in the 60-70 sector
+        azimuths = np.round(np.asarray(azimuths, dtype=float), 9)
+        n = len(self.counts)
+        if self.bidirectional and n % 2: azimuths = np.concatenate((azimuths, azimuths + 180))
+        sectors = (np.floor(np.mod(azimuths, 360) / self.width).astype(int)) % n
+        if self.bidirectional and not n % 2: sectors = np.concatenate((sectors, (sectors + n//2) % n))
+        self.counts += np.bincount(sectors, minlength=n)
+        self.count += len(sectors)
+        return self
+    def __iadd__(self, other):
+        self.counts += other.counts
+        self.count += other.count
+        return self
+
+def RoseAzimuths(vectors, options):
+    """Returns the strikes of the planes whose poles are (for --planes)
+    or the trends of the lines given by an (n,3) array of unit vectors"""
+    if options.PlotType.capitalize() == 'Planes': return VectorsToPlanes(vectors)[0]
+    return VectorsToLines(vectors)[1]
+
+def OutputRose(rose, options):
+    """Returns the sectors of a RoseCounts as GMT multisegment polygons 
+    of x, y (east, north) pairs, scaled so that the longest petal has 
+    a radius of 1."""
+    if rose.count == 0: raise InputError('No valid measurements to count!')
+    radii = rose.counts / float(rose.counts.max())
+    if options.area: radii = np.sqrt(radii)
+
+    if rose.bidirectional: output = ['# n\t%i\n' % (rose.count // 2)]
+    else:                  output = ['# n\t%i\n' % rose.count]
+    steps = int(np.ceil(rose.width / RoseArcStep))
+    for i in np.flatnonzero(rose.counts):
+        start = i * rose.width
+        arc = np.radians(np.linspace(start, start + rose.width, steps + 1))
+        X = np.concatenate(([0], radii[i] * np.sin(arc), [0]))
+        Y = np.concatenate(([0], radii[i] * np.cos(arc), [0]))
+        if options.ReverseXY: X,Y = Y,X
+        output.append('> %g-%g %i\n' % (start, start + rose.width, rose.counts[i]))
+        output.append('%.4f\t%.4f\n' * len(X) % tuple(np.column_stack((X, Y)).ravel()))
+    return ''.join(output)
+
+#Largest angle (in degrees) between vertices along the arc of a petal
+RoseArcStep = 1
+
+#--Raster Output------------------------------------------------------------------------
+
+class RasterCounts(object):
+    """Number of unit vectors falling in each pixel of a square grid of
+    pixels by pixels covering a projected net (see ProjectVectors) with
+    a radius of 1. counts[0] is the southern row of pixels. Counts of 
+    different blocks of data can be added together."""
+    def __init__(self, pixels=512, projection='schmidt', vectors=None):
+        self.pixels, self.projection = pixels, projection
+        self.counts = np.zeros((pixels, pixels), dtype=np.int64)
+        self.count = 0
+        if vectors is not None: self.add(vectors)
+    def add(self, vectors):
+        X,Y = ProjectVectors(np.asarray(vectors, dtype=float).reshape(-1,3), self.projection)
+        columns = np.clip(((X+1) * self.pixels/2.0).astype(int), 0, self.pixels-1)
+        rows = np.clip(((Y+1) * self.pixels/2.0).astype(int), 0, self.pixels-1)
+        counts = np.bincount(rows*self.pixels + columns, minlength=self.pixels**2)
+        self.counts += counts.reshape(self.pixels, self.pixels)
+        self.count += len(X)
+        return self
+    def __iadd__(self, other):
+        self.counts += other.counts
+        self.count += other.count
+        return self
+    def centers(self):
+        """Returns the x (and y) coordinates of the centers of the pixels"""
+        return (np.arange(self.pixels) + 0.5) * 2.0/self.pixels - 1
+    def outside(self):
+        """Returns a boolean array that's True for pixels whose centers
+        are outside the net."""
+        x = self.centers()
+        return (x[np.newaxis,:]**2 + x[:,np.newaxis]**2) > 1
+
+def OutputRaster(raster, options):
+    """Returns a RasterCounts as a PNG image or NetCDF grid (a string 
+    of bytes) depending on options.Raster"""
+    if raster.count == 0: raise InputError('No valid measurements to render!')
+    counts = raster.counts.astype(float)
+    outside = raster.outside()
+    if options.Raster == 'grid':
+        counts[outside] = np.nan
+        x = raster.centers()
+        return PackNetCDF(x, x, counts, 'count')
+
+    #--Colors, north at the top and transparent outside the net
+    colors = Colorize(counts / max(counts.max(), 1), options.cmap)
+    alpha = np.where(outside, 0, 255).astype(np.uint8)
+    return PackPNG(np.dstack((colors, alpha))[::-1])
+
+def Colorize(values, cmap='viridis'):
+    """Returns an (..., 3) array of 8-bit RGB colors for values between 
+    0 and 1, interpolated between the colors of Colormaps[cmap]"""
+    table = np.array(Colormaps[cmap], dtype=float)
+    stops = np.linspace(0, 1, len(table))
+    values = np.clip(values, 0, 1)
+    rgb = [np.interp(values, stops, table[:,i]) for i in range(3)]
+    return np.round(np.dstack(rgb)).astype(np.uint8).reshape(values.shape + (3,))
+
+#Colors (lowest to highest) available for --cmap
+Colormaps = {'viridis':[(68,1,84), (59,82,139), (33,145,140), (94,201,98), (253,231,37)],
+             'hot':[(255,255,255), (255,255,0), (255,0,0), (128,0,0), (0,0,0)],
+             'gray':[(255,255,255), (0,0,0)]}
+
+def PackPNG(rgba):
+    """Returns a (rows, columns, 4) array of 8-bit RGBA pixels (top row 
+    first) as a PNG image."""
+    rgba = np.ascontiguousarray(rgba, dtype=np.uint8)
+    height, width = rgba.shape[:2]
+    #Each row starts with a filter type byte (0 = none)
+    rows = np.hstack((np.zeros((height,1), dtype=np.uint8), rgba.reshape(height, -1)))
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data + 
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    return ('\x89PNG\r\n\x1a\n' +
+            chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) +
+            chunk('IDAT', zlib.compress(rows.tostring(), 6)) +
+            chunk('IEND', ''))
+
+def PackNetCDF(x, y, z, name='z'):
+    """Returns a 2D array z (rows of constant y) with coordinates x 
+    and y as a NetCDF (classic format) grid that GMT can read."""
+    x = np.asarray(x, dtype='>f8')
+    y = np.asarray(y, dtype='>f8')
+    z = np.asarray(z, dtype='>f4')
+    def string(text):
+        return struct.pack('>i', len(text)) + text + '\0'*(-len(text) % 4)
+    def attributes(attrs):
+        if not attrs: return struct.pack('>ii', 0, 0)
+        packed = struct.pack('>ii', NCAttribute, len(attrs))
+        for key, value in attrs:
+            packed += string(key)
+            if isinstance(value, str): packed += struct.pack('>i', NCChar) + string(value)
+            elif isinstance(value, int): packed += struct.pack('>iii', NCInt, 1, value)
+            else:
+                value = np.atleast_1d(value).astype('>f8')
+                packed += struct.pack('>ii', NCDouble, len(value)) + value.tostring()
+        return packed
+
+    #--Dimensions, then variables: (name, dimension ids, attributes, type, data)
+    dimensions = [('x', len(x)), ('y', len(y))]
+    def extent(centers): #Including the outer half of the edge pixels
+        half = (centers[-1] - centers[0]) / max(len(centers)-1, 1) / 2.0
+        return (centers[0] - half, centers[-1] + half)
+    variables = [('x', [0], [('long_name','x'), ('actual_range',extent(x))], NCDouble, x),
+                 ('y', [1], [('long_name','y'), ('actual_range',extent(y))], NCDouble, y),
+                 (name, [1,0], [('long_name',name), ('actual_range',(np.nanmin(z), np.nanmax(z)))], NCFloat, z)]
+    header = 'CDF\x01' + struct.pack('>i', 0)
+    header += struct.pack('>ii', NCDimension, len(dimensions))
+    for dimension, size in dimensions: header += string(dimension) + struct.pack('>i', size)
+    header += attributes([('Conventions', 'COARDS'), ('node_offset', 1)]) #Pixel registered
+
+    #--Offsets of the data depend on the size of the header itself
+    def variableList(begin):
+        packed = struct.pack('>ii', NCVariable, len(variables))
+        for var, dims, attrs, kind, data in variables:
+            size = data.nbytes + (-data.nbytes % 4)
+            packed += string(var) + struct.pack('>i', len(dims)) + struct.pack('>%ii' % len(dims), *dims)
+            packed += attributes(attrs) + struct.pack('>iii', kind, size, begin)
+            begin += size
+        return packed
+    begin = len(header) + len(variableList(0))
+    output = [header, variableList(begin)]
+    for var, dims, attrs, kind, data in variables:
+        output.append(data.tostring() + '\0'*(-data.nbytes % 4))
+    return ''.join(output)
+
+#NetCDF classic format tags and types
+NCDimension, NCVariable, NCAttribute = 10, 11, 12
+NCChar, NCInt, NCFloat, NCDouble = 2, 4, 5, 6
 
-    return output+'\n'
 
 #---------------------------------------------------------------------------------------    
 #--Parsing Functions--------------------------------------------------------------------
@@ -387,78 +2455,51 @@ def ParsePlanes(measurement):
     or 78/9S) and returns a strike and a dip 
     tuple following the right hand rule"""
 
-    #--Read input and split into strike and dip---------------
-    #   This part is repeated in other functions, need to refactor...
-    pair = measurement.split('/')
-    if len(pair) != 2:
-        raise InputError("Too many or too few /'s!")
-    strikestring,dipstring = pair
-
-    #Get Letters from End Indicating Dip Direction
-    (dip,dipdir) = GetDir(dipstring)
-
-    #Parse strike portion
-    if strikestring[0].isalpha(): #Then it's a quadrant measurement
-        strike = ParseQuadrant(strikestring)
-    else:
-        try: strike = float(strikestring)
-        except: raise InputError("Can't convert %s to a number!" % strikestring)
+    #--Has this exact measurement been parsed already?--------
+    result = PlaneCache.get(measurement)
+    if result is not None: return result
 
+    #--Read input and split into strike and dip---------------
+    token = PlaneToken.match(measurement)
+    if token is None:
+        raise InputError("%s is not a valid strike/dip! (e.g. 330/42W, 150/42, N30E/20NW)" % measurement)
+    strike = TokenBearing(token)
+    try: dip = float(token.group('dip'))
+    except ValueError: raise InputError("Can't convert %s to a number!" % token.group('dip'))
+    dipdir = token.group('dir').upper()
 
     #--Does this measurement follow the Right Hand Rule?-------
-
-    #Directions that follow RHR for each quadrant
-    #Remember that this is the _dip_ direction, not the strike itself
-    Directions = {'I':['S','E','SE'], \
-                 'II':['S','W','SW'], \
-                'III':['N','W','NW'], \
-                 'IV':['N','E','NE']}
-
     quad = FindQuadrant(strike)
-    if dipdir not in Directions[quad] and dipdir: #In case of empty string, assume RHR
+    if dipdir not in RHRDipDirections[quad] and dipdir: #In case of empty string, assume RHR
         #Not RHR, so get the opposite end
         strike = strike-180
         if strike < 0:
             strike = strike+360
 
-    return (strike,dip)
+    result = PlaneCache[measurement] = (strike,dip)
+    return result
 
 def ParseLines(input):
     """Takes an input string of the form plunge/bearing 
     (e.g. 10/330S, 20/95, 25/95W) and returns the bearing
     and plunge of the measurement as floats."""
 
-    #--Read input and split into plunge and bearing----------
-    portions = input.split('/')
-    if len(portions) != 2: raise InputError("Too many or too few /'s!")
-    plungeStr, bearingStr = portions
-
+    #--Has this exact measurement been parsed already?--------
+    result = LineCache.get(input)
+    if result is not None: return result
 
-    #--Decide what type of measurement we're dealing with----
-    
-    #Remove trailing whitespace and internal spaces 
-    #  (e.g. make "N30E NW\n" --> N30ENW)
-    bearingStr = bearingStr.strip().split()
-    bearingStr = ''.join(bearingStr)
-
-    #Do we start with a letter? (if so it's a quadrant measurement)
-    if bearingStr[0].isalpha():    
-        try:  #length of a quadrant measurement must be 3 or 4!
-            if bearingStr[2].isalpha(): #e.g. N9E
-                bearing = ParseQuadrant(bearingStr[0:3]) 
-                plungeDir = bearingStr[3:]
-            else: #e.g. N39E
-                bearing = ParseQuadrant(bearingStr[0:4]) 
-                plungeDir = bearingStr[4:]
-        except IndexError:
-            raise InputError("%s is not a valid quadrant measurement!" % bearingStr)
-
-    #Not a quadrant, deal with it normally.
-    else: (bearing, plungeDir) = GetDir(bearingStr)
+    #--Read input and split into plunge and bearing----------
+    #   The bearing may be an azimuth or a quadrant measurement
+    #   (e.g. 23/E30N SW or 10/330S)
+    token = LineToken.match(input)
+    if token is None:
+        raise InputError("%s is not a valid plunge/bearing! (e.g. 25/200N, 20/025, 23/E30N SW)" % input)
+    bearing = TokenBearing(token)
+    plungeDir = token.group('dir').upper()
 
     #--Float conversions-------------------------------------
-    try: plunge = float(plungeStr)
-    except: raise InputError("Can't convert %s to a number!" % plungeStr)
+    try: plunge = float(token.group('plunge'))
+    except ValueError: raise InputError("Can't convert %s to a number!" % token.group('plunge'))
 
     #--Sanity Check------------------------------------------
     if (bearing>360) or (bearing<0) or (plunge>90) or (plunge<0):
@@ -470,7 +2511,8 @@ def ParseLines(input):
         bearing = bearing-180
         if bearing < 0: bearing += 360
 
-    return (bearing,plunge)
+    result = LineCache[input] = (bearing,plunge)
+    return result
 
 def ParseRakes(input):
     """Takes an input string of the from "strike/dip plunge"
@@ -480,18 +2522,23 @@ def ParseRakes(input):
     the plane the would result from following the RHR based
     on the dip of the plane."""
 
+    #--Has this exact measurement been parsed already?--------
+    result = RakeCache.get(input)
+    if result is not None: return result
+
     #--Read input and split into portions--------------------
     #Seperate S/D from rake angle (seperated by whitespace)
-    portions = input.strip().split()
-    if len(portions)!= 2: #Needs to be changed.  Get last characters instead of splitting by whitespace
-        raise InputError("Too many or too few parts of %s seperated by whitespace" % input)
-    SD,rakeStr = portions
+    token = RakeToken.match(input)
+    if token is None:
+        raise InputError("%s is not a valid rake! (e.g. 330/42W 22N, 150/42 30)" % input)
 
     #Treat the S/D of plane like any other
-    strike,dip = ParsePlanes(SD)
+    strike,dip = ParsePlanes(token.group('plane'))
 
     #Get the rake angle and direction
-    rake,rakeDir = GetDir(rakeStr)
+    try: rake = float(token.group('rake'))
+    except ValueError: raise InputError("Can't convert %s to a number!" % token.group('rake'))
+    rakeDir = token.group('dir').upper()
 
     #--Sanity check-----------------------------------------
     if (rake > 90) | (rake < 0):
@@ -500,42 +2547,100 @@ def ParseRakes(input):
     #--Do we need the opposite end?-------------------------
     if not isSameEnd(strike,rakeDir): rake = -rake
     
-    return (strike,dip,rake)
-
-def ParseQuadrant(strikestring):
-    """Takes an input string with a quadrant strike 
-    measurement (e.g. N40W instead of 320) and returns
-    an azimuth strike as a float."""
+    result = RakeCache[input] = (strike,dip,rake)
+    return result
 
-    #--Seperate into portions--------------------------
-    first_dir= strikestring[0].upper() #First letter
-    sec_dir = strikestring[-1].upper() #Last letter
-    angle = strikestring[1:-1]         #Everything in between
-
-    #--Try converting angle to a float----------------
-    try: angle=float(angle)
-    except: raise InputError("%s is not a valid strike. Can't convert %s to a number!" % (strikestring, angle) )
+def QuadrantAzimuth(first_dir, angle, sec_dir, strikestring):
+    """Returns the azimuth of a quadrant measurement given its first
+    letter, angle, and last letter. strikestring is only used for
+    error messages."""
 
     #--Sanity checks----------------------------------
-    valid_dir = ['NE','NW','SE','SW','EN','WN','WS','ES']  
     letters = first_dir + sec_dir
-
-    if (angle<0) or (angle>90) or (letters not in valid_dir):
+    if (angle<0) or (angle>90) or (letters not in QuadrantSigns):
         raise InputError('%s is not a valid quadrant-format strike!' % strikestring)
-    
-    #--Starting angles for each direction-------------
-    start = {'N':0, 'S':180, 'E':90, 'W':270}
 
     #--Do we need to add or subtract angle from first_dir?
-    if letters in ['NE','SW','WN','ES']: 
-        strike = start[first_dir] + angle
-    else: 
-        strike = start[first_dir] - angle
+    strike = QuadrantStart[first_dir] + QuadrantSigns[letters]*angle
+
     #--Make positive for NxxW measurements-----------
     if strike<0: strike += 360
 
     return strike
 
+def TokenBearing(token):
+    """Returns the strike or bearing held in a match object from one
+    of the compiled measurement patterns as an azimuth."""
+    azimuth = token.group('azimuth')
+    if azimuth is not None:
+        try: return float(azimuth)
+        except ValueError: raise InputError("Can't convert %s to a number!" % azimuth)
+
+    #Quadrant measurement
+    angle = token.group('angle')
+    try: angle = float(angle)
+    except ValueError: raise InputError("Can't convert %s to a number!" % angle)
+    first, last = token.group('first').upper(), token.group('last').upper()
+    return QuadrantAzimuth(first, angle, last, first+token.group('angle')+last)
+
+#--Compiled measurement patterns---------------------------
+#   A bearing is either an azimuth (e.g. 045) or a quadrant
+#   measurement (e.g. N45E, S 10 W) and may be followed by
+#   a direction (e.g. 045/55W or 23/E30N SW)
+Number = r'[-+]?(?:\d+\.?\d*|\.\d+)'
+Bearing = r'(?:(?P<first>[NSEW])\s*(?P<angle>%s)\s*(?P<last>[NSEW])|(?P<azimuth>%s))' % (Number, Number)
+Direction = r'\s*(?P<dir>[NSEW]{0,2})\s*$'
+PlaneToken = re.compile(r'^\s*%s\s*/\s*(?P<dip>%s)%s' % (Bearing, Number, Direction), re.I)
+LineToken  = re.compile(r'^\s*(?P<plunge>%s)\s*/\s*%s%s' % (Number, Bearing, Direction), re.I)
+RakeToken  = re.compile(r'^\s*(?P<plane>\S+)\s+(?P<rake>%s)%s' % (Number, Direction), re.I)
+
+#--Lookup tables-------------------------------------------
+#Directions that follow RHR for each quadrant
+#Remember that this is the _dip_ direction, not the strike itself
+RHRDipDirections = {'I':('S','E','SE'), 'II':('S','W','SW'),
+                  'III':('N','W','NW'), 'IV':('N','E','NE')}
+#Correct end of line for each quadrant
+LineEndDirections = {'I':('N','E','NE'), 'II':('S','E','SE'),
+                   'III':('S','W','SW'), 'IV':('N','W','NW')}
+#Starting angles for each direction and whether the angle of a quadrant
+#measurement is added to (+1) or subtracted from (-1) it
+QuadrantStart = {'N':0, 'S':180, 'E':90, 'W':270}
+QuadrantSigns = {'NE':1, 'SW':1, 'WN':1, 'ES':1, 'NW':-1, 'SE':-1, 'EN':-1, 'WS':-1}
+#Direction letters for each quad (used by CleanInput)
+LineDir = {'I':'NE', 'II':'SE', 'III':'SW', 'IV':'NW'} #Same quad as end of line
+DipDir =  {'I':'SE', 'II':'SW', 'III':'NW', 'IV':'NE'} #Dip dir following RHR
+
+#--Parsed measurements-------------------------------------
+#   Field data tends to repeat the same few measurements, so
+#   the results of parsing each string are kept around.
+ParseCacheSize = 100000
+
+class LRUCache(object):
+    """A dictionary with a maximum size. When it's full, the least
+    recently used item is discarded to make room for a new one."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+    def get(self, key, default=None):
+        try: value = self.items.pop(key)
+        except KeyError: return default
+        self.items[key] = value #Move to the most recently used end
+        return value
+    def __setitem__(self, key, value):
+        self.items.pop(key, None)
+        if len(self.items) >= self.maxsize: self.items.popitem(last=False)
+        self.items[key] = value
+    def __len__(self):
+        return len(self.items)
+    def clear(self):
+        self.items.clear()
+
+PlaneCache = LRUCache(ParseCacheSize)
+LineCache = LRUCache(ParseCacheSize)
+RakeCache = LRUCache(ParseCacheSize)
+GreatCircleCache = LRUCache(GreatCircleCacheSize)
+
+
 #---------------------------------------------------------------------------------------    
 #--Various Utility Functions------------------------------------------------------------
 #---------------------------------------------------------------------------------------    
@@ -546,58 +2651,187 @@ def Rotate(longs,lats,strike,dip=0):
     (in degrees) for the coords to be rotated to. Optionally, a
     dip angle may be specified. (usually to rotate measurements
     back to horizontal)"""
-
-    #--Simplified rotation matrices---------------------
-    def XAxisRotate(x,y,z,theta):
-        X = x
-        Y = y*cos(theta) + z*sin(theta)
-        Z = -y*sin(theta) + z*cos(theta)
-        return X,Y,Z
-    def ZAxisRotate(x,y,z,omega):
-        X = x*cos(omega) + y*sin(omega)
-        Y = -x*sin(omega) + y*cos(omega)
-        Z = z
-        return X,Y,Z
-
-    #--Rotate data--------------------------------------
-    #-Convert to radians
-    theta = radians(strike)
-    omega = radians(dip)
-
-    #-Convert to cartesian and rotate
-    X,Y = [],[]
-    for lon,lat in zip(longs,lats):
-        #Rotate around center: lon=0,lat=0 (X-axis)
-        x,y,z = sph2cart(lon,lat)
-        x,y,z = XAxisRotate(x,y,z,theta)
-
-        #Are we rotating back to horizontal? ("unfolding")
-        #if so, rotate around north pole (Z-axis)
-        if dip != 0:  x,y,z = ZAxisRotate(x,y,z,omega)
-
-        #Back to lat,long and add to coordinate list
-        rotLon,rotLat = cart2sph(x,y,z)
-        X.append(rotLon)
-        Y.append(rotLat)
-
-    return X,Y
+    X,Y = RotateArrays([longs], [lats], [strike], [dip])
+    return X[0].tolist(), Y[0].tolist()
+
+def RotateArrays(longs,lats,strikes,dips=0):
+    """Vectorized version of Rotate. Takes arrays of longs and
+    lats with one row per measurement (either a single point or
+    a row of vertices per measurement) and arrays of the strike
+    and (optionally) dip to rotate each row by. Returns arrays of
+    the rotated longs and lats with the same shape as the input."""
+    longs, lats = np.broadcast_arrays(np.asarray(longs, dtype=float),
+                                      np.asarray(lats, dtype=float))
+    shape = longs.shape
+
+    #-Convert to cartesian and rotate everything with one matrix product
+    xyz = np.dstack(sph2cart(longs.reshape(shape[0],-1), lats.reshape(shape[0],-1)))
+    xyz = RotateVectors(xyz, RotationMatrices(strikes, dips))
+
+    #Back to lat,long
+    X,Y = cart2sph(xyz[...,0], xyz[...,1], xyz[...,2])
+    return X.reshape(shape), Y.reshape(shape)
+
+def RotationMatrices(strikes,dips=0):
+    """Returns an array of 3x3 rotation matrices, one for each
+    strike (and dip) given. Each matrix rotates around the X-axis
+    (lon=0,lat=0) by the strike and then, if a dip is given, around
+    the Z-axis (north pole) by the dip."""
+    theta = np.radians(np.atleast_1d(np.asarray(strikes, dtype=float)))
+    omega = np.radians(np.asarray(dips, dtype=float)) * np.ones_like(theta)
+    ct, st = np.cos(theta), np.sin(theta)
+    co, so = np.cos(omega), np.sin(omega)
+
+    #--Z-axis rotation (by dip) times X-axis rotation (by strike)--
+    R = np.zeros(theta.shape + (3,3))
+    R[...,0,0], R[...,0,1], R[...,0,2] =  co, so*ct, so*st
+    R[...,1,0], R[...,1,1], R[...,1,2] = -so, co*ct, co*st
+    R[...,2,1], R[...,2,2]             = -st, ct
+    return R
+
+def RotateAboutAxes(longs, lats, plunges, bearings, angles):
+    """Like RotateArrays, but rotates each row of longs and lats by 
+    an angle (in degrees, clockwise looking down the axis) around an
+    axis given by its plunge and bearing."""
+    longs, lats = np.broadcast_arrays(np.asarray(longs, dtype=float),
+                                      np.asarray(lats, dtype=float))
+    shape = longs.shape
+    xyz = np.dstack(sph2cart(longs.reshape(shape[0],-1), lats.reshape(shape[0],-1)))
+    xyz = RotateVectors(xyz, QuaternionMatrices(AxisQuaternions(plunges, bearings, angles)))
+    X,Y = cart2sph(xyz[...,0], xyz[...,1], xyz[...,2])
+    return X.reshape(shape), Y.reshape(shape)
+
+def AxisQuaternions(plunges, bearings, angles):
+    """Returns an (n,4) array of unit quaternions (w,x,y,z) that rotate
+    <x,y,z> vectors by each angle (in degrees, clockwise looking down 
+    the axis) around the axis with each plunge and bearing."""
+    plunges, bearings, angles = np.broadcast_arrays(*[np.atleast_1d(
+                            np.asarray(value, dtype=float)) for value in (plunges, bearings, angles)])
+    axes = LineVectors(plunges, bearings)
+    angles = np.radians(angles)
+    #--The usual quaternion (cos(angle/2), sin(angle/2)*axis) turns
+    #   counterclockwise looking down the axis, so the angle is negated
+    return np.column_stack([np.cos(angles/2), -np.sin(angles/2)[:,np.newaxis]*axes])
+
+def LineVectors(plunges, bearings):
+    """Returns an (n,3) array of the <x,y,z> unit vectors of the lines
+    with the given plunges and bearings (the inverse of VectorsToLines)"""
+    plunges = np.radians(np.atleast_1d(np.asarray(plunges, dtype=float)))
+    bearings = np.radians(np.atleast_1d(np.asarray(bearings, dtype=float)))
+    return np.column_stack(np.broadcast_arrays(np.sin(plunges), np.cos(plunges)*np.sin(bearings), 
+                                               np.cos(plunges)*np.cos(bearings)))
+
+def MultiplyQuaternions(first, second):
+    """Returns the products of two (n,4) arrays of quaternions, which
+    rotate by second and then by first (as with matrices)."""
+    w1, x1, y1, z1 = np.moveaxis(np.asarray(first, dtype=float), -1, 0)
+    w2, x2, y2, z2 = np.moveaxis(np.asarray(second, dtype=float), -1, 0)
+    return np.stack([w1*w2 - x1*x2 - y1*y2 - z1*z2,
+                     w1*x2 + x1*w2 + y1*z2 - z1*y2,
+                     w1*y2 - x1*z2 + y1*w2 + z1*x2,
+                     w1*z2 + x1*y2 - y1*x2 + z1*w2], axis=-1)
+
+def ComposeRotations(*quaternions):
+    """Returns the quaternions that rotate by each of the given arrays
+    of quaternions in turn (the first one first)"""
+    total = quaternions[0]
+    for quaternion in quaternions[1:]: total = MultiplyQuaternions(quaternion, total)
+    return total
+
+def QuaternionMatrices(quaternions):
+    """Returns an array of the 3x3 rotation matrices (for RotateVectors)
+    of an (n,4) array of unit quaternions"""
+    w, x, y, z = np.moveaxis(np.asarray(quaternions, dtype=float), -1, 0)
+    R = np.empty(w.shape + (3,3))
+    R[...,0,0], R[...,0,1], R[...,0,2] = 1-2*(y*y+z*z), 2*(x*y-w*z), 2*(x*z+w*y)
+    R[...,1,0], R[...,1,1], R[...,1,2] = 2*(x*y+w*z), 1-2*(x*x+z*z), 2*(y*z-w*x)
+    R[...,2,0], R[...,2,1], R[...,2,2] = 2*(x*z-w*y), 2*(y*z+w*x), 1-2*(x*x+y*y)
+    return R
+
+def RotateVectors(xyz, matrices):
+    """Rotates an array of <x,y,z> vectors with shape (n,m,3) or
+    (n,3) by an array of n rotation matrices, one per row."""
+    xyz = np.asarray(xyz, dtype=float)
+    if xyz.ndim == 2: return RotateVectors(xyz[:,np.newaxis,:], matrices)[:,0,:]
+    return np.matmul(xyz, np.swapaxes(matrices, -1, -2))
+
+def FoldHemisphere(longs, lats):
+    """Returns copies of longs and lats with any points in the upper
+    hemisphere replaced by the opposite end of the line."""
+    longs = np.array(longs, dtype=float)
+    lats = np.array(lats, dtype=float)
+    upper = longs > 90
+    lower = longs < -90
+    longs[upper] -= 180
+    longs[lower] += 180
+    lats[upper | lower] *= -1
+    return longs, lats
+
+def VectorsToLines(xyz):
+    """Returns arrays of the plunge and bearing (in degrees) of the
+    lines given by an (n,3) array of <x,y,z> vectors. Vectors pointing
+    into the upper hemisphere are replaced by the opposite end of the
+    line. (The same conventions as InvertGeographic)"""
+    xyz = np.asarray(xyz, dtype=float)
+    xyz = np.where(xyz[:,0:1] < 0, -xyz, xyz)
+    x,y,z = xyz[:,0], xyz[:,1], xyz[:,2]
+    bearing = np.degrees(np.arctan2(z,y))                  #Bearing will be in y-z plane
+    plunge = np.degrees(np.arctan2(x, np.sqrt(y**2 + z**2))) #Plunge is the angle btw the line and the y-z plane
+
+    #--Rotate so that 0 is north, not east
+    bearing = 90-bearing
+    with np.errstate(invalid='ignore'): bearing[bearing<0] += 360
+    return plunge, bearing
+
+def VectorsToPlanes(xyz):
+    """Returns arrays of the strike and dip (in degrees, following
+    the RHR) of the planes whose poles are given by an (n,3) array
+    of <x,y,z> vectors."""
+    plunge, bearing = VectorsToLines(xyz)
+    strike = bearing+90
+    dip = 90-plunge
+    with np.errstate(invalid='ignore'): strike[strike>360] -= 360
+    return strike, dip
+
+def ProjectVectors(xyz, projection='schmidt'):
+    """Returns arrays of the x, y coordinates of an array of <x,y,z>
+    unit vectors (with shape (..., 3)) on a lower hemisphere net with
+    a radius of 1 using an equal-area ('schmidt') or equal-angle 
+    ('wulff') projection. x is east and y is north, as in a -JA
+    projection of stereonet's usual long, lat output. Vectors pointing
+    into the upper hemisphere are replaced by the opposite end of 
+    the line."""
+    xyz = np.asarray(xyz, dtype=float)
+    flip = np.where(xyz[...,0] < 0, -1.0, 1.0)
+    x, y, z = flip*xyz[...,0], flip*xyz[...,1], flip*xyz[...,2]
+
+    #--Distance from the center is sqrt(2)*sin(angle/2) (scaled 
+    #  to a radius of 1) or tan(angle/2) from the center (x-axis)
+    if projection == 'schmidt':  scale = 1 / np.sqrt(1 + x)
+    elif projection == 'wulff':  scale = 1 / (1 + x)
+    else: #Shouldn't Happen
+        sys.exit("Invalid projection: %s (This shouldn't happen!) Programming error!" % projection)
+    return y*scale, z*scale
 
 #--Conversions btw cartesian & spherical-------------
 def sph2cart(lon, lat): 
     """Converts a long, lat pair in degrees to cartesian 
-    coordinates <x,y,z> assuming a radius of 1."""
-    lat, lon = radians(lat), radians(lon)
-    x = cos(lat)*cos(lon)
-    y = cos(lat)*sin(lon)
-    z = sin(lat)
+    coordinates <x,y,z> assuming a radius of 1. Works
+    with either scalars or arrays."""
+    lat, lon = np.radians(lat), np.radians(lon)
+    x = np.cos(lat)*np.cos(lon)
+    y = np.cos(lat)*np.sin(lon)
+    z = np.sin(lat)
     return x,y,z
 def cart2sph(x,y,z): 
     """Converts a <x,y,z> triplet to spherical coordinates.
-    Returns long, lat in degrees."""
-    r = sqrt(x*x + y*y + z*z)
-    lat = asin(z/r)
-    lon = atan2(y,x)
-    return degrees(lon),degrees(lat)
+    Returns long, lat in degrees. Works with either scalars
+    or arrays."""
+    r = np.sqrt(x*x + y*y + z*z)
+    lat = np.arcsin(np.clip(z/r, -1, 1))
+    lon = np.arctan2(y,x)
+    return np.degrees(lon),np.degrees(lat)
+
 
 
 def FindQuadrant(strike):
@@ -638,41 +2872,6 @@ def FindEnd(strike):
 
     return (pole_lon,pole_lat)
 
-def GetDir(dipstring):
-    """Given a string with a number and a direction,
-    (e.g. 45N or 52NW) return the string indicating
-    the direction and the string indicating the angle."""
-
-    #Note, this is used for both dips and strikes.
-    #Don't put a sanity check 0<dip<90!
-
-    #--Strip trailing chars
-    dipstring = dipstring.strip()
-
-    #--Get Letters from End Indicating Dip Direction
-    if dipstring[-2:].isalpha(): #One Letter
-        #e.g. 340/45NE
-        dipdir = dipstring[-2:]
-        dip = dipstring[0:-2].strip()
-
-    elif dipstring[-1:].isalpha(): #Two Letters
-        #e.g. 340/45E or 340/45N
-        dipdir = dipstring[-1:]
-        dip = dipstring[0:-1].strip()
-
-    else: #Just dip, no direction
-        #Assume RHR (e.g. 340/45)
-        dipdir = ''
-        dip = dipstring.strip()
-    
-    try: dip = float(dip)
-    except: raise InputError("%s is not a valid dip.  Can't convert %s to a number!" % (dipstring, dip) )
-   
-    #--Captialize dipdir for easier checking
-    dipdir = dipdir.upper()
-
-    return (dip, dipdir)
-
 def isSameEnd(bearing,plungeDir):
     """Checks to see if the plungeDir matches the bearing
     given.  plungeDir is a string, bearing is a float.
@@ -681,14 +2880,9 @@ def isSameEnd(bearing,plungeDir):
 
     quad = FindQuadrant(bearing)
 
-    #Correct end of line for each quadrant
-    Directions = {'I':['N','E','NE'], \
-                 'II':['S','E','SE'],\
-                'III':['S','W','SW'],\
-                 'IV':['N','W','NW']}
     #Is the direction given opposite the bearing?
     if plungeDir:
-        same_end = plungeDir in Directions[quad]
+        same_end = plungeDir in LineEndDirections[quad]
     else:
         #Empty string, assume they're the same. This is deliberate
         same_end = True
@@ -699,7 +2893,9 @@ def isSameEnd(bearing,plungeDir):
 #--Error Classes----------------------------------------------------------------
 class InputError(Exception):
     """Exception raised for errors in input format."""
-    def __init__(self, message):   self.message = message
+    def __init__(self, message):
+        Exception.__init__(self, message) #So it can be pickled by --jobs
+        self.message = message
     def __str__(self):             return self.message
 
 #-------------------------------------------------------------------------------
@@ -0,0 +1,306 @@
+#! /usr/bin/python
+"""stereonet_bench: Times stereonet on reproducible synthetic data.
+
+Generates random measurements in each notation stereonet accepts and
+times OutputXY (one line at a time and in blocks), InvertGeographic,
+CleanInput and the whole command line pipeline (main) for each number
+of rows requested.  Rows per second and the peak resident memory of
+each run are written as JSON so the results of different commits can
+be compared with --compare.
+
+Provided under an MIT-style license.
+"""
+__license__   = "MIT License <http://http://www.opensource.org/licenses/mit-license.php>"
+
+
+#-------------------------------------------------------------------------
+#--Try to import modules--------------------------------------------------
+#-------------------------------------------------------------------------
+import sys, os, time, json, platform, subprocess, tempfile
+from collections import OrderedDict
+from multiprocessing import Process, Queue
+from optparse import OptionParser
+try:
+    import resource
+except ImportError:
+    resource = None #Not available on windows, peak memory won't be reported
+import numpy as np
+
+import stereonet
+
+
+#----------------------------------------------------------------------------------
+#--Option Handling-----------------------------------------------------------------
+#----------------------------------------------------------------------------------
+
+def main(argv):
+    """Parse arguments and run the benchmarks"""
+    usage = "usage: %prog [-o outfile] [-s sizes] [-b benchmarks] [-n notations] [-c old.json]"
+    description = """Benchmarks stereonet on synthetic data. Each
+    benchmark is run in a new process so that its peak memory use can
+    be measured. Writes JSON results to stdout or OUTFILE and, with
+    --compare, the ratio of each rate to a previous run."""
+    description = description.replace('    ','') #Strip out spaces for better display
+
+    parser = OptionParser(usage=usage, description=description)
+    parser.add_option("-o", "--output", dest="output",\
+            help="Write the results to OUTPUT instead of stdout.", \
+            action="store", type="string")
+    parser.add_option("-s", "--sizes", dest="sizes",\
+            help="Comma separated numbers of rows to benchmark (e.g. 1e3,1e5,1e7). Default: 1e3,1e4,1e5", \
+            action="store", type="string")
+    parser.add_option("-b", "--benchmarks", dest="benchmarks",\
+            help="Comma separated benchmarks to run. Any of: %s. Default: all" % ', '.join(Benchmarks), \
+            action="store", type="string")
+    parser.add_option("-n", "--notations", dest="notations",\
+            help="Comma separated notations to use. Any of: %s. Default: all" % ', '.join(Notations), \
+            action="store", type="string")
+    parser.add_option("--seed", dest="seed",\
+            help="Seed for the random measurements. Default: 0", \
+            action="store", type="int")
+    parser.add_option("-c", "--compare", dest="compare",\
+            help="Print the ratio of each rate to the rate in COMPARE (the output of a previous run) to stderr.", \
+            action="store", type="string")
+    parser.set_defaults(sizes='1e3,1e4,1e5', benchmarks=','.join(Benchmarks),
+                        notations=','.join(Notations), seed=0)
+    (options, args) = parser.parse_args(args=argv[1:])
+    if args: parser.error("Unexpected arguments: %s" % ' '.join(args))
+
+    try:
+        sizes = [int(float(size)) for size in options.sizes.split(',')]
+    except ValueError:
+        parser.error("Invalid sizes: %s" % options.sizes)
+    benchmarks = options.benchmarks.split(',')
+    notations = options.notations.split(',')
+    for name in benchmarks:
+        if name not in Benchmarks: parser.error("Unknown benchmark: %s" % name)
+    for name in notations:
+        if name not in Notations: parser.error("Unknown notation: %s" % name)
+
+    #--Run everything---------------------------------------
+    results = []
+    for rows in sizes:
+        for name in benchmarks:
+            for notation in BenchmarkNotations(name, notations):
+                result = RunIsolated(name, notation, rows, options.seed)
+                print >>sys.stderr, '%-21s %-16s %9i rows %12.0f rows/s %9s kB' % (name, notation, rows,
+                            result['rows_per_second'], result['peak_rss_kb'])
+                results.append(result)
+
+    report = {'environment':Environment(), 'seed':options.seed, 'results':results}
+    if options.output: outfile = open(options.output, 'w')
+    else:              outfile = sys.stdout
+    json.dump(report, outfile, indent=1, sort_keys=True)
+    outfile.write('\n')
+
+    if options.compare:
+        Compare(json.load(open(options.compare)), report)
+
+
+#---------------------------------------------------------------------------------------
+#--Synthetic Data-----------------------------------------------------------------------
+#---------------------------------------------------------------------------------------
+
+#Formats of the synthetic measurements
+Notations = ('azimuth', 'azimuth-dipdir', 'quadrant', 'quadrant-dipdir',
+             'lines', 'lines-dir', 'rakes', 'rakes-dir', 'longlat')
+
+#Compass directions every 45 degrees, starting at north
+Compass = np.array(['N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW'])
+
+def Measurements(notation, rows, seed=0):
+    """Returns a list of rows random measurements (strings without
+    newlines) in the given notation.  The same seed always gives the
+    same measurements."""
+    state = np.random.RandomState(seed)
+    strikes = state.uniform(0, 360, rows)
+    dips = state.uniform(0, 90, rows)
+    rakes = state.uniform(0, 180, rows)
+
+    #--Azimuths with (approximately) the dip direction----
+    dipdirs = Direction(strikes + 90)
+
+    if notation == 'azimuth':
+        return ['%05.1f/%04.1f' % item for item in zip(strikes, dips)]
+    elif notation == 'azimuth-dipdir':
+        return ['%05.1f/%04.1f%s' % item for item in zip(strikes, dips, dipdirs)]
+    elif notation == 'quadrant':
+        return ['%s/%04.1f' % item for item in zip(Quadrant(strikes), dips)]
+    elif notation == 'quadrant-dipdir':
+        return ['%s/%04.1f%s' % item for item in zip(Quadrant(strikes), dips, dipdirs)]
+    elif notation == 'lines':
+        return ['%04.1f/%05.1f' % item for item in zip(dips, strikes)]
+    elif notation == 'lines-dir':
+        return ['%04.1f/%05.1f%s' % item for item in zip(dips, strikes, Direction(strikes))]
+    elif notation == 'rakes':
+        return ['%05.1f/%04.1f %04.1f' % item for item in zip(strikes, dips, rakes / 2)] #Measured from the strike
+    elif notation == 'rakes-dir':
+        #--Rakes < 90 measured from the strike, others from the opposite end
+        ends = np.where(rakes < 90, Direction(strikes), Direction(strikes + 180))
+        rakes = np.where(rakes < 90, rakes, 180 - rakes)
+        return ['%05.1f/%04.1f%s %04.1f%s' % item for item in zip(strikes, dips, dipdirs, rakes, ends)]
+    elif notation == 'longlat':
+        #--Points on the lower hemisphere (the output of stereonet)
+        longs = state.uniform(-90, 90, rows)
+        lats = np.degrees(np.arcsin(state.uniform(-1, 1, rows)))
+        return ['%.2f %.2f' % item for item in zip(longs, lats)]
+    else:
+        raise ValueError('Unknown notation: %s' % notation)
+
+def Direction(azimuths):
+    """Returns the nearest compass direction (e.g. 'NE') to each azimuth"""
+    return Compass[np.round(np.mod(azimuths, 360) / 45).astype(int) % 8]
+
+def Quadrant(azimuths):
+    """Returns each azimuth in quadrant form (e.g. N30E, S20W)"""
+    azimuths = np.mod(azimuths, 360)
+    north = (azimuths <= 90) | (azimuths >= 270)
+    east = azimuths < 180
+    angles = np.where(north, np.where(east, azimuths, 360 - azimuths),
+                             np.where(east, 180 - azimuths, azimuths - 180))
+    first = np.where(north, 'N', 'S')
+    last = np.where(east, 'E', 'W')
+    return ['%s%04.1f%s' % item for item in zip(first, angles, last)]
+
+
+#---------------------------------------------------------------------------------------
+#--Benchmarks---------------------------------------------------------------------------
+#---------------------------------------------------------------------------------------
+#   Each benchmark takes the synthetic measurements and stereonet's options
+#   and returns nothing. Only the time spent in the benchmark is measured.
+
+#Options stereonet would be given for the measurements in each notation
+NotationOptions = {'azimuth':['--planes'], 'azimuth-dipdir':['--planes'],
+                   'quadrant':['--planes'], 'quadrant-dipdir':['--planes'],
+                   'lines':['--lines'], 'lines-dir':['--lines'],
+                   'rakes':['--rakes'], 'rakes-dir':['--rakes'],
+                   'longlat':['--invert', 'planes']}
+
+def OutputXYLines(lines, options):
+    """stereonet.OutputXY called once per measurement"""
+    for line in lines: stereonet.OutputXY(line, options)
+
+def OutputXYBlocks(lines, options):
+    """stereonet.OutputXYBatch called on blocks of measurements (as main does)"""
+    for start in xrange(0, len(lines), stereonet.BlockSize):
+        stereonet.OutputXYBatch(lines[start:start+stereonet.BlockSize], options)
+
+def InvertLines(lines, options):
+    """stereonet.InvertGeographic called once per long,lat pair"""
+    for line in lines: stereonet.InvertGeographic(line, options)
+
+def InvertBlocks(lines, options):
+    """stereonet.InvertGeographicBatch called on blocks of long,lat pairs (as main does)"""
+    for start in xrange(0, len(lines), stereonet.BlockSize):
+        stereonet.InvertGeographicBatch(lines[start:start+stereonet.BlockSize], options)
+
+def CleanLines(lines, options):
+    """stereonet.CleanInput called once per measurement"""
+    for line in lines: stereonet.CleanInput(line, options)
+
+def Pipeline(filename, args):
+    """stereonet.main on a file, with output discarded"""
+    stereonet.main(['stereonet'] + args + [filename, os.devnull])
+
+#Name: (function, notations it applies to)
+Benchmarks = OrderedDict([
+    ('OutputXY',         (OutputXYLines,  Notations[:-1])),
+    ('OutputXYBatch',    (OutputXYBlocks, Notations[:-1])),
+    ('InvertGeographic', (InvertLines,    ('longlat',))),
+    ('InvertGeographicBatch', (InvertBlocks, ('longlat',))),
+    ('CleanInput',       (CleanLines,     Notations[:-1])),
+    ('main',             (Pipeline,       Notations)),
+    ])
+
+def BenchmarkNotations(name, notations):
+    """Returns the notations (of those selected) that benchmark name applies to"""
+    return [notation for notation in Benchmarks[name][1] if notation in notations]
+
+def RunBenchmark(name, notation, rows, seed=0):
+    """Runs a single benchmark in this process and returns its result
+    as a dict."""
+    function = Benchmarks[name][0]
+    lines = Measurements(notation, rows, seed)
+    args = NotationOptions[notation]
+    if notation.startswith('rakes') and name == 'CleanInput': args = ['--rakes', '--clean']
+    if function is Pipeline:
+        #--main reads from a file, so write one first-----
+        handle, filename = tempfile.mkstemp(suffix='.txt')
+        os.write(handle, '\n'.join(lines) + '\n')
+        os.close(handle)
+        del lines
+        try:
+            start = time.time()
+            Pipeline(filename, args)
+            seconds = time.time() - start
+        finally:
+            os.remove(filename)
+    else:
+        options, extra = stereonet.BuildParser().parse_args(args=args)
+        start = time.time()
+        function(lines, options)
+        seconds = time.time() - start
+
+    return {'benchmark':name, 'notation':notation, 'rows':rows, 'seconds':seconds,
+            'rows_per_second':rows / max(seconds, 1e-9), 'peak_rss_kb':PeakRSS()}
+
+def RunIsolated(name, notation, rows, seed=0):
+    """Runs a benchmark in a new process (so that the peak memory use is
+    its own) and returns its result."""
+    queue = Queue()
+    process = Process(target=QueueBenchmark, args=(queue, name, notation, rows, seed))
+    process.start()
+    result = queue.get()
+    process.join()
+    if isinstance(result, Exception): raise result
+    return result
+
+def QueueBenchmark(queue, *args):
+    """Puts the result of RunBenchmark(*args) (or the exception it raised) on queue"""
+    try: queue.put(RunBenchmark(*args))
+    except Exception, error: queue.put(error)
+    except SystemExit, error: queue.put(RuntimeError('stereonet exited: %s' % error))
+
+def PeakRSS():
+    """Returns the peak resident memory of this process in kB (None if unknown)"""
+    if resource is None: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': peak /= 1024 #Reported in bytes instead of kB
+    return peak
+
+
+#---------------------------------------------------------------------------------------
+#--Reporting----------------------------------------------------------------------------
+#---------------------------------------------------------------------------------------
+
+def Environment():
+    """Returns a description of what was benchmarked (commit, versions, machine)"""
+    directory = os.path.dirname(os.path.abspath(stereonet.__file__))
+    try:
+        commit = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=directory,
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0].strip()
+    except OSError:
+        commit = ''
+    return {'commit':commit or None, 'python':platform.python_version(),
+            'numpy':np.__version__, 'machine':platform.machine(), 'platform':platform.platform(),
+            'time':time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def Compare(old, new):
+    """Prints the ratio of the rates in new to those in old (>1 is faster)
+    for every benchmark in both to stderr."""
+    key = lambda result: (result['benchmark'], result['notation'], result['rows'])
+    previous = dict((key(result), result) for result in old['results'])
+    print >>sys.stderr, '\nCompared to %s:' % (old['environment'].get('commit') or 'previous run')
+    for result in new['results']:
+        if key(result) not in previous: continue
+        ratio = result['rows_per_second'] / previous[key(result)]['rows_per_second']
+        if ratio < 0.9:   flag = '  <-- slower'
+        elif ratio > 1.1: flag = '  faster'
+        else:             flag = ''
+        print >>sys.stderr, '%-21s %-16s %9i rows %6.2fx%s' % (key(result) + (ratio, flag))
+
+
+if __name__ == '__main__':
+    #gracefully exit on ctrl-c
+    try: main(sys.argv)
+    except KeyboardInterrupt: pass